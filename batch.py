@@ -0,0 +1,317 @@
+import numpy as np
+import polars as pl
+
+from trades import TradesHandler
+from orderbook import ArrayOrderBook
+from columns import ColumnSpec, column_spec
+from handlers import handle_trades_bucket, handle_OverlapRefresh, is_full_OverlapRefresh
+from check_ob import BookValidator, save_validation
+from profiling import StageClock, bucket_messages, save_replay_profile
+
+try:
+    from numba import njit
+except ImportError: # numba is optional, without it the kernels run as plain python
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda f: f
+
+# integer message codes, 0 to 10 are the DeltaRefresh actions of 1.4.2
+NOOP = -1
+OVERLAP_REFRESH = -2
+MAX_VISIBLE_DEPTH = -3
+
+# columns of the raw message kept for the python handlers, see _OVERLAP_COL_MAPPING
+_SPECIAL_COLS = [
+    'OverlapRefresh_BidChangeIndicator',
+    'OverlapRefresh_AskChangeIndicator',
+    'OverlapRefresh_BidLimits',
+    'OverlapRefresh_AskLimits',
+    'MaxVisibleDepth_MaxVisibleDepth',
+]
+_OVERLAP_COL_MAPPING = {col: i for i, col in enumerate(_SPECIAL_COLS)}
+
+
+def flatten_l2(l2: pl.DataFrame) -> dict:
+    """
+    explodes the bucketed (list column) l2 frame of one instrument into flat per message numpy arrays
+
+    Returns:
+    --------
+    dict with
+    layer, action, level, price, qty:   per message arrays, action holds the integer message codes
+    bucket:                             index of the bucket (row of l2) each message belongs to
+    special:                            {message index: raw values} for OverlapRefresh and MaxVisibleDepth messages
+    """
+    lengths = l2['LayerId'].list.len().fill_null(0).to_numpy()
+    cols = ['LayerId', 'DeltaRefresh_DeltaAction', 'DeltaRefresh_Level', 'DeltaRefresh_Price',
+            'DeltaRefresh_CumulatedUnits'] + _SPECIAL_COLS
+    msgs = (
+        l2.select(cols)
+        .filter(pl.col('LayerId').is_not_null())
+        .explode(cols)
+        .with_columns(
+            # same precedence as handlers.handle_l2_update
+            action = pl.when(pl.col('LayerId').is_null()).then(NOOP)
+            .when(pl.col('OverlapRefresh_BidChangeIndicator').is_not_null() |
+                  pl.col('OverlapRefresh_AskChangeIndicator').is_not_null()).then(OVERLAP_REFRESH)
+            .when(pl.col('DeltaRefresh_DeltaAction').is_not_null())
+            .then(pl.col('DeltaRefresh_DeltaAction').cast(pl.Int8))
+            .when(pl.col('MaxVisibleDepth_MaxVisibleDepth').is_not_null()).then(MAX_VISIBLE_DEPTH)
+            .otherwise(NOOP)
+            .cast(pl.Int8),
+        )
+        .with_row_index('pos')
+    )
+    special = (
+        msgs.filter(pl.col('action') < NOOP)
+        .select(['pos'] + _SPECIAL_COLS)
+        .rows()
+    )
+    return {
+        'layer': msgs['LayerId'].fill_null(-1).to_numpy(),
+        'action': msgs['action'].to_numpy(),
+        'level': msgs['DeltaRefresh_Level'].fill_null(0).cast(pl.Int64).to_numpy(),
+        'price': msgs['DeltaRefresh_Price'].cast(pl.Float64).to_numpy(),
+        'qty': msgs['DeltaRefresh_CumulatedUnits'].cast(pl.Float64).to_numpy(),
+        'bucket': np.repeat(np.arange(len(lengths)), lengths),
+        'special': {row[0]: row[1:] for row in special},
+    }
+
+
+@njit(cache=True)
+def _clear(book, row, level, depth):
+    for j in range(level, depth):
+        book[row, j] = np.nan
+        book[row + 1, j] = np.nan
+
+
+@njit(cache=True)
+def _insert(book, row, level, depth, price, qty):
+    if level >= depth:
+        return
+    for j in range(depth - 1, level, -1):
+        book[row, j] = book[row, j - 1]
+        book[row + 1, j] = book[row + 1, j - 1]
+    book[row, level] = price
+    book[row + 1, level] = qty
+
+
+@njit(cache=True)
+def _remove(book, row, level, depth, price, qty):
+    if level >= depth:
+        raise IndexError("DeltaRefresh level is beyond the visible depth")
+    for j in range(level, depth - 1):
+        book[row, j] = book[row, j + 1]
+        book[row + 1, j] = book[row + 1, j + 1]
+    book[row, depth - 1] = price
+    book[row + 1, depth - 1] = qty
+
+
+@njit(cache=True)
+def _change(book, row, level, depth, qty):
+    # same guard as ArrayOrderBook._change, bounds are not checked in compiled code
+    if level >= depth:
+        raise IndexError("DeltaRefresh level is beyond the visible depth")
+    book[row, level] = qty
+
+
+@njit(cache=True)
+def replay_deltas(book, depth, action, level, price, qty, ends, pos, b, b_stop, out, row0, col, levels):
+    """
+    applies DeltaRefresh messages to an ArrayOrderBook buffer starting at message pos and bucket b,
+    the book is written to out[b - row0, col:col + 4 * levels] every time a bucket ends
+
+    stops at b_stop or at the first OverlapRefresh/MaxVisibleDepth message, which is left to the python handlers
+    returns the position and bucket to resume from
+    """
+    nan = np.nan
+    width = book.shape[1]
+    while b < b_stop:
+        end = ends[b]
+        while pos < end:
+            a = action[pos]
+            if a < NOOP:
+                return pos, b
+            lv = level[pos]
+            if a == 0:      # 1.4.2 0 - ALLClearFromLevel
+                _clear(book, 0, lv, depth)
+                _clear(book, 2, lv, depth)
+            elif a == 1:    # 1.4.2 1 - BidClearFromLevel
+                _clear(book, 0, lv, depth)
+            elif a == 2:    # 1.4.2 2 - AskClearFromLevel
+                _clear(book, 2, lv, depth)
+            elif a == 3:    # 1.4.2 3 - BidInsertAtLevel
+                _insert(book, 0, lv, depth, price[pos], qty[pos])
+            elif a == 4:    # 1.4.2 4 - AskInsertAtLevel
+                _insert(book, 2, lv, depth, price[pos], qty[pos])
+            elif a == 5:    # 1.4.2 5 - BidRemoveLevel
+                _remove(book, 0, lv, depth, nan, nan)
+            elif a == 6:    # 1.4.2 6 - AskRemoveLevel
+                _remove(book, 2, lv, depth, nan, nan)
+            elif a == 7:    # 1.4.2 7 - BidChangeQtyAtLevel
+                _change(book, 1, lv, depth, qty[pos])
+            elif a == 8:    # 1.4.2 8 - AskChangeQtyAtLevel
+                _change(book, 3, lv, depth, qty[pos])
+            elif a == 9:    # 1.4.2 9 - BidRemoveLevelAndAppend
+                _remove(book, 0, lv, depth, price[pos], qty[pos])
+            elif a == 10:   # 1.4.2 10 - AskRemoveLevelAndAppend
+                _remove(book, 2, lv, depth, price[pos], qty[pos])
+            pos += 1
+        # bucket boundary, materialize the book
+        r = b - row0
+        for side in range(4):
+            for j in range(levels):
+                out[r, col + side * levels + j] = book[side, j] if j < depth and j < width else nan
+        b += 1
+    return pos, b
+
+
+class _LayerStream:
+
+    """
+    messages of a single layer and where the replay of that layer currently stands
+    """
+
+    def __init__(self, layer, ob, msgs, n_buckets, warmup=False):
+        self.layer = layer
+        self.ob = ob
+        idx = np.flatnonzero(msgs['layer'] == layer)
+        self.idx = idx
+        self.action = np.ascontiguousarray(msgs['action'][idx])
+        self.level = np.ascontiguousarray(msgs['level'][idx])
+        self.price = np.ascontiguousarray(msgs['price'][idx])
+        self.qty = np.ascontiguousarray(msgs['qty'][idx])
+        self.bucket = msgs['bucket'][idx]
+        self.ends = np.searchsorted(self.bucket, np.arange(n_buckets), side='right').astype(np.int64)
+        self.pos = 0
+        self.synced = not warmup or self._skip_until_full_refresh(msgs['special'])
+
+    def _skip_until_full_refresh(self, special):
+        # the book starts empty, drop everything but MaxVisibleDepth before the first full OverlapRefresh
+        # returns whether there was one
+        first = len(self.action)
+        for pos in np.flatnonzero(self.action == OVERLAP_REFRESH):
+            row = special[self.idx[pos]]
+            if is_full_OverlapRefresh(row[_OVERLAP_COL_MAPPING['OverlapRefresh_BidChangeIndicator']],
+                                      row[_OVERLAP_COL_MAPPING['OverlapRefresh_AskChangeIndicator']]):
+                first = pos
+                break
+        head = self.action[:first]
+        head[head != MAX_VISIBLE_DEPTH] = NOOP
+        return first < len(self.action)
+
+
+def compute_day_batch(
+        l2: pl.DataFrame,
+        l1: pl.DataFrame,
+        l2_col_mapping: dict,
+        l1_col_mapping: dict,
+        ob_handler: dict,
+        trade_handler: TradesHandler,
+        dest,
+        last = None,
+        warmup: bool = False,
+        validation: dict = None,
+        profile: str = None,
+        columns: ColumnSpec = None,
+        chunk_size: int = 2**14,
+    ) -> tuple:
+    """
+    same contract as handlers.compute_day (including warmup, windows and columns), but DeltaRefresh messages
+    of a whole chunk of buckets are applied per layer by the compiled replay_deltas kernel and the books are only read
+    at bucket ends, down to the depth of columns
+    requires ArrayOrderBook books
+    """
+    for ob in ob_handler.values():
+        assert isinstance(ob, ArrayOrderBook), f"batch replay needs ArrayOrderBook, got {type(ob).__name__}"
+    chunks = [(l2, l1)] if l1 is not None else l2
+    columns = column_spec(columns)
+    dest.open()
+    prev_data = last
+    validator = BookValidator(**(validation or {}))
+    synced = set() if warmup else None
+    clock = StageClock() if profile is not None else None
+    rows, messages = 0, 0
+    for l2, l1 in chunks:
+        if clock is not None:
+            rows += l2.height
+            messages += bucket_messages(l2, l1)
+        prev_data = _replay_frames(l2, l1, l1_col_mapping, ob_handler, trade_handler, dest, prev_data,
+                                   synced, validator, clock, columns, chunk_size)
+
+    dest.close()
+    save_validation(validator, dest)
+    if clock is not None:
+        clock.lap('write')
+        save_replay_profile(profile, dest, clock, rows, messages)
+    return prev_data, validator.accuracy(columns.layers[0])
+
+
+def _replay_frames(l2, l1, l1_col_mapping, ob_handler, trade_handler, dest, prev_data, synced, validator, clock,
+                   columns, chunk_size):
+    # replays one pair of bucketed frames, synced holds the layers done warming up (None without warmup)
+    # clock is the profiling.StageClock of the day or None, the kernel runs are charged to the next row's replay
+    msgs = flatten_l2(l2)
+    special = msgs['special']
+    n_buckets = l2.height
+    timestamps = l2['Timestamp'].to_list()
+    streams = []
+    for layer in columns.layers: # in the order of the columns
+        ob = ob_handler[layer]
+        s = _LayerStream(layer, ob, msgs, n_buckets, synced is not None and layer not in synced)
+        if synced is not None and s.synced:
+            synced.add(layer)
+        streams.append(s)
+    levels = max(columns.depth, 1) # the top level is read for the derived values
+    width = 4 * levels
+    out = np.empty((min(chunk_size, n_buckets), width * len(streams)))
+
+    for b0 in range(0, n_buckets, chunk_size):
+        b1 = min(b0 + chunk_size, n_buckets)
+        chunk = out[:b1 - b0]
+
+        # replay the book of each layer over the chunk
+        for i, s in enumerate(streams):
+            b = b0
+            while b < b1:
+                s.pos, b = replay_deltas(
+                    s.ob.book, s.ob.depth, s.action, s.level, s.price, s.qty,
+                    s.ends, s.pos, b, b1, chunk, b0, i * width, levels
+                )
+                if b == b1:
+                    break
+                # OverlapRefresh/MaxVisibleDepth message, falls back to the python handlers
+                row = special[s.idx[s.pos]]
+                if s.action[s.pos] == OVERLAP_REFRESH:
+                    handle_OverlapRefresh(row, s.ob, _OVERLAP_COL_MAPPING, timestamps[b], validator, s.layer)
+                else:
+                    s.ob.MaxVisibleDepth(row[_OVERLAP_COL_MAPPING['MaxVisibleDepth_MaxVisibleDepth']])
+                s.pos += 1
+
+        # process trades and record the features
+        books = columns.select(chunk, levels)
+        for i, trades in enumerate(l1.slice(b0, b1 - b0).iter_rows(named = True)):
+            timestamp = trades.pop('Timestamp')
+            assert timestamp == timestamps[b0 + i]
+            if trades['Code'] is not None:
+                handle_trades_bucket(trades, trade_handler)
+            if clock is not None:
+                clock.lap('replay')
+            data = books[i].tolist()
+            data += trade_handler.get_ohlcva()
+            if trade_handler.stats:
+                data += trade_handler.get_stats(timestamp)
+            data += [f(
+                        data=data,
+                        prev_data=prev_data,
+                        vwap=trade_handler.vwap
+                    ) for f in trade_handler.feature_funcs]
+            if clock is not None:
+                clock.lap('features')
+            dest.write(data, timestamp)
+            prev_data = data
+            if clock is not None:
+                clock.lap('write')
+
+    return prev_data
@@ -0,0 +1,279 @@
+"""
+benchmarks of the replay pipeline on synthetic days (see synthetic.py): loading stage by stage, order book operations
+and the per tick replay with its output, every run is appended to {out}/results.jsonl with the commit it ran on
+
+Usage:  python benchmark.py run [--out <dir>] [--instruments <n>] [--rate <messages/s>] [--layers <n>] [--overlap <share>]
+                                [--hours <h>] [--frequency <seconds>] [--repeat <n>]
+        python benchmark.py compare <commit> [<commit>] [--out <dir>]
+"""
+import os
+import sys
+import json
+import shutil
+import hashlib
+import argparse
+import datetime
+import tempfile
+import platform
+import subprocess
+import time
+from orderbook import LocalOrderBook, ArrayOrderBook
+from trades import TradesHandler
+from handlers import compute_day
+from batch import compute_day_batch, flatten_l2
+from sinks import make_sink
+from feature_func import all_features, snapshot_columns
+from profiling import StageProfile
+from synthetic import generate_day, ACTION_MIX
+from replayer import Replayer
+
+DATE = "2020-12-01"
+EID = "1027"
+ENGINES = {'rows': (compute_day, LocalOrderBook), 'batch': (compute_day_batch, ArrayOrderBook)}
+# DeltaRefresh action codes of 1.4.2 as order book methods and the arguments they take
+BOOK_OPS = [
+    ('ALLClearFromLevel', 'level'),
+    ('BidClearFromLevel', 'level'),
+    ('AskClearFromLevel', 'level'),
+    ('BidInsertAtLevel', 'level price qty'),
+    ('AskInsertAtLevel', 'level price qty'),
+    ('BidRemoveLevel', 'level'),
+    ('AskRemoveLevel', 'level'),
+    ('BidChangeQtyAtLevel', 'level qty'),
+    ('AskChangeQtyAtLevel', 'level qty'),
+    ('BidRemoveLevelAndAppend', 'level price qty'),
+    ('AskRemoveLevelAndAppend', 'level price qty'),
+]
+
+
+def _result(wall: float, rows: int = 0, messages: int = 0) -> dict:
+    return {
+        'wall_s': wall,
+        'rows': rows,
+        'messages': messages,
+        'rows_per_s': rows / wall if wall > 0 else None,
+        'messages_per_s': messages / wall if wall > 0 else None,
+    }
+
+
+def synthetic_data(out: str, params: dict) -> str:
+    """
+    directory of the synthetic day of params, generated on first use
+    """
+    key = hashlib.md5(json.dumps(params, sort_keys=True).encode()).hexdigest()[:12]
+    root = os.path.join(out, "data", key)
+    if not os.path.exists(os.path.join(root, "params.json")):
+        print(f"generating synthetic data in {root}")
+        generate_day(root, DATE, **params)
+        with open(os.path.join(root, "params.json"), 'w') as f:
+            json.dump(params, f)
+    return root
+
+
+def bench_load(src: str, codes: list, frequency: datetime.timedelta, work: str) -> tuple:
+    """
+    times the loading stages of the replayer, from the csv scan to group_by_dynamic
+    returns the results and the bucketed (l2, l1) frames
+    """
+    replayer = Replayer(src, EID, work, DATE, frequency, codes, prefetch=0)
+    replayer.date = DATE
+    profile = StageProfile(DATE)
+    l2, l1 = replayer._load_date(DATE, profile)
+    results = {}
+    for row in profile.rows():
+        results[f"load.{row['stage']}"] = _result(row['wall_s'], row['rows'], row['messages'])
+    return results, (l2, l1)
+
+
+def bench_orderbook(l2) -> dict:
+    """
+    times the DeltaRefresh operations of one instrument's day on each order book, without the message dispatch
+    """
+    msgs = flatten_l2(l2)
+    ops = []
+    for action, layer, level, price, qty in zip(msgs['action'].tolist(), msgs['layer'].tolist(), msgs['level'].tolist(),
+                                                msgs['price'].tolist(), msgs['qty'].tolist()):
+        if 0 <= action < len(BOOK_OPS):
+            name, args = BOOK_OPS[action]
+            values = {'level': level, 'price': price, 'qty': qty}
+            ops.append((layer, name, tuple(values[arg] for arg in args.split())))
+    results = {}
+    for book_type in (LocalOrderBook, ArrayOrderBook):
+        books = {}
+        for layer in {op[0] for op in ops}:
+            books[layer] = book_type("bench")
+            books[layer].MaxVisibleDepth(10)
+        calls = [(getattr(books[layer], name), args) for layer, name, args in ops]
+        start = time.perf_counter()
+        for method, args in calls:
+            method(*args)
+        results[f"orderbook.{book_type.__name__}"] = _result(time.perf_counter() - start, len(calls), len(calls))
+    return results
+
+
+def bench_replay(l2, l1, code: str, frequency: datetime.timedelta, work: str, engine: str, output: str) -> dict:
+    """
+    replays one instrument's day with engine into output, split into the replay, features and write stages
+    """
+    dest = os.path.join(work, f"{engine}-{output}")
+    shutil.rmtree(dest, ignore_errors=True)
+    os.makedirs(dest)
+    compute, book_type = ENGINES[engine]
+    l2_col_mapping = {col: i for i, col in enumerate(l2.columns[1:])}
+    l1_col_mapping = {col: i for i, col in enumerate(l1.columns[1:])}
+    books = {layer: book_type(code) for layer in range(6)}
+    sink = make_sink(output, dest, code, snapshot_columns() + all_features)
+    sink.date = DATE
+    start = time.perf_counter()
+    compute(l2, l1, l2_col_mapping, l1_col_mapping, books, TradesHandler(code, frequency), sink, profile=dest)
+    wall = time.perf_counter() - start
+    with open(os.path.join(dest, f"{code}.{DATE}.json")) as f:
+        stages = json.load(f)
+    name = f"replay.{engine}.{output}"
+    messages = sum(stage['messages'] for stage in stages)
+    results = {name: _result(wall, l2.height, messages)}
+    for stage in stages:
+        results[f"{name}.{stage['stage']}"] = _result(stage['wall_s'], stage['rows'], stage['messages'])
+    return results
+
+
+def _best(runs: list) -> dict:
+    # fastest of the repeats of every benchmark
+    best = {}
+    for results in runs:
+        for name, result in results.items():
+            if name not in best or result['wall_s'] < best[name]['wall_s']:
+                best[name] = result
+    return best
+
+
+def _commit() -> tuple:
+    # (short hash, uncommitted changes) of the tree the benchmarks run on, (None, None) outside of a git repo
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=cwd, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        status = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=cwd, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, status != ""
+
+
+def run(out: str, params: dict, frequency: datetime.timedelta, repeat: int = 3) -> dict:
+    """
+    runs every benchmark repeat times on the synthetic day of params and appends the fastest runs to {out}/results.jsonl
+    """
+    src = synthetic_data(out, params)
+    work = tempfile.mkdtemp(prefix="benchmark-")
+    runs = []
+    try:
+        for _ in range(repeat):
+            results, (l2, l1) = bench_load(src, params['codes'], frequency, work)
+            code = params['codes'][0]
+            results.update(bench_orderbook(l2[code]))
+            for engine, output in (('rows', 'csv'), ('batch', 'csv'), ('batch', 'parquet')):
+                results.update(bench_replay(l2[code], l1[code], code, frequency, work, engine, output))
+            runs.append(results)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    commit, dirty = _commit()
+    record = {
+        'commit': commit,
+        'dirty': dirty,
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'params': params,
+        'frequency_s': frequency.total_seconds(),
+        'repeat': repeat,
+        'results': _best(runs),
+    }
+    with open(os.path.join(out, "results.jsonl"), 'a') as f:
+        f.write(json.dumps(record) + "\n")
+    return record
+
+
+def load_results(out: str) -> list:
+    path = os.path.join(out, "results.jsonl")
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _find(records: list, commit: str) -> dict:
+    # latest run of commit (a prefix of its hash)
+    for record in reversed(records):
+        if record['commit'] is not None and record['commit'].startswith(commit):
+            return record
+    raise ValueError(f"no benchmark results for commit {commit}")
+
+
+def compare(out: str, base: str, head: str = None) -> None:
+    """
+    prints the wall time of every benchmark of the latest runs of base and head (by default the latest run)
+    """
+    records = load_results(out)
+    assert len(records) > 0, f"no benchmark results in {out}"
+    a = _find(records, base)
+    b = records[-1] if head is None else _find(records, head)
+    if a['params'] != b['params'] or a['frequency_s'] != b['frequency_s']:
+        print("warning: the runs used different synthetic data or frequencies")
+    print(f"{'benchmark':<40} {a['commit'] + ('+' if a['dirty'] else ''):>12} {b['commit'] + ('+' if b['dirty'] else ''):>12}  change")
+    for name, result in b['results'].items():
+        before = a['results'].get(name)
+        if before is None:
+            print(f"{name:<40} {'':>12} {result['wall_s']:>12.4f}")
+            continue
+        change = (result['wall_s'] / before['wall_s'] - 1) * 100 if before['wall_s'] > 0 else float('nan')
+        print(f"{name:<40} {before['wall_s']:>12.4f} {result['wall_s']:>12.4f}  {change:+.1f}%")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="replayer benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+    bench = commands.add_parser("run", help="run the benchmarks and record the results")
+    bench.add_argument("--out", default="benchmarks", help="directory of the results and the synthetic data")
+    bench.add_argument("--instruments", type=int, default=2)
+    bench.add_argument("--rate", type=float, default=1.0, help="l2 messages per second and instrument")
+    bench.add_argument("--trade-rate", type=float, default=0.25, help="trades per second and instrument")
+    bench.add_argument("--layers", type=int, default=2)
+    bench.add_argument("--overlap", type=float, default=0.005, help="share of full OverlapRefresh snapshots")
+    bench.add_argument("--action-mix", type=json.loads, default=ACTION_MIX, help="json {action: weight}")
+    bench.add_argument("--hours", type=float, default=24.0, help="hours of the day with messages")
+    bench.add_argument("--frequency", type=float, default=1.0, help="replay frequency in seconds")
+    bench.add_argument("--repeat", type=int, default=3)
+    bench.add_argument("--seed", type=int, default=0)
+    diff = commands.add_parser("compare", help="compare the recorded results of two commits")
+    diff.add_argument("base")
+    diff.add_argument("head", nargs="?", default=None)
+    diff.add_argument("--out", default="benchmarks")
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        compare(args.out, args.base, args.head)
+        return
+    os.makedirs(args.out, exist_ok=True)
+    params = {
+        'codes': [f"SYN{i}" for i in range(args.instruments)],
+        'eid': EID,
+        'rate': args.rate,
+        'trade_rate': args.trade_rate,
+        'layers': args.layers,
+        'action_mix': args.action_mix,
+        'overlap_fraction': args.overlap,
+        'hours': args.hours,
+        'seed': args.seed,
+    }
+    record = run(args.out, params, datetime.timedelta(seconds=args.frequency), args.repeat)
+    print(f"{'benchmark':<40} {'wall_s':>10} {'rows/s':>12} {'messages/s':>12}")
+    for name, result in record['results'].items():
+        rows = f"{result['rows_per_s']:.0f}" if result['rows_per_s'] else ""
+        messages = f"{result['messages_per_s']:.0f}" if result['messages_per_s'] else ""
+        print(f"{name:<40} {result['wall_s']:>10.4f} {rows:>12} {messages:>12}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
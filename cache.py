@@ -0,0 +1,143 @@
+import os
+import json
+import shutil
+import hashlib
+import datetime
+import polars as pl
+from data_schema import L2_SCHEMA, L1_SCHEMA
+
+# bump whenever the preprocessing in Replayer._read_next_date changes its output
+CACHE_VERSION = 4
+
+
+def schema_hash(*parts) -> str:
+    """
+    hash of the input schemas, the cache version and any extra preprocessing parameters
+    """
+    h = hashlib.sha1(f"v{CACHE_VERSION}".encode())
+    for schema in (L2_SCHEMA, L1_SCHEMA):
+        for col, dtype in schema.items():
+            h.update(f"{col}:{dtype};".encode())
+    for part in parts:
+        h.update(repr(part).encode())
+    return h.hexdigest()[:16]
+
+
+class DayCache:
+
+    """
+    parquet cache of the bucketed per instrument frames produced by Replayer._read_next_date
+    one entry per (eid, date, frequency, schema hash) under {root}/{eid}/{date}/{frequency}/{schema hash}/
+    holding a {code}_l2.parquet and {code}_l1.parquet per instrument and a meta.json with
+    the cached codes, whether they are every instrument of the day (full_universe) and
+    the size/mtime of the source files the entry was built from
+
+    an entry is dropped as soon as its source files change,
+    least recently used entries are evicted once the cache grows past max_bytes
+    """
+
+    def __init__(self, root: str, max_bytes: int = 100 * 2**30, key_parts: tuple = ()) -> None:
+        self.root = root
+        self.max_bytes = max_bytes
+        self.schema = schema_hash(*key_parts)
+        os.makedirs(self.root, exist_ok=True)
+
+    def entry(self, eid: str, date: str, freq: datetime.timedelta) -> str:
+        freq = f"{int(freq / datetime.timedelta(microseconds=1))}us"
+        return os.path.join(self.root, str(eid), date, freq, self.schema)
+
+    def load(self, eid: str, date: str, freq: datetime.timedelta, codes: list, sources: list):
+        """
+        returns (codes, {code: l2 frame}, {code: l1 frame}) or None on a miss
+        an empty codes list loads every instrument of the day, a miss unless an entry was stored with full_universe
+        """
+        entry = self.entry(eid, date, freq)
+        meta = self._read_meta(entry)
+        if meta is None:
+            return None
+        if meta['sources'] != self._stat(sources):
+            print(f"cache entry {entry} is stale, dropping it")
+            shutil.rmtree(entry, ignore_errors=True)
+            return None
+        if codes == []:
+            if not meta['full_universe']:
+                return None # only the instruments of earlier universes are cached
+            codes = meta['codes']
+        if not set(codes).issubset(meta['codes']):
+            return None
+        l2 = {code: pl.read_parquet(os.path.join(entry, f"{code}_l2.parquet")) for code in codes}
+        l1 = {code: pl.read_parquet(os.path.join(entry, f"{code}_l1.parquet")) for code in codes}
+        os.utime(os.path.join(entry, "meta.json")) # mark as recently used
+        return codes, l2, l1
+
+    def store(self, eid: str, date: str, freq: datetime.timedelta, l2: dict, l1: dict, sources: list,
+              full_universe: bool = False) -> None:
+        """
+        adds the instruments of l2 and l1 to the entry, full_universe if they are every instrument of the day
+        """
+        entry = self.entry(eid, date, freq)
+        stat = self._stat(sources)
+        meta = self._read_meta(entry)
+        if meta is None or meta['sources'] != stat:
+            shutil.rmtree(entry, ignore_errors=True)
+            meta = {'sources': stat, 'codes': [], 'full_universe': False}
+        os.makedirs(entry, exist_ok=True)
+        for code in l2.keys():
+            for name, data in ((f"{code}_l2.parquet", l2[code]), (f"{code}_l1.parquet", l1[code])):
+                # write then rename so readers never see a partial file
+                tmp = os.path.join(entry, f".{name}.tmp")
+                data.write_parquet(tmp)
+                os.replace(tmp, os.path.join(entry, name))
+        meta['codes'] = sorted(set(meta['codes']) | set(l2.keys()))
+        meta['full_universe'] = meta['full_universe'] or full_universe
+        tmp = os.path.join(entry, ".meta.json.tmp")
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, os.path.join(entry, "meta.json"))
+        self.evict(keep=entry)
+
+    def invalidate(self, eid: str = None, date: str = None) -> None:
+        """
+        drops every entry, every entry of an exchange, or the entries of one exchange and date
+        """
+        path = self.root
+        if eid is not None:
+            path = os.path.join(path, str(eid))
+            if date is not None:
+                path = os.path.join(path, date)
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(self.root, exist_ok=True)
+
+    def evict(self, keep: str = None) -> None:
+        # least recently used first, meta.json is touched on every hit
+        entries = []
+        total = 0
+        for dirpath, _, files in os.walk(self.root):
+            if "meta.json" not in files:
+                continue
+            size = sum(os.path.getsize(os.path.join(dirpath, f)) for f in files)
+            entries.append((os.path.getmtime(os.path.join(dirpath, "meta.json")), size, dirpath))
+            total += size
+        for _, size, dirpath in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if dirpath == keep:
+                continue
+            shutil.rmtree(dirpath, ignore_errors=True)
+            total -= size
+            print(f"evicted cache entry {dirpath}")
+
+    def _read_meta(self, entry: str):
+        try:
+            with open(os.path.join(entry, "meta.json")) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def _stat(sources: list) -> list:
+        stats = []
+        for path in sources:
+            st = os.stat(path)
+            stats.append([os.path.basename(path), st.st_size, st.st_mtime_ns])
+        return stats
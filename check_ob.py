@@ -1,31 +1,209 @@
-from datetime import datetime
-
-def check_ob(ob_handler, bid_limits, ask_limits, timestamp):
-    consistent = True
-    local_ob_bid_prices = ob_handler.bid_prices
-    local_ob_bid_volumes = ob_handler.bid_volumes
-    local_ob_ask_prices = ob_handler.ask_prices
-    local_ob_ask_volumes = ob_handler.ask_volumes    
-    timestamp = timestamp.strftime("%Y-%m-%d %H:%M:%S.%f")
-    for i in range(len(bid_limits)):
-        bid_price_diff = local_ob_bid_prices[i] - bid_limits[i][0]
-        bid_volume_diff = local_ob_bid_volumes[i] - bid_limits[i][1]
-        if abs(bid_price_diff) > 1e-3 or abs(bid_volume_diff) > 1e-3:
-            consistent = False
-            msg = f"Timestamp: {timestamp}, Bid mismatch at Level {i}: bid_price_diff: {abs(bid_price_diff)},\
-                    bid_volume_diff: {abs(bid_volume_diff)}, reference bid_limits: {bid_limits},\
-                    local bid snapshot: {ob_handler.take_snapshot()[0:20]}"
-            print(msg)
-            break
-    for i in range(len(ask_limits)):
-        ask_price_diff = local_ob_ask_prices[i] - ask_limits[i][0]
-        ask_volume_diff = local_ob_ask_volumes[i] - ask_limits[i][1]
-        if abs(ask_price_diff) > 1e-3 or abs(ask_volume_diff) > 1e-3:
-            consistent = False
-            msg = f"Timestamp: {timestamp}, Ask mismatch at Level {i}: ask_price_diff: {abs(ask_price_diff)},\
-                    ask_volume_diff: {abs(ask_volume_diff)}, reference ask_limits: {ask_limits},\
-                    local ask snapshot: {ob_handler.take_snapshot()[20:40]}"
-            print(msg)
-            break
-    return consistent
-    
+import os
+import json
+import random
+import numpy as np
+from datetime import datetime, timedelta
+from sinks import report_path
+
+VALIDATION_MODES = ('off', 'sampled', 'all')
+
+
+def _format(timestamp):
+    # bucket boundaries are datetimes, event time replay passes microseconds since epoch
+    if isinstance(timestamp, int):
+        timestamp = datetime(1970, 1, 1) + timedelta(microseconds=timestamp)
+    return timestamp.strftime("%Y-%m-%d %H:%M:%S.%f")
+
+
+def _levels(ob, bid_limits, ask_limits) -> tuple:
+    """
+    (local, reference) (side, level, price/qty) arrays of the book and of the flat [price, qty, ...] limits,
+    nan past the local depth and past the shorter of the limits
+    """
+    n = max(len(bid_limits), len(ask_limits)) // 2
+    if len(bid_limits) == len(ask_limits):
+        reference = np.array((bid_limits, ask_limits), dtype=np.float64).reshape(2, n, 2)
+    else:
+        reference = np.full((2, 2 * n), np.nan)
+        reference[0, :len(bid_limits)] = bid_limits
+        reference[1, :len(ask_limits)] = ask_limits
+        reference = reference.reshape(2, n, 2)
+    depth = min(n, len(ob.bid_prices))
+    # None (empty level of a LocalOrderBook) becomes nan
+    local = np.array((ob.bid_prices[:depth], ob.bid_volumes[:depth], ob.ask_prices[:depth], ob.ask_volumes[:depth]),
+                     dtype=np.float64).reshape(4, depth)
+    if depth < n:
+        local = np.concatenate((local, np.full((4, n - depth), np.nan)), axis=1)
+    return local.reshape(2, 2, n).transpose(0, 2, 1), reference
+
+
+def _mismatches(local, reference, tolerance) -> np.ndarray:
+    # (side, level) mask of the levels of the limits the book does not match,
+    # an empty (nan) or missing local level mismatches a level of the limits, levels past the limits never do
+    return ~(np.abs(local - reference) <= tolerance).all(axis=2) & ~np.isnan(reference[:, :, 0])
+
+
+def check_ob(ob_handler, bid_limits, ask_limits, timestamp, tolerance=1e-3):
+    """
+    True when the first levels of the book equal the limits of a full OverlapRefresh
+    every level of the limits is compared: a level the book has empty (nan) or lacks (past its depth) is a mismatch,
+    where the original level by level loop counted a nan level as consistent, so a book missing levels of the
+    snapshot is no longer reported as accurate, levels past the limits (the shorter side of the snapshot) are not compared
+    """
+    local, reference = _levels(ob_handler, bid_limits, ask_limits)
+    if np.abs(local - reference).max(initial=0.0) <= tolerance:
+        return True
+    return not _mismatches(local, reference, tolerance).any()
+
+
+def _mean(sums: list, counts: list) -> list:
+    return [None if n == 0 else total / n for total, n in zip(sums, counts)]
+
+
+class _LayerStats:
+
+    __slots__ = ('checked', 'consistent', 'mismatches', 'price_drift', 'qty_drift')
+
+    def __init__(self, levels: int) -> None:
+        self.checked = 0
+        self.consistent = 0
+        # [bid, ask] x level: mismatching checks and summed absolute differences where both sides have the level
+        self.mismatches = np.zeros((2, levels), dtype=np.int64)
+        self.price_drift = np.zeros((2, levels))
+        self.qty_drift = np.zeros((2, levels))
+
+
+class BookValidator:
+
+    """
+    checks the books against the full OverlapRefresh snapshots of one instrument and day
+    mode 'off' checks nothing, 'sampled' every every-th full snapshot and 'all' every one of them
+    only counters are kept: per layer checks, per side and level mismatches and price/qty drift,
+    plus a reservoir of at most reservoir mismatching levels, see report
+    """
+
+    def __init__(self, mode: str = 'all', every: int = 100, levels: int = 10, reservoir: int = 32,
+                 tolerance: float = 1e-3, seed: int = 0) -> None:
+        assert mode in VALIDATION_MODES, f"unknown validation mode {mode}, expected one of {VALIDATION_MODES}"
+        assert every > 0, "every must be positive"
+        self.mode = mode
+        self.every = 1 if mode == 'all' else every
+        self.levels = levels
+        self.tolerance = tolerance
+        self.size = reservoir
+        self.reservoir = []
+        self.seen = 0 # full snapshots, checked or not
+        self.found = 0 # mismatching levels offered to the reservoir
+        self.layers = {}
+        self._random = random.Random(seed)
+
+    def check(self, ob, bid_limits, ask_limits, timestamp, layer: int = 0):
+        """
+        result of the check of a full snapshot, None when it is not checked
+        """
+        self.seen += 1
+        if self.mode == 'off' or self.seen % self.every:
+            return None
+        stats = self.layers.get(layer)
+        if stats is None:
+            stats = self.layers[layer] = _LayerStats(self.levels)
+        stats.checked += 1
+        local, reference = _levels(ob, bid_limits, ask_limits)
+        consistent = np.abs(local - reference).max(initial=0.0) <= self.tolerance
+        if not consistent:
+            # only mismatching snapshots are looked at level by level
+            bad = _mismatches(local, reference, self.tolerance)
+            consistent = not bad.any()
+            diff = np.abs(local - reference)
+            for side, level in zip(*np.nonzero(bad)):
+                side, level = int(side), int(level)
+                if level < self.levels:
+                    stats.mismatches[side, level] += 1
+                    if not np.isnan(diff[side, level]).any():
+                        stats.price_drift[side, level] += diff[side, level, 0]
+                        stats.qty_drift[side, level] += diff[side, level, 1]
+                self._keep(timestamp, layer, side, level, local[side, level], reference[side, level])
+        consistent = bool(consistent)
+        stats.consistent += consistent
+        return consistent
+
+    def _keep(self, timestamp, layer, side, level, local, reference) -> None:
+        # reservoir sampling, every mismatching level is kept with the same probability
+        self.found += 1
+        if len(self.reservoir) < self.size:
+            i = len(self.reservoir)
+            self.reservoir.append(None)
+        else:
+            i = self._random.randrange(self.found)
+            if i >= self.size:
+                return
+        self.reservoir[i] = (timestamp, layer, side, level, *local.tolist(), *reference.tolist())
+
+    def accuracy(self, layer: int = 0) -> float:
+        """
+        share of the checked snapshots of layer that matched, nan without any
+        """
+        stats = self.layers.get(layer)
+        if stats is None or stats.checked == 0:
+            return np.nan
+        return stats.consistent / stats.checked
+
+    def report(self) -> dict:
+        layers = {}
+        for layer, stats in sorted(self.layers.items()):
+            sides = {}
+            for side, name in enumerate(('bid', 'ask')):
+                mismatches = stats.mismatches[side].tolist()
+                sides[name] = {
+                    'mismatches': mismatches,
+                    # mean absolute difference of the mismatching levels, None without any
+                    'price_drift': _mean(stats.price_drift[side].tolist(), mismatches),
+                    'qty_drift': _mean(stats.qty_drift[side].tolist(), mismatches),
+                }
+            layers[layer] = {
+                'checked': stats.checked,
+                'consistent': stats.consistent,
+                'accuracy': stats.consistent / stats.checked if stats.checked else None,
+                **sides,
+            }
+        mismatches = [
+            {
+                'timestamp': _format(timestamp),
+                'layer': layer,
+                'side': ('bid', 'ask')[side],
+                'level': level,
+                'price': None if np.isnan(price) else price,
+                'qty': None if np.isnan(qty) else qty,
+                'reference_price': reference_price,
+                'reference_qty': reference_qty,
+            }
+            for timestamp, layer, side, level, price, qty, reference_price, reference_qty in sorted(
+                self.reservoir, key=lambda entry: (str(entry[0]), entry[1], entry[2], entry[3]))
+        ]
+        return {
+            'mode': self.mode,
+            'every': self.every,
+            'full_snapshots': self.seen,
+            'checked': sum(stats.checked for stats in self.layers.values()),
+            'consistent': sum(stats.consistent for stats in self.layers.values()),
+            'mismatching_levels': self.found,
+            'layers': layers,
+            'mismatches': mismatches,
+        }
+
+    def save(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(self.report(), f)
+        os.replace(tmp, path)
+
+
+def save_validation(validator: BookValidator, sink, code: str = None) -> None:
+    """
+    writes the report of a day of code (by default the sink's) with the reports of its sink:
+    {dest}/_reports/{code}.{date}.validation.json (see sinks.report_path)
+    """
+    if validator.mode == 'off' or sink.date is None:
+        return
+    validator.save(report_path(sink, 'validation', code))
@@ -0,0 +1,36 @@
+import os
+import pickle
+
+
+def checkpoint_path(root: str, code: str, date: str) -> str:
+    return os.path.join(root, code, f"{date}.pkl")
+
+
+def save_checkpoint(root: str, code: str, date: str, ob_handler: dict, trade_handler, last) -> None:
+    """
+    stores the end of day state of one instrument: its order books, trades handler and last output row
+    """
+    path = checkpoint_path(root, code, date)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, 'wb') as f:
+        pickle.dump((ob_handler, trade_handler, last), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path) # never leave a truncated checkpoint behind
+
+
+def load_checkpoint(root: str, code: str, date: str, layers: list = None):
+    """
+    returns (ob_handler, trade_handler, last) saved at the end of date, or None
+    with layers, also None unless the checkpoint holds the books of exactly these layers,
+    otherwise it was written by a replay of other columns
+    """
+    if date is None:
+        return None
+    try:
+        with open(checkpoint_path(root, code, date), 'rb') as f:
+            ob_handler, trade_handler, last = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    if layers is not None and sorted(ob_handler) != list(layers):
+        return None
+    return ob_handler, trade_handler, last
@@ -0,0 +1,133 @@
+import numpy as np
+
+# fields of a book level, in the order of the rows of an ArrayOrderBook buffer and of take_snapshot
+FIELDS = ('bid_price', 'bid_qty', 'ask_price', 'ask_qty')
+# values derived from the top level of a book
+DERIVED = ('mid', 'spread', 'microprice')
+
+
+def _padded(ob, levels: int, rows: list) -> list:
+    # the rows of take_snapshot(levels, fields=rows), nan padded past the visible depth like the batch engine
+    sides = (ob.bid_prices, ob.bid_volumes, ob.ask_prices, ob.ask_volumes)
+    pad = [np.nan] * levels
+    data = []
+    for row in rows:
+        side = sides[row][:levels]
+        side = side.tolist() if isinstance(side, np.ndarray) else side # python floats, like take_snapshot
+        data += side + pad[len(side):]
+    return data
+
+
+def derive(top: tuple, derived: tuple) -> list:
+    """
+    derived values of one book from its top level (bid price, bid qty, ask price, ask qty), nan without it
+    """
+    bid, bid_qty, ask, ask_qty = top
+    values = []
+    for name in derived:
+        if name == 'mid':
+            values.append((bid + ask) / 2)
+        elif name == 'spread':
+            values.append(ask - bid)
+        else: # microprice, the mid weighted towards the side with less quantity
+            total = bid_qty + ask_qty
+            values.append((bid * ask_qty + ask * bid_qty) / total if total > 0 else np.nan)
+    return values
+
+
+class ColumnSpec:
+
+    """
+    book columns written every tick: the books of layers, depth levels per side, the fields of each level
+    and values derived from the top of each book (see DERIVED), laid out layer by layer as
+    layer_{layer}_{field}_{level} for every field and level, then layer_{layer}_{derived}
+
+    only the books of layers are allocated and replayed, messages of any other layer are dropped when a day is loaded,
+    the default is the full snapshot: 6 layers, 10 levels, every field and nothing derived
+    """
+
+    def __init__(self, layers=range(6), depth: int = 10, fields=FIELDS, derived=()) -> None:
+        self.layers = sorted({int(layer) for layer in layers})
+        self.depth = depth
+        self.fields = list(fields)
+        self.derived = list(derived)
+        assert len(self.layers) > 0, "a column spec needs at least one layer"
+        assert all(0 <= layer < 128 for layer in self.layers), f"layers {self.layers} out of range"
+        assert depth >= 0, "depth must not be negative"
+        unknown = [field for field in self.fields if field not in FIELDS]
+        assert unknown == [], f"unknown fields {unknown}, expected some of {list(FIELDS)}"
+        unknown = [name for name in self.derived if name not in DERIVED]
+        assert unknown == [], f"unknown derived values {unknown}, expected some of {list(DERIVED)}"
+        assert (depth > 0 and len(self.fields) > 0) or len(self.derived) > 0, "the column spec selects no book column"
+        self.rows = [FIELDS.index(field) for field in self.fields] # rows of the book buffer
+        self.full = self.fields == list(FIELDS) # fields in take_snapshot order, the snapshot is taken as is
+
+    def columns(self) -> list:
+        """
+        names of the book columns, in the order snapshot lays them out
+        """
+        levels = [f'{field}_{i}' for field in self.fields for i in range(self.depth)] + self.derived
+        return [f"layer_{layer}_{col}" for layer in self.layers for col in levels]
+
+    def books(self, code: str, orderbook: type) -> dict:
+        # {layer: empty book} of the layers of the spec
+        return {layer: orderbook(code) for layer in self.layers}
+
+    def filters(self) -> bool:
+        # whether messages of some layers of the six are dropped at load time
+        return self.layers != list(range(6))
+
+    def snapshot(self, ob_handler: dict) -> list:
+        """
+        the book columns of one tick off the live books, for the rows engine
+        """
+        data = []
+        for layer in self.layers:
+            ob = ob_handler[layer]
+            if self.depth > len(ob.bid_prices):
+                data += _padded(ob, self.depth, self.rows) # a book shallower than the columns
+            elif self.depth > 0:
+                data += ob.take_snapshot(self.depth) if self.full else ob.take_snapshot(self.depth, fields=self.rows)
+            if self.derived:
+                data += derive(ob.top(), self.derived)
+        return data
+
+    def select(self, block: np.ndarray, levels: int) -> np.ndarray:
+        """
+        the book columns of a block of ticks off the books of the batch engine,
+        block is (ticks, layer x side x level) as replay_deltas writes it, with levels levels per side
+        """
+        if self.full and self.depth == levels and not self.derived:
+            return block
+        books = block.reshape(len(block), len(self.layers), len(FIELDS), levels)
+        parts = [books[:, :, self.rows, :self.depth].reshape(len(block), len(self.layers), -1)]
+        if self.derived:
+            bid, bid_qty, ask, ask_qty = (books[:, :, row, 0] for row in range(len(FIELDS)))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                total = bid_qty + ask_qty
+                derived = {
+                    'mid': (bid + ask) / 2,
+                    'spread': ask - bid,
+                    'microprice': np.where(total > 0, (bid * ask_qty + ask * bid_qty) / total, np.nan),
+                }
+            parts.append(np.stack([derived[name] for name in self.derived], axis=2))
+        return np.concatenate(parts, axis=2).reshape(len(block), -1)
+
+    def describe(self) -> dict:
+        # the spec as plain values, for the run manifest and repr
+        return {'layers': self.layers, 'depth': self.depth, 'fields': self.fields, 'derived': self.derived}
+
+    def __repr__(self) -> str:
+        return f"ColumnSpec({self.describe()})"
+
+
+def column_spec(spec=None) -> ColumnSpec:
+    """
+    ColumnSpec of spec, given as None (the full snapshot), a ColumnSpec or a dict of its params, e.g.
+    {'layers': [0], 'depth': 5, 'fields': ['bid_price', 'ask_price'], 'derived': ['mid', 'spread']}
+    """
+    if spec is None:
+        return ColumnSpec()
+    if isinstance(spec, ColumnSpec):
+        return spec
+    return ColumnSpec(**spec)
@@ -0,0 +1,305 @@
+"""
+file based coordination of replay nodes that share a filesystem, no service involved
+every (date, code) unit of a plan is replayed by one node at a time under a lease, laid out in root as
+
+{root}/plan.json                        [[date, code], ...] of the units, written once by the first node
+{root}/leases/{date}_{code}             lease of the node replaying the unit: {"node", "attempt"}, renewed by touching it
+{root}/done/{date}_{code}.json          result of a finished unit, the unit is never replayed again
+{root}/failed/{date}_{code}/{node}.{n}  traceback of every failed attempt, or the note of an expired lease
+{root}/merged.json                      {code: last date} stitched into the output of every instrument, see merged
+{root}/clock/{node}                     touched to read the time of the shared filesystem
+
+a unit is retried until max_attempts attempts failed, a lease not renewed for lease seconds has expired
+and its unit goes to the next node that claims it, so nodes may die and runs resume where they stopped
+lease ages are measured against the time of the filesystem (the mtime of a freshly touched file), not the clocks
+of the nodes, and a node only renews, completes or releases a lease while it is still the one it acquired,
+every attempt is named (see attempt) so that its output can be written apart and promoted once the unit completes
+"""
+import os
+import json
+import time
+import socket
+import threading
+from contextlib import contextmanager
+
+
+def _unit(date: str, code: str) -> str:
+    return f"{date}_{code}"
+
+
+def _write(path: str, data: str) -> None:
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'w') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+class Coordinator:
+
+    """
+    one node's view of a coordinator directory, see the module docstring for the layout
+    node names the node in leases and failures, by default {hostname}-{pid}
+    """
+
+    def __init__(self, root: str, node: str = None, lease: float = 60.0, max_attempts: int = 3) -> None:
+        assert lease > 0, "lease must be positive"
+        assert max_attempts > 0, "max_attempts must be positive"
+        self.root = root
+        self.node = node if node is not None else f"{socket.gethostname()}-{os.getpid()}"
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.held = {} # {(date, code): attempt} of the leases acquired by this node
+        for directory in ('leases', 'done', 'failed', 'clock'):
+            os.makedirs(os.path.join(root, directory), exist_ok=True)
+
+    def _path(self, *parts) -> str:
+        return os.path.join(self.root, *parts)
+
+    def _now(self) -> float:
+        # the time of the shared filesystem, which stamps the mtime of the leases as well
+        path = self._path("clock", self.node)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            open(path, 'w').close()
+        return os.stat(path).st_mtime
+
+    def plan(self, dates: list, codes: list) -> list:
+        """
+        units of the plan, which is written from dates x codes unless a node already did
+        every node must ask for the same plan
+        """
+        units = sorted([date, code] for date in dates for code in codes)
+        path = self._path("plan.json")
+        if not os.path.exists(path):
+            tmp = f"{path}.{self.node}.tmp"
+            with open(tmp, 'w') as f:
+                json.dump(units, f)
+            try:
+                os.link(tmp, path) # fails if another node was first
+            except FileExistsError:
+                pass
+            os.remove(tmp)
+        planned = self.units()
+        if planned != [tuple(unit) for unit in units]:
+            raise ValueError(f"{self.root} holds a different plan, use another directory for other dates or codes")
+        return planned
+
+    def units(self) -> list:
+        with open(self._path("plan.json")) as f:
+            return [tuple(unit) for unit in json.load(f)]
+
+    def _done(self) -> list:
+        return [name[:-len(".json")] for name in os.listdir(self._path("done")) if name.endswith(".json")]
+
+    def done(self) -> dict:
+        """
+        {(date, code): result} of the finished units
+        """
+        results = {}
+        for unit in self._done():
+            with open(self._path("done", f"{unit}.json")) as f:
+                results[tuple(unit.split('_', 1))] = json.load(f)
+        return results
+
+    def attempts(self, date: str, code: str) -> int:
+        # failed attempts of the unit
+        try:
+            return sum(not name.endswith(".tmp") for name in os.listdir(self._path("failed", _unit(date, code))))
+        except FileNotFoundError:
+            return 0
+
+    def status(self) -> dict:
+        """
+        {(date, code): 'done', 'leased', 'failed' (no attempts left) or 'pending'} of every unit
+        """
+        # one listing per directory, the units without a file in it are not looked at
+        done = set(self._done())
+        failed = set(os.listdir(self._path("failed")))
+        leased = set(os.listdir(self._path("leases")))
+        now = self._now() if leased else None
+        status = {}
+        for date, code in self.units():
+            unit = _unit(date, code)
+            if unit in done:
+                status[(date, code)] = 'done'
+            elif unit in failed and self.attempts(date, code) >= self.max_attempts:
+                status[(date, code)] = 'failed'
+            elif unit in leased and self._lease(date, code, now) is not None:
+                status[(date, code)] = 'leased'
+            else:
+                status[(date, code)] = 'pending'
+        return status
+
+    def finished(self) -> bool:
+        # nothing left to claim or waiting for another node
+        return all(state in ('done', 'failed') for state in self.status().values())
+
+    def claim(self, limit: int = 1) -> list:
+        """
+        leases up to limit pending units of one date, the earliest with any, so the date is loaded once for all of them
+        returns the [(date, code)] leased, empty when no unit can be claimed right now
+        """
+        claimed = []
+        for date, code in sorted(unit for unit, state in self.status().items() if state == 'pending'):
+            if claimed and date != claimed[0][0]:
+                break
+            if self._acquire(date, code):
+                claimed.append((date, code))
+                if len(claimed) == limit:
+                    break
+        return claimed
+
+    def _lease(self, date: str, code: str, now: float = None):
+        # {"node", "attempt"} of the live lease of the unit, None without one or once it expired
+        path = self._path("leases", _unit(date, code))
+        now = now if now is not None else self._now()
+        try:
+            if now - os.stat(path).st_mtime > self.lease:
+                return None
+        except FileNotFoundError:
+            return None
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {'node': "unknown", 'attempt': None} # being written or released right now
+
+    def attempt(self, date: str, code: str) -> str:
+        """
+        name of the attempt of the unit this node holds the lease of: {node}.{failed attempts before it}
+        """
+        return self.held[(date, code)]
+
+    def owns(self, date: str, code: str) -> bool:
+        """
+        whether this node still holds the live lease it acquired for the unit, a lease that expired
+        may have been taken over by another node, whose attempt then owns the unit
+        """
+        lease = self._lease(date, code)
+        return lease is not None and lease == {'node': self.node, 'attempt': self.held.get((date, code))}
+
+    def _acquire(self, date: str, code: str) -> bool:
+        path = self._path("leases", _unit(date, code))
+        if os.path.exists(path) and not self._break(path, date, code):
+            return False
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False # another node was first
+        attempt = f"{self.node}.{self.attempts(date, code)}"
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'node': self.node, 'attempt': attempt}, f)
+        # a unit finished by another node between the status and the lease is not replayed again
+        if os.path.exists(self._path("done", f"{_unit(date, code)}.json")):
+            os.remove(path)
+            return False
+        self.held[(date, code)] = attempt
+        return True
+
+    def _break(self, path: str, date: str, code: str) -> bool:
+        # takes an expired lease away from its node, only one of the nodes trying succeeds
+        try:
+            if self._now() - os.stat(path).st_mtime <= self.lease:
+                return False
+            stale = f"{path}.{self.node}.stale"
+            os.rename(path, stale)
+        except FileNotFoundError:
+            return True # released meanwhile
+        if self._now() - os.stat(stale).st_mtime <= self.lease:
+            # another node renewed or replaced it after the check, give it back
+            try:
+                os.link(stale, path)
+            except FileExistsError:
+                pass
+            os.remove(stale)
+            return False
+        try:
+            with open(stale) as f:
+                owner = json.load(f)['node']
+        except json.JSONDecodeError:
+            owner = "unknown"
+        os.remove(stale)
+        self._record_failure(date, code, f"lease of {owner} expired\n")
+        return True
+
+    def renew(self, units: list) -> None:
+        # a lease that expired is not renewed, another node may have taken it over
+        for date, code in units:
+            if self.owns(date, code):
+                try:
+                    os.utime(self._path("leases", _unit(date, code)))
+                except FileNotFoundError:
+                    pass # broken meanwhile
+
+    @contextmanager
+    def hold(self, units: list):
+        """
+        renews the leases of units every lease / 3 seconds from a daemon thread while the block runs
+        """
+        stop = threading.Event()
+
+        def renew():
+            while not stop.wait(self.lease / 3):
+                self.renew(units)
+
+        thread = threading.Thread(target=renew, name="lease-renewal", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def complete(self, date: str, code: str, result: dict, promote=None) -> bool:
+        """
+        marks the unit done with result (anything json serializable) and releases its lease,
+        promote() is called first to move the output of the attempt into place
+        returns False, leaving the unit alone, once this node lost its lease
+        """
+        if not self.owns(date, code):
+            self.held.pop((date, code), None)
+            return False
+        if promote is not None:
+            promote()
+        result = {'node': self.node, 'attempt': self.attempt(date, code), 'time': time.time(), **result}
+        _write(self._path("done", f"{_unit(date, code)}.json"), json.dumps(result))
+        self._release(date, code)
+        return True
+
+    def fail(self, date: str, code: str, error: str) -> None:
+        """
+        records a failed attempt of the unit and releases its lease, the unit is retried unless it ran out of attempts
+        """
+        if self.owns(date, code):
+            self._record_failure(date, code, error)
+        self._release(date, code)
+
+    def _record_failure(self, date: str, code: str, error: str) -> None:
+        os.makedirs(self._path("failed", _unit(date, code)), exist_ok=True)
+        n = self.attempts(date, code)
+        _write(self._path("failed", _unit(date, code), f"{self.node}.{n}"), error)
+
+    def _release(self, date: str, code: str) -> None:
+        # only the lease this node acquired, not the one of a node that took the unit over
+        if self.owns(date, code):
+            try:
+                os.remove(self._path("leases", _unit(date, code)))
+            except FileNotFoundError:
+                pass
+        self.held.pop((date, code), None)
+
+    def merged(self) -> dict:
+        """
+        {code: last date} stitched into the output of every instrument by merges so far
+        """
+        try:
+            with open(self._path("merged.json")) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def record_merged(self, code: str, date: str) -> None:
+        merged = self.merged()
+        merged[code] = date
+        _write(self._path("merged.json"), json.dumps(merged))
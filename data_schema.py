@@ -61,4 +61,53 @@ L1_SCHEMA = {
     'TCC_CorrectedTrade_ImpactIndicator': pl.Utf8,
     'TCC_CorrectedTrade_MarketTimestamp': pl.Utf8,
     'TCC_CorrectedTrade_TradeId': pl.Utf8,
-}
\ No newline at end of file
+}
+# compact message format the replay works on, produced once at load time by stream.encode_l2 / stream.encode_l1:
+# only the columns the replay reads, integer codes instead of strings and timestamps in microseconds since epoch,
+# Code is a pl.Enum of the universe, the OverlapRefresh limits are flat [price, qty, ...] lists
+L2_MESSAGE_SCHEMA = {
+    "Timestamp": pl.Datetime("us"),
+    "LayerId": pl.Int8,
+    "DeltaRefresh_DeltaAction": pl.UInt8,
+    "DeltaRefresh_Level": pl.Int16,
+    "DeltaRefresh_Price": pl.Float32,
+    "DeltaRefresh_CumulatedUnits": pl.Float32,
+    "OverlapRefresh_BidChangeIndicator": pl.Int8,
+    "OverlapRefresh_AskChangeIndicator": pl.Int8,
+    "OverlapRefresh_BidLimits": pl.List(pl.Float64),
+    "OverlapRefresh_AskLimits": pl.List(pl.Float64),
+    "MaxVisibleDepth_MaxVisibleDepth": pl.Int16,
+}
+
+L1_MESSAGE_SCHEMA = {
+    "Timestamp": pl.Datetime("us"),
+    "ServerTimestamp": pl.Int64,
+    "TradeEvent_LastPrice": pl.Float32,
+    "TradeEvent_LastTradeQuantity": pl.Float32,
+    "TradeEvent_Context_AggressorSide": pl.UInt8, # 1 buyer initiated, 2 seller initiated
+}
+
+# columns of the csv.gz files the message format is built from, the others are not read
+L2_SOURCE_COLUMNS = [
+    "Code",
+    "LayerId",
+    "DeltaRefresh_ServerTimestamp",
+    "DeltaRefresh_DeltaAction",
+    "DeltaRefresh_Level",
+    "DeltaRefresh_Price",
+    "DeltaRefresh_CumulatedUnits",
+    "OverlapRefresh_ServerTimestamp",
+    "OverlapRefresh_BidChangeIndicator",
+    "OverlapRefresh_AskChangeIndicator",
+    "OverlapRefresh_BidLimits",
+    "OverlapRefresh_AskLimits",
+    "MaxVisibleDepth_MaxVisibleDepth",
+]
+
+L1_SOURCE_COLUMNS = [
+    "Code",
+    "ServerTimestamp",
+    "TradeEvent_LastPrice",
+    "TradeEvent_LastTradeQuantity",
+    "TradeEvent_Context_AggressorSide",
+]
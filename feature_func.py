@@ -1,4 +1,166 @@
-import numpy as np 
+import copy
+import numpy as np
+import polars as pl
+from rolling import OPERATORS
+from columns import column_spec
 
+# per tick features, called in the replay loop as f(data=data, prev_data=prev_data, vwap=vwap)
 all_features = []
 all_feature_funcs = []
+
+
+def snapshot_columns(layers: int = 6, levels: int = 10, trade_stats: bool = False, spec=None) -> list:
+    """
+    columns of data as the per tick features see it: the books layer by layer, then ohlcva (and the trade stats)
+    the books are the ones of spec (see columns.column_spec) if given, otherwise every field of levels levels of layers
+    """
+    if spec is None:
+        spec = {'layers': range(layers), 'depth': levels}
+    orderbooks = column_spec(spec).columns()
+    trades = ['open', 'high', 'low', 'close', 'volume', 'amount']
+    if trade_stats:
+        trades += ['trade_count', 'signed_volume', 'last_trade_age']
+    return orderbooks + trades
+
+
+class OnlineFeature:
+
+    """
+    per tick feature kept by one of the online operators of rolling.py
+    inputs are columns of snapshot_columns, fed to op.update in order every tick, the per tick features are all
+    computed off the same row, before any of them is added to it, so they cannot be inputs
+    the operator holds per instrument state, see bind_features
+    """
+
+    def __init__(self, op, inputs: list) -> None:
+        self.op = op
+        self.inputs = inputs
+        self.index = None # positions of inputs in the rows, see bind
+
+    def bind(self, columns: list) -> None:
+        features = [col for col in self.inputs if col in all_features]
+        assert features == [], f"online feature inputs {features} are per tick features, not snapshot columns"
+        missing = [col for col in self.inputs if col not in columns]
+        assert missing == [], f"online feature inputs {missing} are not snapshot columns"
+        self.index = [columns.index(col) for col in self.inputs]
+
+    def __call__(self, data, prev_data=None, vwap=None):
+        return self.op.update(*(data[i] for i in self.index))
+
+
+def online_feature(name: str, op: str, inputs, **params) -> None:
+    """
+    registers a per tick feature kept by an online operator, e.g.
+    online_feature('mid_ewma', 'ewma', 'layer_0_bid_price_0', halflife=600)
+    online_feature('ofi_60', 'ofi', ['layer_0_bid_price_0', 'layer_0_bid_qty_0',
+                                     'layer_0_ask_price_0', 'layer_0_ask_qty_0'], window=60)
+    """
+    assert op in OPERATORS, f"unknown online operator {op}, expected one of {list(OPERATORS)}"
+    inputs = [inputs] if isinstance(inputs, str) else list(inputs)
+    features = [col for col in inputs if col in all_features]
+    assert features == [], f"online feature inputs {features} are per tick features, not snapshot columns"
+    all_features.append(name)
+    all_feature_funcs.append(OnlineFeature(OPERATORS[op](**params), inputs))
+
+
+def bind_features(columns: list = None) -> list:
+    """
+    the per tick features of one instrument, online features get their own operator state
+    and read their inputs off rows laid out as columns, snapshot_columns() if None
+    """
+    if columns is None:
+        columns = snapshot_columns()
+    features = []
+    for f in all_feature_funcs:
+        if isinstance(f, OnlineFeature):
+            f = copy.deepcopy(f)
+            f.bind(columns)
+        features.append(f)
+    return features
+
+
+# vectorized features, computed over blocks of ticks once they are replayed, see VectorFeature
+vector_features = []
+
+
+class VectorFeature:
+
+    """
+    feature computed over many ticks at once from the columns of the replayed rows
+    (layer_{l}_bid_price_{i} ..., open ... amount and the per tick features)
+
+    either a kernel, called with the arrays of deps in order and returning one value per tick,
+    or a polars expression over those columns, whose deps are read off the expression
+    lookback is the number of previous ticks a value depends on, they are kept across blocks (and days)
+    """
+
+    def __init__(self, name: str, func=None, expr: pl.Expr = None, deps: list = None, lookback: int = 0) -> None:
+        assert (func is None) != (expr is None), "a vector feature is either a kernel or a polars expression"
+        self.name = name
+        self.func = func
+        self.expr = expr
+        self.deps = list(deps) if deps is not None else expr.meta.root_names()
+        self.lookback = lookback
+
+    def compute(self, frame: pl.DataFrame) -> np.ndarray:
+        if self.expr is not None:
+            return frame.select(self.expr).to_series().to_numpy()
+        return np.asarray(self.func(*(frame[col].to_numpy() for col in self.deps)), dtype=np.float64)
+
+    def __repr__(self) -> str:
+        return f"VectorFeature({self.name}, deps={self.deps}, lookback={self.lookback})"
+
+
+def tick_feature(name: str):
+    """
+    registers a per tick feature
+    """
+    def register(func):
+        all_features.append(name)
+        all_feature_funcs.append(func)
+        return func
+    return register
+
+
+def vector_feature(name: str, deps: list, lookback: int = 0):
+    """
+    registers a vectorized kernel, e.g.
+
+    @vector_feature('spread', deps=['layer_0_ask_price_0', 'layer_0_bid_price_0'])
+    def spread(ask, bid):
+        return ask - bid
+    """
+    def register(func):
+        vector_features.append(VectorFeature(name, func=func, deps=deps, lookback=lookback))
+        return func
+    return register
+
+
+def expr_feature(name: str, expr: pl.Expr, lookback: int = 0) -> None:
+    """
+    registers a polars expression, e.g. expr_feature('volume_60', pl.col('volume').rolling_sum(60), lookback=59)
+    """
+    vector_features.append(VectorFeature(name, expr=expr.alias(name), lookback=lookback))
+
+
+# panel features, computed every tick over the instruments of a panel group, see panel.py
+panel_features = []
+panel_feature_funcs = []
+
+
+def panel_feature(name: str):
+    """
+    registers a feature of the instruments of a panel, called every tick as
+    f(data={code: row}, prev_data={code: row} or None, books={code: {layer: book}}) with the members in group order,
+    rows laid out like those of the per tick features, e.g. the spread between the first two members
+
+    @panel_feature('calendar_spread')
+    def calendar_spread(data, prev_data=None, books=None):
+        front, back = list(books.values())[:2]
+        return back[0].top()[0] - front[0].top()[0]
+    """
+    def register(func):
+        panel_features.append(name)
+        panel_feature_funcs.append(func)
+        return func
+    return register
@@ -1,11 +1,11 @@
 import numpy as np
 import polars as pl
-import orjson as json
 
 from trades import TradesHandler
-from orderbook import LocalOrderBook
-from feature_func import all_feature_funcs
-from check_ob import check_ob
+from orderbook import LocalOrderBook, ArrayOrderBook
+from columns import ColumnSpec, column_spec
+from check_ob import check_ob, BookValidator, save_validation
+from profiling import StageClock, bucket_messages, save_replay_profile
 
 def compute_day(
         l2: pl.DataFrame,
@@ -14,72 +14,183 @@ def compute_day(
         l1_col_mapping: dict, 
         ob_handler: LocalOrderBook, 
         trade_handler: TradesHandler, 
-        dest: str,
-        buffer_size: int = 2**20,
-        last = None
+        dest,
+        last = None,
+        warmup: bool = False,
+        validation: dict = None,
+        profile: str = None,
+        columns: ColumnSpec = None,
     ) -> tuple:    
-    dest = open(dest, 'a', buffering=buffer_size) 
+    # with warmup the books are assumed to be empty, messages of a layer are ignored
+    # until its first full OverlapRefresh, MaxVisibleDepth messages still apply
+    # l1 None means l2 is an iterable of consecutive (l2, l1) windows of the day, see stream.DayStream
+    # validation are the check_ob.BookValidator params, the accuracy is the one of the first layer of columns
+    # with profile, the time spent replaying, computing features and writing goes to {profile}/{code}.{date}.json
+    # columns is the columns.ColumnSpec of the books written, ob_handler holds the books of its layers
+    chunks = [(l2, l1)] if l1 is not None else l2
+    columns = column_spec(columns)
+    snapshot = columns.snapshot
+    dest.open() # one of the sinks in sinks.py
     # replay loop
     prev_data = last
-    overlaprefresh_check_results = []
-    for (l2_updates, trades) in zip(l2.iter_rows(named = True), l1.iter_rows(named = True)):
-        # assure time is uniform
-        timestamp = l2_updates.pop('Timestamp')
-        assert timestamp == trades.pop('Timestamp')
-        
-        # process l2 updates
-        if l2_updates['Code'] is not None:
-            for row in zip(*l2_updates.values()):
-                layer = row[l2_col_mapping['LayerId']]
-                if layer is None:
-                    continue
-                res, bid_limits, ask_limits = handle_l2_update(row, l2_col_mapping, ob_handler[layer], timestamp)
-                # log correctness check results
-                if res is not None and layer == "0":
-                    overlaprefresh_check_results.append((res, timestamp, layer, bid_limits, ask_limits, ob_handler[layer].take_snapshot()))
-        
-        # process trades 
-        if trades['Code'] is not None:
-            for row in zip(*trades.values()):
-                handle_trades(row, l1_col_mapping, trade_handler)
-        
-        # record the features
-        data = [col for ob_container in ob_handler.values() for col in ob_container.take_snapshot()]
-        data += trade_handler.get_ohlcva()
-        data += [f(
-                    data=data, 
-                    prev_data=prev_data, 
-                    vwap=trade_handler.vwap
-                ) for f in all_feature_funcs]
-        dest.write(f"{str(data)[1:-1]}, {timestamp}\n")
-        prev_data = data
+    validator = BookValidator(**(validation or {}))
+    synced = set() if warmup else None
+    clock = StageClock() if profile is not None else None
+    rows, messages = 0, 0
+    for l2, l1 in chunks:
+        if clock is not None:
+            rows += l2.height
+            messages += bucket_messages(l2, l1)
+        for (l2_updates, trades) in zip(l2.iter_rows(named = True), l1.iter_rows(named = True)):
+            # assure time is uniform
+            timestamp = l2_updates.pop('Timestamp')
+            assert timestamp == trades.pop('Timestamp')
+            replay_bucket(l2_updates, trades, l2_col_mapping, ob_handler, trade_handler, timestamp, validator, synced)
+            if clock is not None:
+                clock.lap('replay')
+
+            # record the features
+            data = tick_row(snapshot, ob_handler, trade_handler, timestamp, prev_data)
+            if clock is not None:
+                clock.lap('features')
+            dest.write(data, timestamp)
+            prev_data = data
+            if clock is not None:
+                clock.lap('write')
 
     dest.close()
-    if len(overlaprefresh_check_results) == 0:
-        accuracy = np.nan
-    else:
-        r = []
-        for res, timestamp, layer, bid_limits, ask_limits, snapshot in overlaprefresh_check_results:
-            # print(f"OverlapRefresh check failed at {timestamp} in layer {layer}")
-            # print(f"bid_limits {bid_limits} and ask_limits {ask_limits}")
-            # print(f"Snapshot: {snapshot}")
-            r.append(res)
-        accuracy = np.sum(r) / len(r)
-        
-    return data, accuracy
+    save_validation(validator, dest)
+    if clock is not None:
+        clock.lap('write')
+        save_replay_profile(profile, dest, clock, rows, messages)
+    return prev_data, validator.accuracy(columns.layers[0])
+
+def replay_bucket(l2_updates, trades, l2_col_mapping, ob_handler, trade_handler, timestamp, validator, synced) -> None:
+    # the l2 messages and trades of one bucket (named rows of the bucketed frames, without the timestamp)
+    # synced holds the layers done warming up, None without warmup
+    if l2_updates['Code'] is not None:
+        for row in zip(*l2_updates.values()):
+            layer = row[l2_col_mapping['LayerId']]
+            if layer is None:
+                continue
+            if synced is not None and layer not in synced:
+                if is_full_OverlapRefresh(row[l2_col_mapping['OverlapRefresh_BidChangeIndicator']],
+                                          row[l2_col_mapping['OverlapRefresh_AskChangeIndicator']]):
+                    synced.add(layer)
+                elif row[l2_col_mapping['OverlapRefresh_BidChangeIndicator']] is not None or\
+                     row[l2_col_mapping['OverlapRefresh_AskChangeIndicator']] is not None or\
+                     row[l2_col_mapping['DeltaRefresh_DeltaAction']] is not None:
+                    continue
+            handle_l2_update(row, l2_col_mapping, ob_handler[layer], timestamp, validator, layer)
+
+    # process trades
+    if trades['Code'] is not None:
+        handle_trades_bucket(trades, trade_handler)
+
+def tick_row(snapshot, ob_handler, trade_handler, timestamp, prev_data) -> list:
+    # the row of one tick: the book columns (snapshot of columns.ColumnSpec), ohlcva, trade stats and per tick features
+    data = snapshot(ob_handler)
+    data += trade_handler.get_ohlcva()
+    if trade_handler.stats:
+        data += trade_handler.get_stats(timestamp)
+    data += [f(
+                data=data,
+                prev_data=prev_data,
+                vwap=trade_handler.vwap
+            ) for f in trade_handler.feature_funcs]
+    return data
+
+def iter_day_events(
+        l2: pl.DataFrame,
+        l1: pl.DataFrame,
+        columns: list,
+        ob_handler: dict,
+        changes_only: bool = False,
+        levels: int = 10,
+    ):
+    """
+    replays one instrument's messages of a day one at a time, without bucketing, l2 and l1 merged in time order
+    (l2 first at equal timestamps, as in compute_day) and yields (timestamp, ob_handler, trade) after each of them
+    timestamp is in microseconds since epoch, trade is (price, qty, aggressor side 1 or 2) for trades and None for l2
+    ob_handler is the live {layer: book} the handlers update in place, copy what has to outlive the step
+    with changes_only, l2 messages are only yielded when they changed the first levels of their layer's book,
+    levels past the visible depth count as nan, so a change of depth within the first levels is a change
+    """
+    l2_col_mapping = {col: i for i, col in enumerate(columns)}
+    layer_index = l2_col_mapping['LayerId']
+    # DeltaRefresh messages past the first levels only shift deeper levels, they are skipped without comparing
+    bid_refresh_index = l2_col_mapping['OverlapRefresh_BidChangeIndicator']
+    ask_refresh_index = l2_col_mapping['OverlapRefresh_AskChangeIndicator']
+    action_index = l2_col_mapping['DeltaRefresh_DeltaAction']
+    level_index = l2_col_mapping['DeltaRefresh_Level']
+    l2_times = l2['Timestamp'].dt.epoch('us').to_list()
+    l2_rows = l2.select(columns).rows()
+    l1 = l1.filter(pl.col('TradeEvent_LastPrice').is_not_null())
+    l1_times = l1['Timestamp'].dt.epoch('us').to_list()
+    trades = list(zip(
+        l1['TradeEvent_LastPrice'].to_list(),
+        l1['TradeEvent_LastTradeQuantity'].to_list(),
+        l1['TradeEvent_Context_AggressorSide'].to_list(),
+    ))
+    j, n = 0, len(l1_times)
+    for timestamp, row in zip(l2_times, l2_rows):
+        while j < n and l1_times[j] < timestamp:
+            yield l1_times[j], ob_handler, trades[j]
+            j += 1
+        layer = row[layer_index]
+        if layer is None: # blank rows keeping the day uniform
+            continue
+        ob = ob_handler[layer]
+        if changes_only:
+            if row[action_index] is not None and row[level_index] >= levels and\
+               row[bid_refresh_index] is None and row[ask_refresh_index] is None:
+                handle_l2_update(row, l2_col_mapping, ob, timestamp)
+                continue
+            before = _first_levels(ob, levels)
+            handle_l2_update(row, l2_col_mapping, ob, timestamp)
+            after = _first_levels(ob, levels)
+            if after == before or all(a == b or (a != a and b != b) for a, b in zip(after, before)):
+                continue
+        else:
+            handle_l2_update(row, l2_col_mapping, ob, timestamp)
+        yield timestamp, ob_handler, None
+    while j < n:
+        yield l1_times[j], ob_handler, trades[j]
+        j += 1
+
+def _first_levels(ob, levels) -> list:
+    # the first levels levels of every side, nan padded past the visible depth so books of any depth compare
+    if isinstance(ob, ArrayOrderBook) and ob.book.shape[1] >= levels:
+        return ob.book[:, :levels].ravel().tolist() # slots past the visible depth are nan already
+    if len(ob.bid_prices) >= levels:
+        return ob.take_snapshot(levels)
+    pad = [np.nan] * levels
+    snapshot = []
+    for side in (ob.bid_prices, ob.bid_volumes, ob.ask_prices, ob.ask_volumes):
+        snapshot += list(side[:levels])
+        snapshot += pad[len(side):]
+    return snapshot
 
 def handle_trades(row, l1_col_mapping, trades_handler) -> None: # message handler wrapper
     price = row[l1_col_mapping['TradeEvent_LastPrice']]
     qty = row[l1_col_mapping['TradeEvent_LastTradeQuantity']]
     trades_handler.handle_trades(price, qty)
 
-def handle_l2_update(row, l2_col_mapping, ob_handler, timestamp) -> None: # message handler wrapper
+def handle_trades_bucket(trades, trades_handler) -> None: # all trades of one bucketed l1 row
+    trades_handler.handle_trades_array(
+        trades['TradeEvent_LastPrice'],
+        trades['TradeEvent_LastTradeQuantity'],
+        trades['TradeEvent_Context_AggressorSide'],
+        trades['ServerTimestamp'],
+    )
+
+def handle_l2_update(row, l2_col_mapping, ob_handler, timestamp, validator=None, layer=0) -> None: # message handler wrapper
     res = None # place holder for overlap refresh reference check result
     # 1.4.4.8   OverlapRefresh
     bid_limits, ask_limits = None, None
     if row[l2_col_mapping['OverlapRefresh_BidChangeIndicator']] is not None or\
        row[l2_col_mapping['OverlapRefresh_AskChangeIndicator']] is not None:
-        res, bid_limits, ask_limits = handle_OverlapRefresh(row, ob_handler, l2_col_mapping, timestamp)
+        res, bid_limits, ask_limits = handle_OverlapRefresh(row, ob_handler, l2_col_mapping, timestamp, validator, layer)
     # 1.4.2     DeltaRefresh
     elif row[l2_col_mapping['DeltaRefresh_DeltaAction']] is not None:
         handle_DeltaRefresh(row, ob_handler, l2_col_mapping)
@@ -90,7 +201,7 @@ def handle_l2_update(row, l2_col_mapping, ob_handler, timestamp) -> None: # mess
 
 def handle_MBLMaxVisibleDepth(row, ob, l2_col_mapping):
     depth = row[l2_col_mapping['MaxVisibleDepth_MaxVisibleDepth']]
-    ob.MaxVisibleDepth(int(depth))
+    ob.MaxVisibleDepth(depth)
 
 def handle_OverlapRefresh_indicator(indicator):
     # decode start level 1.4.1.3
@@ -102,7 +213,12 @@ def handle_OverlapRefresh_indicator(indicator):
         start_level = indicator
     return is_full, int(start_level)
 
-def handle_OverlapRefresh(row, ob, l2_col_mapping, timestamp):
+def is_full_OverlapRefresh(bid_indicator, ask_indicator):
+    # both sides are sent in full, so the book can be rebuilt from this message alone
+    return bid_indicator is not None and ask_indicator is not None and\
+           handle_OverlapRefresh_indicator(bid_indicator)[0] and handle_OverlapRefresh_indicator(ask_indicator)[0]
+
+def handle_OverlapRefresh(row, ob, l2_col_mapping, timestamp, validator=None, layer=0):
     # process a partial or full order book snapshot
     bid_indicator = row[l2_col_mapping['OverlapRefresh_BidChangeIndicator']]
     ask_indicator = row[l2_col_mapping['OverlapRefresh_AskChangeIndicator']]
@@ -111,28 +227,28 @@ def handle_OverlapRefresh(row, ob, l2_col_mapping, timestamp):
     bid_limits = row[l2_col_mapping['OverlapRefresh_BidLimits']]
     ask_limits = row[l2_col_mapping['OverlapRefresh_AskLimits']]
     
+    # limits come pre-parsed as flat [price, qty, price, qty, ...] lists, see stream.parse_limits
     if bid_limits is not None: # load bid limits (snapshot)
         if ob.bid_prices[0] is None:
             bid_start_level = 0
-        bid_limits = json.loads(f"[{bid_limits}]".replace('][', '],['))
-        for i in range(len(bid_limits)):
-            ob.BidOverwriteLevel(bid_limits[i][0], bid_limits[i][1], bid_start_level+i)
+        ob.BidOverwriteLevels(bid_limits[0::2], bid_limits[1::2], bid_start_level)
         if bid_is_full:
-            ob.BidClearFromLevel(i + 1)
+            ob.BidClearFromLevel(len(bid_limits) // 2)
     if ask_limits is not None: # load ask limits (snapshot)
         if ob.ask_prices[0] is None:
             ask_start_level = 0
         if ask_is_full:
             ob.AskClearFromLevel(0)
-        ask_limits = json.loads(f"[{ask_limits}]".replace('][', '],['))
-        for i in range(len(ask_limits)):
-            ob.AskOverwriteLevel(ask_limits[i][0], ask_limits[i][1], ask_start_level+i)
+        ob.AskOverwriteLevels(ask_limits[0::2], ask_limits[1::2], ask_start_level)
         if ask_is_full:
-            ob.AskClearFromLevel(i + 1)
+            ob.AskClearFromLevel(len(ask_limits) // 2)
             
-    # this is a full snapshot, check for local ob accuracy
+    # this is a full snapshot, check for local ob accuracy (None when the validator skips it)
     if (bid_is_full and ask_is_full) and (bid_limits and ask_limits): 
-        res = check_ob(ob, bid_limits, ask_limits, timestamp)
+        if validator is None:
+            res = check_ob(ob, bid_limits, ask_limits, timestamp)
+        else:
+            res = validator.check(ob, bid_limits, ask_limits, timestamp, layer)
     else:
         res = None
     return res, bid_limits, ask_limits
@@ -140,28 +256,28 @@ def handle_OverlapRefresh(row, ob, l2_col_mapping, timestamp):
 def handle_DeltaRefresh(row, ob, l2_col_mapping):
     # process a delta update
     action = row[l2_col_mapping['DeltaRefresh_DeltaAction']]
-    level = int(row[l2_col_mapping['DeltaRefresh_Level']])
+    level = row[l2_col_mapping['DeltaRefresh_Level']]
     price = row[l2_col_mapping['DeltaRefresh_Price']]
     qty = row[l2_col_mapping['DeltaRefresh_CumulatedUnits']]
-    if action == "0.0":     # 1.4.2 0 - ALLClearFromLevel
+    if action == 0:     # 1.4.2 0 - ALLClearFromLevel
         ob.ALLClearFromLevel(level)
-    elif action == "1.0":   # 1.4.2 1 - BidClearFromLevel
+    elif action == 1:   # 1.4.2 1 - BidClearFromLevel
         ob.BidClearFromLevel(level)
-    elif action == "2.0":   # 1.4.2 2 - AskClearFromLevel
+    elif action == 2:   # 1.4.2 2 - AskClearFromLevel
         ob.AskClearFromLevel(level)
-    elif action == "3.0":   # 1.4.2 3 - BidInsertAtLevel
+    elif action == 3:   # 1.4.2 3 - BidInsertAtLevel
         ob.BidInsertAtLevel(level, price, qty)
-    elif action == "4.0":   # 1.4.2 4 - AskInsertAtLevel
+    elif action == 4:   # 1.4.2 4 - AskInsertAtLevel
         ob.AskInsertAtLevel(level, price, qty)
-    elif action == "5.0":   # 1.4.2 5 - BidRemoveLevel
+    elif action == 5:   # 1.4.2 5 - BidRemoveLevel
         ob.BidRemoveLevel(level)
-    elif action == "6.0":   # 1.4.2 6 - AskRemoveLevel
+    elif action == 6:   # 1.4.2 6 - AskRemoveLevel
         ob.AskRemoveLevel(level)
-    elif action == "7.0":   # 1.4.2 7 - BidChangeQtyAtLevel
+    elif action == 7:   # 1.4.2 7 - BidChangeQtyAtLevel
         ob.BidChangeQtyAtLevel(level, qty)
-    elif action == "8.0":   # 1.4.2 8 - AskChangeQtyAtLevel
+    elif action == 8:   # 1.4.2 8 - AskChangeQtyAtLevel
         ob.AskChangeQtyAtLevel(level, qty)
-    elif action == "9.0":   # 1.4.2 9 - BidRemoveLevelAndAppend
+    elif action == 9:   # 1.4.2 9 - BidRemoveLevelAndAppend
         ob.BidRemoveLevelAndAppend(level, price, qty)
-    elif action == "10.0":  # 1.4.2 10 - AskRemoveLevelAndAppend
+    elif action == 10:  # 1.4.2 10 - AskRemoveLevelAndAppend
         ob.AskRemoveLevelAndAppend(level, price, qty)
@@ -0,0 +1,405 @@
+"""
+live replay of intraday l2/l1 feeds with the handlers of the day replay, and a feed simulator to test it
+
+feeds are csv lines laid out like the csv.gz files (L2_SCHEMA / L1_SCHEMA column order, header lines are skipped):
+an l2 feed with the messages of every layer and instrument and an l1 feed with the trades, each opened by open_feed
+from a tcp socket ("host:port") or a pipe (a path, e.g. a fifo or a file)
+"""
+import os
+import re
+import csv
+import time
+import asyncio
+import datetime
+import pgzip
+import numpy as np
+from data_schema import L2_SCHEMA, L1_SCHEMA
+from orderbook import LocalOrderBook
+from trades import TradesHandler, EPOCH
+from handlers import handle_l2_update
+from feature_func import all_features, vector_features, snapshot_columns
+from columns import ColumnSpec, column_spec
+from sinks import make_sink
+
+L2_COLUMNS = {col: i for i, col in enumerate(L2_SCHEMA)}
+L1_COLUMNS = {col: i for i, col in enumerate(L1_SCHEMA)}
+# a live l2 message is handed to handle_l2_update as a row of these columns, like a row of the replay frames
+LIVE_L2_COLUMNS = [
+    'LayerId',
+    'OverlapRefresh_BidChangeIndicator',
+    'OverlapRefresh_AskChangeIndicator',
+    'OverlapRefresh_BidLimits',
+    'OverlapRefresh_AskLimits',
+    'MaxVisibleDepth_MaxVisibleDepth',
+    'DeltaRefresh_DeltaAction',
+    'DeltaRefresh_CumulatedUnits',
+    'DeltaRefresh_Level',
+    'DeltaRefresh_Price',
+]
+LIMIT = re.compile(r"[^\[\],]+")
+
+
+def _f32(value: str):
+    # Float32 columns of the schemas, rounded like the csv reader of the day replay does
+    return float(np.float32(value)) if value else None
+
+
+def _int(value: str):
+    # integer codes of the message format, written as floats in the csv files, e.g. the DeltaAction "3.0"
+    return int(float(value)) if value else None
+
+
+def _limits(value: str, overlap: bool):
+    # "[price,qty][price,qty]..." as a flat [price, qty, ...] list, see stream.parse_limits,
+    # empty for an empty side of an OverlapRefresh, None for the other messages
+    return [float(x) for x in LIMIT.findall(value)] if value or overlap else None
+
+
+def _fields(line: str) -> list:
+    # only the OverlapRefresh limits are quoted
+    return next(csv.reader([line])) if '"' in line else line.split(',')
+
+
+def parse_l2_line(line: str) -> tuple:
+    """
+    (code, server timestamp in microseconds or None, row of LIVE_L2_COLUMNS) of an l2 csv line
+    """
+    f = _fields(line.rstrip('\r\n'))
+    timestamp = f[L2_COLUMNS['DeltaRefresh_ServerTimestamp']] or f[L2_COLUMNS['OverlapRefresh_ServerTimestamp']]
+    overlap = f[L2_COLUMNS['OverlapRefresh_ServerTimestamp']] != ''
+    row = (
+        _int(f[L2_COLUMNS['LayerId']]),
+        _int(f[L2_COLUMNS['OverlapRefresh_BidChangeIndicator']]),
+        _int(f[L2_COLUMNS['OverlapRefresh_AskChangeIndicator']]),
+        _limits(f[L2_COLUMNS['OverlapRefresh_BidLimits']], overlap),
+        _limits(f[L2_COLUMNS['OverlapRefresh_AskLimits']], overlap),
+        _int(f[L2_COLUMNS['MaxVisibleDepth_MaxVisibleDepth']]),
+        _int(f[L2_COLUMNS['DeltaRefresh_DeltaAction']]),
+        _f32(f[L2_COLUMNS['DeltaRefresh_CumulatedUnits']]),
+        _int(f[L2_COLUMNS['DeltaRefresh_Level']]),
+        _f32(f[L2_COLUMNS['DeltaRefresh_Price']]),
+    )
+    return f[L2_COLUMNS['Code']], int(timestamp.split('.')[0]) if timestamp else None, row
+
+
+def parse_l1_line(line: str) -> tuple:
+    """
+    (code, server timestamp in microseconds, price, qty, aggressor side) of an l1 csv line
+    """
+    f = line.rstrip('\r\n').split(',')
+    timestamp = f[L1_COLUMNS['ServerTimestamp']]
+    return (
+        f[L1_COLUMNS['Code']],
+        int(timestamp) if timestamp else None,
+        _f32(f[L1_COLUMNS['TradeEvent_LastPrice']]),
+        _f32(f[L1_COLUMNS['TradeEvent_LastTradeQuantity']]),
+        _int(f[L1_COLUMNS['TradeEvent_Context_AggressorSide']]),
+    )
+
+
+class WallClock:
+
+    """
+    microseconds since epoch of the wall clock
+    """
+
+    def now(self) -> int:
+        return time.time_ns() // 1000
+
+    async def sleep_until(self, timestamp: int) -> None:
+        await asyncio.sleep(max(timestamp - self.now(), 0) / 1e6)
+
+
+class SimulatedClock(WallClock):
+
+    """
+    feed time of a simulated replay: start when created, running speed times faster than the wall clock
+    """
+
+    def __init__(self, start: int, speed: float = 1.0) -> None:
+        self.start = start
+        self.speed = speed
+        self.origin = super().now()
+
+    def now(self) -> int:
+        return self.start + int((super().now() - self.origin) * self.speed)
+
+    async def sleep_until(self, timestamp: int) -> None:
+        await asyncio.sleep(max(timestamp - self.now(), 0) / self.speed / 1e6)
+
+
+class LiveReplayer:
+
+    """
+    keeps the books and trades of the universe up to date as the messages of the feeds arrive
+    and writes a row per instrument every frequency of clock time, laid out like the rows of compute_day,
+    to the same sinks as the day replay
+
+    Params:
+    -------
+    dest:           str, directory of the outputs
+    universe:       list, string codes of the instruments, messages of other instruments are ignored
+    frequency:      timedelta, interval of the snapshots, on boundaries of the clock
+    orderbook:      type, LocalOrderBook or ArrayOrderBook
+    output:         str, 'csv', 'parquet' or 'ipc', see sinks.make_sink
+    trade_stats:    bool, add trade_count, signed_volume and last_trade_age after the ohlcva columns
+    clock:          WallClock, or the SimulatedClock of a FeedSimulator
+    latency_window: int, latencies of the last latency_window messages are kept for latency_percentiles
+    columns:        ColumnSpec or a dict of its params, the book columns (see columns.py), messages of layers
+                    without a book are ignored
+    """
+
+    def __init__(
+            self,
+            dest: str,
+            universe: list,
+            frequency: datetime.timedelta = datetime.timedelta(seconds=1),
+            orderbook: type = LocalOrderBook,
+            output: str = 'csv',
+            trade_stats: bool = False,
+            buffer_size: int = 2**20,
+            batch_rows: int = 2**16,
+            clock: WallClock = None,
+            latency_window: int = 2**16,
+            columns: ColumnSpec | dict = None,
+        ) -> None:
+        os.makedirs(dest, exist_ok=True)
+        self.universe = set(universe)
+        self.frequency = frequency
+        self.clock = clock if clock is not None else WallClock()
+        self.columns = column_spec(columns)
+        self.books = {code: self.columns.books(code, orderbook) for code in universe}
+        features = snapshot_columns(trade_stats=trade_stats, spec=self.columns) + all_features
+        self.trade_handlers = {code: TradesHandler(code, frequency, trade_stats, features) for code in universe}
+        self.sinks = {
+            code: make_sink(output, dest, code, features, buffer_size, batch_rows, vector_features)
+            for code in universe
+        }
+        self.prev_data = {code: None for code in universe}
+        self.l2_col_mapping = {col: i for i, col in enumerate(LIVE_L2_COLUMNS)}
+        self.date = None
+        self.last_timestamp = None # server timestamp of the last message, for the ones without
+        self.latencies = np.zeros(latency_window, dtype=np.int64) # ns from reading a line to the books updated
+        self.lags = np.zeros(latency_window, dtype=np.int64) # us from the server timestamp to the books updated
+        self.messages = 0
+        self.checks = 0 # full OverlapRefresh checks of layer 0
+        self.consistent = 0 # those the book matched
+
+    def handle_l2(self, line: str) -> None:
+        code, timestamp, row = parse_l2_line(line)
+        if code not in self.universe or row[0] is None:
+            return
+        timestamp = timestamp if timestamp is not None else self.last_timestamp
+        self.last_timestamp = timestamp
+        if row[0] not in self.books[code]: # a layer outside of the columns
+            return
+        res, _, _ = handle_l2_update(row, self.l2_col_mapping, self.books[code][row[0]], timestamp)
+        if res is not None and row[0] == 0:
+            self.checks += 1
+            self.consistent += res
+
+    def handle_l1(self, line: str) -> None:
+        code, timestamp, price, qty, side = parse_l1_line(line)
+        if code not in self.universe:
+            return
+        self.last_timestamp = timestamp if timestamp is not None else self.last_timestamp
+        self.trade_handlers[code].handle_trades(price, qty, side, timestamp)
+
+    def snapshot(self, timestamp: datetime.datetime) -> None:
+        """
+        writes the row of every instrument for the interval ending at timestamp
+        """
+        date = timestamp.strftime("%Y-%m-%d")
+        if date != self.date:
+            self._open_sinks(date)
+        for code, sink in self.sinks.items():
+            trade_handler = self.trade_handlers[code]
+            data = self.columns.snapshot(self.books[code])
+            data += trade_handler.get_ohlcva()
+            if trade_handler.stats:
+                data += trade_handler.get_stats(timestamp)
+            data += [f(
+                        data=data,
+                        prev_data=self.prev_data[code],
+                        vwap=trade_handler.vwap
+                    ) for f in trade_handler.feature_funcs]
+            sink.write(data, timestamp)
+            self.prev_data[code] = data
+
+    def _open_sinks(self, date: str) -> None:
+        for sink in self.sinks.values():
+            if self.date is not None:
+                sink.close()
+            sink.date = date
+            if not os.path.exists(sink.path):
+                sink.write_header()
+            sink.open()
+        self.date = date
+
+    def _record(self, started: int) -> None:
+        i = self.messages % len(self.latencies)
+        self.latencies[i] = time.perf_counter_ns() - started
+        if self.last_timestamp is not None:
+            self.lags[i] = self.clock.now() - self.last_timestamp
+        self.messages += 1
+
+    def latency_percentiles(self, percentiles: tuple = (50, 90, 99, 99.9)) -> dict:
+        """
+        percentiles of the per message latency (reading the line to the books updated)
+        and lag (server timestamp to the books updated, in microseconds of the clock) over the last messages
+        """
+        n = min(self.messages, len(self.latencies))
+        if n == 0:
+            return {}
+        return {
+            'messages': self.messages,
+            'latency_us': dict(zip(percentiles, (np.percentile(self.latencies[:n], percentiles) / 1e3).tolist())),
+            'lag_us': dict(zip(percentiles, np.percentile(self.lags[:n], percentiles).tolist())),
+        }
+
+    async def _consume(self, reader: asyncio.StreamReader, handle) -> None:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            started = time.perf_counter_ns()
+            line = line.decode()
+            if line.startswith('Code,'): # header
+                continue
+            handle(line)
+            self._record(started)
+
+    async def _tick(self) -> None:
+        step = self.frequency // datetime.timedelta(microseconds=1)
+        boundary = (self.clock.now() // step + 1) * step
+        while True:
+            await self.clock.sleep_until(boundary)
+            # a late wake up still writes every boundary it passed, the grid stays uniform
+            while boundary <= self.clock.now():
+                self.snapshot(EPOCH + datetime.timedelta(microseconds=boundary))
+                boundary += step
+
+    async def run(self, l2: asyncio.StreamReader, l1: asyncio.StreamReader) -> None:
+        """
+        consumes both feeds until they end, snapshotting every frequency meanwhile
+        """
+        ticker = asyncio.create_task(self._tick())
+        try:
+            await asyncio.gather(self._consume(l2, self.handle_l2), self._consume(l1, self.handle_l1))
+        finally:
+            ticker.cancel()
+            self.close()
+
+    def close(self) -> None:
+        if self.date is not None:
+            for sink in self.sinks.values():
+                sink.close()
+            self.date = None
+
+
+async def open_feed(address: str) -> tuple:
+    """
+    (reader, connection) of a feed at "host:port" (tcp) or at a path (pipe, fifo or file),
+    the connection has to be kept until the feed is read and closed then
+    """
+    if not os.path.exists(address) and ':' in address:
+        host, port = address.rsplit(':', 1)
+        return await asyncio.open_connection(host, int(port), limit=2**20)
+    reader = asyncio.StreamReader(limit=2**20)
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), open(address, 'rb'))
+    return reader, transport
+
+
+class FeedSimulator:
+
+    """
+    plays a day of l2 and l1 csv.gz files as live feeds, speed times faster than real time, to test LiveReplayer
+    a line is sent once the clock passes its server timestamp, lines without one are sent with the previous line
+    the clock starts at start (microseconds since epoch), by default the first timestamp of the l2 file
+    """
+
+    def __init__(self, l2_path: str, l1_path: str, speed: float = 1.0, start: int = None) -> None:
+        self.l2_path = l2_path
+        self.l1_path = l1_path
+        self.speed = speed
+        self.start = start if start is not None else self._first_timestamp()
+        self.clock = None
+
+    def _first_timestamp(self) -> int:
+        with pgzip.open(self.l2_path, 'rt') as f:
+            f.readline()
+            for line in f:
+                timestamp = self._l2_timestamp(line)
+                if timestamp is not None:
+                    return timestamp
+        raise ValueError(f"no timestamp in {self.l2_path}")
+
+    @staticmethod
+    def _l2_timestamp(line: str):
+        # the server timestamps come before the first quoted field
+        f = line.split(',', L2_COLUMNS['OverlapRefresh_ServerTimestamp'] + 1)
+        timestamp = f[L2_COLUMNS['DeltaRefresh_ServerTimestamp']] or f[L2_COLUMNS['OverlapRefresh_ServerTimestamp']]
+        return int(timestamp.split('.')[0]) if timestamp else None
+
+    @staticmethod
+    def _l1_timestamp(line: str):
+        timestamp = line.split(',', L1_COLUMNS['ServerTimestamp'] + 1)[L1_COLUMNS['ServerTimestamp']]
+        return int(timestamp) if timestamp else None
+
+    def start_clock(self) -> SimulatedClock:
+        self.clock = SimulatedClock(self.start, self.speed)
+        return self.clock
+
+    async def play(self, path: str, timestamp, writer: asyncio.StreamWriter) -> None:
+        """
+        writes the lines of one file to writer at the pace of the clock, then closes it
+        """
+        if self.clock is None:
+            self.start_clock()
+        try:
+            with pgzip.open(path, 'rt') as f:
+                writer.write(f.readline().encode()) # header
+                for line in f:
+                    t = timestamp(line)
+                    if t is not None and t > self.clock.now():
+                        await writer.drain()
+                        await self.clock.sleep_until(t)
+                    writer.write(line.encode())
+            await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass # the consumer left or the simulation was stopped
+        finally:
+            writer.close()
+
+    async def serve(self, host: str = '127.0.0.1', l2_port: int = 9000, l1_port: int = 9001) -> tuple:
+        """
+        serves the l2 feed on l2_port and the l1 feed on l1_port, each connection is sent the whole day,
+        the clock starts with the first connection
+        """
+        l2 = await asyncio.start_server(
+            lambda reader, writer: self.play(self.l2_path, self._l2_timestamp, writer), host, l2_port)
+        l1 = await asyncio.start_server(
+            lambda reader, writer: self.play(self.l1_path, self._l1_timestamp, writer), host, l1_port)
+        return l2, l1
+
+
+async def simulate(l2_path: str, l1_path: str, dest: str, universe: list, speed: float = 1.0,
+                   host: str = '127.0.0.1', l2_port: int = 9000, l1_port: int = 9001, **kwargs) -> LiveReplayer:
+    """
+    plays a day through a FeedSimulator over local sockets into a LiveReplayer on the simulated clock
+    kwargs go to LiveReplayer, returns it once both feeds ended
+    """
+    simulator = FeedSimulator(l2_path, l1_path, speed)
+    servers = await simulator.serve(host, l2_port, l1_port)
+    live = LiveReplayer(dest, universe, clock=simulator.start_clock(), **kwargs)
+    l2, l2_connection = await open_feed(f"{host}:{l2_port}")
+    l1, l1_connection = await open_feed(f"{host}:{l1_port}")
+    try:
+        await live.run(l2, l1)
+    finally:
+        l2_connection.close()
+        l1_connection.close()
+        for server in servers:
+            server.close()
+    return live
@@ -1,14 +1,101 @@
 from replayer import Replayer
+from coordinator import Coordinator
+import argparse
+import asyncio
+import json
+import os
 import datetime
 import sys 
 import multiprocessing as mp
 
+
+def data_args(parser, start: bool = True) -> None:
+    # the data a replay reads, the defaults are those of the original feed
+    parser.add_argument("--eid", default="1027", help="exchange id in the names of the csv.gz files")
+    if start:
+        parser.add_argument("--start", default="2020-12-01", help="first date to replay, YYYY-MM-DD")
+        parser.add_argument("--universe", nargs="*", default=["648799570"],
+                            help="instrument codes, inferred from the first date if the flag is given without any")
+        parser.add_argument("--frequency", type=float, default=1.0, help="seconds between snapshots")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="orderbook replayer")
+    commands = parser.add_subparsers(dest="command")
+    replay = commands.add_parser("replay", help="replay days and write features to the destination")
+    replay.add_argument("source")
+    replay.add_argument("destination")
+    replay.add_argument("days", type=int)
+    replay.add_argument("--cache", default=None, help="directory of the preprocessed day cache")
+    replay.add_argument("--cache-size", type=int, default=100 * 2**30, help="cache size limit in bytes")
+    replay.add_argument("--parallel", action="store_true", help="replay the days at once, one process per date")
+    replay.add_argument("--streaming", action="store_true", help="read each day chunk by chunk with bounded memory")
+    replay.add_argument("--profile", action="store_true", help="write per stage timings to <destination>/_profile")
+    replay.add_argument("--profile-sampling", type=float, default=None,
+                        help="seconds between stack samples of the worker processes")
+    replay.add_argument("--resume", action="store_true",
+                        help="skip the units <destination>/_manifest.json records as finished and still fresh")
+    replay.add_argument("--columns", type=json.loads, default=None,
+                        help='json column spec, e.g. {"layers": [0], "depth": 5, "derived": ["mid", "spread"]}')
+    replay.add_argument("--panels", type=json.loads, default=None,
+                        help='json panel groups replayed in lock step, e.g. {"pair": ["648799570", "648799571"]}')
+    data_args(replay)
+    cache = commands.add_parser("cache", help="preprocess days into the cache without replaying them")
+    cache.add_argument("source")
+    cache.add_argument("cache")
+    cache.add_argument("days", type=int)
+    cache.add_argument("--cache-size", type=int, default=100 * 2**30, help="cache size limit in bytes")
+    data_args(cache)
+    node = commands.add_parser("node", help="replay units of the days with the other nodes sharing a coordinator directory")
+    node.add_argument("source")
+    node.add_argument("destination", help="shared by the nodes, like the checkpoints under it")
+    node.add_argument("coordinator", help="shared directory of the plan, leases and finished units")
+    node.add_argument("days", type=int)
+    node.add_argument("--node", default=None, help="name of the node, {hostname}-{pid} by default")
+    node.add_argument("--lease", type=float, default=60.0, help="seconds until the units of a silent node are taken over")
+    node.add_argument("--max-attempts", type=int, default=3, help="attempts of a unit before it is given up")
+    node.add_argument("--units", type=int, default=None, help="instruments of one date claimed at a time")
+    node.add_argument("--cache", default=None, help="directory of the preprocessed day cache")
+    node.add_argument("--cache-size", type=int, default=100 * 2**30, help="cache size limit in bytes")
+    node.add_argument("--columns", type=json.loads, default=None, help="json column spec, the same on every node")
+    data_args(node)
+    merge = commands.add_parser("merge", help="stitch the units finished by the nodes into the outputs")
+    merge.add_argument("source")
+    merge.add_argument("destination")
+    merge.add_argument("coordinator")
+    merge.add_argument("--columns", type=json.loads, default=None, help="json column spec of the nodes")
+    data_args(merge)
+    live = commands.add_parser("live", help="keep books from live l2/l1 feeds and write features every frequency")
+    live.add_argument("l2", help="l2 feed, host:port or a pipe")
+    live.add_argument("l1", help="l1 feed, host:port or a pipe")
+    live.add_argument("destination")
+    live.add_argument("--frequency", type=float, default=1.0, help="seconds between snapshots")
+    live.add_argument("--universe", nargs="+", default=["648799570"], help="instrument codes, other messages are ignored")
+    simulate = commands.add_parser("simulate", help="serve a day of csv.gz files as live feeds")
+    simulate.add_argument("source")
+    simulate.add_argument("date")
+    simulate.add_argument("--speed", type=float, default=1.0, help="times faster than real time")
+    simulate.add_argument("--port", type=int, default=9000, help="l2 feed port, the l1 feed is served on the next one")
+    data_args(simulate, start=False)
+    if len(argv) > 0 and argv[0] not in ("replay", "cache", "node", "merge", "live", "simulate", "-h", "--help"):
+        argv = ["replay"] + argv # python main.py <source> <destination> <days_to_replay>
+    return parser.parse_args(argv)
+
+
 if __name__ == "__main__":
     """
 
         Main thread of the feature generation process
         
-        Usage:          python main.py <source> <destination> <days_to_replay>
+        Usage:          python main.py [replay] <source> <destination> <days_to_replay> [--cache <cache_dir>] [--parallel] [--streaming]
+                                        [--resume] [--columns <json>] [--panels <json>] [<data>]
+                        python main.py cache <source> <cache_dir> <days_to_cache> [<data>]
+                        python main.py node <source> <destination> <coordinator_dir> <days_to_replay> [--node <name>]
+                                        [--columns <json>] [<data>]
+                        python main.py merge <source> <destination> <coordinator_dir> [--columns <json>] [<data>]
+                        python main.py live <l2_feed> <l1_feed> <destination> [--frequency <seconds>] [--universe <code> ...]
+                        python main.py simulate <source> <date> [--speed <n>] [--port <l2_port>] [--eid <eid>]
+                        <data>: [--eid <eid>] [--start <YYYY-MM-DD>] [--universe [<code> ...]] [--frequency <seconds>]
 
         Params:
         -------
@@ -22,7 +109,9 @@ if __name__ == "__main__":
 
         Output:
         -------
-        One csv file (in the destination directory) for each specified symbol in the universe with the following columns for each layer:
+        One csv file (in the destination directory) for each specified symbol in the universe,
+        or with output='parquet'/'ipc' one float32 file per symbol and date under code={code}/date={date}/,
+        with the following columns for each layer (or those of --columns):
         bid_price_0 ... bid_price_9
         bid_qty_0   ... bid_qty_9
         ask_price_0 ... ask_price_9
@@ -33,16 +122,79 @@ if __name__ == "__main__":
 
         timestamp
 
+        With --panels the members of every group are written as one wide float32 file per group and date under
+        panels/code={group}/date={date}/, the columns above prefixed with each member's code, then the panel features
+
     """
+    args = parse_args(sys.argv[1:])
+    if args.command == "live":
+        from live import LiveReplayer, open_feed
+
+        async def run_live():
+            l2, l2_connection = await open_feed(args.l2)
+            l1, l1_connection = await open_feed(args.l1)
+            live = LiveReplayer(args.destination, args.universe, datetime.timedelta(seconds=args.frequency))
+            try:
+                await live.run(l2, l1)
+            finally:
+                l2_connection.close()
+                l1_connection.close()
+                print(live.latency_percentiles())
+        try:
+            asyncio.run(run_live())
+        except KeyboardInterrupt: # the way to stop a live replay
+            pass
+        sys.exit(0)
+    if args.command == "simulate":
+        from live import FeedSimulator
+
+        async def serve():
+            simulator = FeedSimulator(
+                os.path.join(args.source, "l2_data", f"{args.date}_{args.eid}_L2.csv.gz"),
+                os.path.join(args.source, "l1_data", f"{args.date}_{args.eid}_L1-Trades.csv.gz"),
+                args.speed,
+            )
+            servers = await simulator.serve('127.0.0.1', args.port, args.port + 1)
+            await asyncio.gather(*(server.serve_forever() for server in servers))
+        try:
+            asyncio.run(serve())
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
     mp.set_start_method("forkserver")
+    panels = args.panels if args.command == "replay" else None
+    universe = list(args.universe)
+    # the members of the panels are replayed along
+    universe += [code for members in (panels or {}).values() for code in members if code not in universe]
     r = Replayer(
-        src=sys.argv[1],
-        eid="1027", 
-        dest=sys.argv[2],
-        frequency=datetime.timedelta(seconds=1),
-        start="2020-12-01", 
-        universe=["648799570"]
+        src=args.source,
+        eid=args.eid,
+        dest=args.cache if args.command == "cache" else args.destination,
+        frequency=datetime.timedelta(seconds=args.frequency),
+        start=args.start,
+        universe=universe,
+        cache=args.cache if args.command != "merge" else None,
+        cache_size=args.cache_size if args.command != "merge" else 100 * 2**30,
+        streaming=args.command == "replay" and args.streaming,
+        profile=args.command == "replay" and args.profile,
+        profile_sampling=args.profile_sampling if args.command == "replay" else None,
+        resume=args.command == "replay" and args.resume,
+        columns=args.columns if args.command in ("replay", "node", "merge") else None,
+        panels=panels,
     )
-    days_to_replay = int(sys.argv[3])
-    for i in range(days_to_replay):
-        r.compute_day() # this computes one day worth of data
+    if args.command == "cache":
+        for i in range(args.days):
+            r.cache_day() # this only preprocesses one day worth of data
+    elif args.command == "node":
+        coordinator = Coordinator(args.coordinator, args.node, args.lease, args.max_attempts)
+        r.run_node(coordinator, args.days, args.units) # returns once every unit is done or given up
+    elif args.command == "merge":
+        left = r.merge_units(Coordinator(args.coordinator))
+        if left:
+            print(f"not merged, not done: {left}")
+    elif args.parallel:
+        r.compute_days_parallel(args.days) # dates start from checkpoints or warm up on their first full snapshot
+    else:
+        for i in range(args.days):
+            r.compute_day() # this computes one day worth of data
+    r.close()
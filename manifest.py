@@ -0,0 +1,110 @@
+"""
+run manifest of a replay destination, {dest}/_manifest.json (_ prefixed, skipped by dataset readers) holds
+the feature set of the run, the checksums of the input files of every date and the finished (instrument, date) units
+with the offsets their output ended at, so a rerun can skip the finished units and redo the missing or stale ones
+"""
+import os
+import json
+import time
+import hashlib
+
+MANIFEST_VERSION = 1
+
+
+def file_checksum(path: str, known: dict = None) -> dict:
+    """
+    {size, mtime, md5} of path, the md5 of known is reused while the size and mtime still match
+    """
+    stat = os.stat(path)
+    if known is not None and known['size'] == stat.st_size and known['mtime'] == stat.st_mtime:
+        return known
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2**24), b''):
+            h.update(block)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime, 'md5': h.hexdigest()}
+
+
+class RunManifest:
+
+    """
+    a unit is stale once the checksums of its date's input files changed, and all of them once the feature set did
+    since the books carry over from one date to the next, so does staleness: only the finished units an instrument
+    starts with are kept on resume, see resume
+    """
+
+    def __init__(self, dest: str, features: dict) -> None:
+        self.dest = dest
+        self.path = os.path.join(dest, "_manifest.json")
+        self.features = features
+        data = None
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                data = json.load(f)
+        if data is not None and (data.get('version') != MANIFEST_VERSION or data['features'] != features):
+            print(f"the feature set of {self.path} changed, every unit is stale")
+            data = None
+        if data is None:
+            data = {'sources': {}, 'units': {}}
+        self.sources = data['sources'] # {date: {file name: checksum}}
+        self.units = data['units'] # {code: {date: unit}}
+        self._checked = {} # {date: checksums} as of this run
+
+    def checksums(self, date: str, paths: list) -> dict:
+        # checksums of the input files of date, computed once per run
+        if date not in self._checked:
+            known = self.sources.get(date, {})
+            self._checked[date] = {
+                os.path.basename(path): file_checksum(path, known.get(os.path.basename(path))) for path in paths
+            }
+        return self._checked[date]
+
+    def fresh(self, code: str, date: str, paths: list) -> bool:
+        """
+        whether the unit is finished and its input files are the ones it was replayed from
+        """
+        if date not in self.units.get(code, {}) or date not in self.sources:
+            return False
+        current = self.checksums(date, paths)
+        recorded = self.sources[date]
+        return recorded.keys() == current.keys() and all(recorded[k]['md5'] == current[k]['md5'] for k in current)
+
+    def resume(self, code: str, dates: list, paths, resumable=None):
+        """
+        last of the fresh units code starts dates with (whose state resumable(date) can restore), None without any
+        every other unit of code in dates is dropped, its output is about to be redone
+        paths(date) are the input files of a date
+        """
+        last = None
+        for date in dates:
+            if not self.fresh(code, date, paths(date)):
+                break
+            if resumable is None or resumable(date):
+                last = date
+        units = self.units.get(code, {})
+        for date in dates:
+            if last is None or date > last:
+                units.pop(date, None)
+        return last
+
+    def offsets(self, code: str, date: str) -> dict:
+        # recorded relative to dest, so the destination can be given either way or moved
+        return {os.path.join(self.dest, path): size for path, size in self.units[code][date]['offsets'].items()}
+
+    def record(self, code: str, date: str, paths: list, accuracy: float, offsets: dict) -> None:
+        """
+        marks the unit finished, offsets are those of its instrument's output right after it (see sinks)
+        """
+        self.sources[date] = self.checksums(date, paths)
+        self.units.setdefault(code, {})[date] = {
+            'accuracy': accuracy,
+            'offsets': {os.path.relpath(path, self.dest): size for path, size in offsets.items()},
+            'finished': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+
+    def save(self) -> None:
+        data = {'version': MANIFEST_VERSION, 'features': self.features, 'sources': self.sources, 'units': self.units}
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, self.path) # never leave a truncated manifest behind
@@ -89,8 +89,23 @@ class LocalOrderBook:
     def AskOverwriteLevel(self, price, qty, level):
         self.ask_prices[level] = price
         self.ask_volumes[level] = qty
+
+    def BidOverwriteLevels(self, prices, qtys, level):
+        # overwrite len(prices) levels starting at level at once
+        if level + len(prices) > len(self.bid_prices): raise IndexError("bid levels beyond the book")
+        self.bid_prices[level:level + len(prices)] = prices
+        self.bid_volumes[level:level + len(qtys)] = qtys
+
+    def AskOverwriteLevels(self, prices, qtys, level):
+        if level + len(prices) > len(self.ask_prices): raise IndexError("ask levels beyond the book")
+        self.ask_prices[level:level + len(prices)] = prices
+        self.ask_volumes[level:level + len(qtys)] = qtys
         
-    def take_snapshot(self, levels=10, mode = 'list'):
+    def take_snapshot(self, levels=10, mode = 'list', fields=None):
+        # fields picks the sides of the list, 0 to 3 for bid prices, bid volumes, ask prices and ask volumes
+        if fields is not None:
+            sides = (self.bid_prices, self.bid_volumes, self.ask_prices, self.ask_volumes)
+            return [value for field in fields for value in sides[field][:levels]]
         if mode == 'dict':
             snapshot = {}
             snapshot['bid_prices'] = self.bid_prices[:levels]
@@ -101,9 +116,171 @@ class LocalOrderBook:
             snapshot = self.bid_prices[:levels] + self.bid_volumes[:levels] + self.ask_prices[:levels] + self.ask_volumes[:levels]
         return snapshot
 
+    def top(self):
+        # (bid price, bid volume, ask price, ask volume) of the best level, nan without any level
+        if len(self.bid_prices) == 0:
+            return np.nan, np.nan, np.nan, np.nan
+        return self.bid_prices[0], self.bid_volumes[0], self.ask_prices[0], self.ask_volumes[0]
+
     def __repr__(self) -> str:
         return f"Instrument Code: {self.code}" +\
                f"\nbid prices: {self.bid_prices}" +\
                f"\nbid volumes: {self.bid_volumes}" +\
                f"\nask prices: {self.ask_prices}" +\
                f"\nask volumes: {self.ask_volumes}"
+
+
+class ArrayOrderBook:
+
+    """
+    drop-in replacement for LocalOrderBook backed by a preallocated numpy buffer
+    rows of the buffer hold bid prices, bid volumes, ask prices and ask volumes,
+    levels are shifted in place so updates and snapshots do not allocate new lists
+    slots past the visible depth are always kept at nan
+    """
+
+    __slots__ = ('code', 'depth', 'book')
+
+    def __init__(self, code:str, initial_levels=15, capacity=64) -> None:
+        self.code = code
+        self.depth = initial_levels
+        self.book = np.full((4, max(capacity, initial_levels)), np.nan) # best level at column 0
+
+    @property
+    def bid_prices(self):
+        return self.book[0, :self.depth]
+
+    @property
+    def bid_volumes(self):
+        return self.book[1, :self.depth]
+
+    @property
+    def ask_prices(self):
+        return self.book[2, :self.depth]
+
+    @property
+    def ask_volumes(self):
+        return self.book[3, :self.depth]
+
+    def BidChangeQtyAtLevel(self, level, qty):
+        self._change(1, level, qty)
+
+    def AskChangeQtyAtLevel(self, level, qty):
+        self._change(3, level, qty)
+
+    def BidRemoveLevel(self, level):
+        self._remove(0, level, np.nan, np.nan)
+
+    def AskRemoveLevel(self, level):
+        self._remove(2, level, np.nan, np.nan)
+
+    def BidInsertAtLevel(self, level, price, qty):
+        self._insert(0, level, price, qty)
+
+    def AskInsertAtLevel(self, level, price, qty):
+        self._insert(2, level, price, qty)
+
+    def BidRemoveLevelAndAppend(self, level, price, qty):
+        self._remove(0, level, price, qty)
+
+    def AskRemoveLevelAndAppend(self, level, price, qty):
+        self._remove(2, level, price, qty)
+
+    def BidClearFromLevel(self, level):
+        if level >= self.depth: return
+        self.book[0:2, level:self.depth] = np.nan
+
+    def AskClearFromLevel(self, level):
+        if level >= self.depth: return
+        self.book[2:4, level:self.depth] = np.nan
+
+    def ALLClearFromLevel(self, level):
+        if level >= self.depth: return
+        self.book[:, level:self.depth] = np.nan
+
+    def MaxVisibleDepth(self, depth):
+        if depth > self.book.shape[1]:
+            # only reallocate when the venue announces more levels than we reserved
+            book = np.full((4, depth), np.nan)
+            book[:, :self.depth] = self.book[:, :self.depth]
+            self.book = book
+        elif depth < self.depth:
+            self.book[:, depth:self.depth] = np.nan
+        self.depth = depth
+
+    def BidOverwriteLevel(self, price, qty, level):
+        if level >= self.depth: raise IndexError(f"level {level} is beyond visible depth {self.depth}")
+        self.book[0, level] = price
+        self.book[1, level] = qty
+
+    def AskOverwriteLevel(self, price, qty, level):
+        if level >= self.depth: raise IndexError(f"level {level} is beyond visible depth {self.depth}")
+        self.book[2, level] = price
+        self.book[3, level] = qty
+
+    def BidOverwriteLevels(self, prices, qtys, level):
+        end = level + len(prices)
+        if end > self.depth: raise IndexError(f"level {end - 1} is beyond visible depth {self.depth}")
+        self.book[0, level:end] = prices
+        self.book[1, level:end] = qtys
+
+    def AskOverwriteLevels(self, prices, qtys, level):
+        end = level + len(prices)
+        if end > self.depth: raise IndexError(f"level {end - 1} is beyond visible depth {self.depth}")
+        self.book[2, level:end] = prices
+        self.book[3, level:end] = qtys
+
+    def _change(self, row, level, qty):
+        # like the lists of LocalOrderBook, a level past the visible depth is an IndexError
+        if level >= self.depth: raise IndexError(f"level {level} is beyond visible depth {self.depth}")
+        self.book[row, level] = qty
+
+    def _insert(self, row, level, price, qty):
+        # shift [level, depth - 1) one level deeper, the last visible level falls off
+        depth = self.depth
+        if level >= depth: return
+        side = self.book[row:row + 2]
+        side[:, level + 1:depth] = side[:, level:depth - 1]
+        side[0, level] = price
+        side[1, level] = qty
+
+    def _remove(self, row, level, price, qty):
+        # shift (level, depth) one level up and fill the freed last visible level
+        depth = self.depth
+        if level >= depth: raise IndexError(f"level {level} is beyond visible depth {depth}")
+        side = self.book[row:row + 2]
+        side[:, level:depth - 1] = side[:, level + 1:depth]
+        side[0, depth - 1] = price
+        side[1, depth - 1] = qty
+
+    def take_snapshot(self, levels=10, mode = 'list', fields=None):
+        """
+        mode 'view' returns a (4, levels) view of the buffer without copying, nan padded past the visible depth,
+        'dict' returns views per side and 'list' a flat list laid out like LocalOrderBook.take_snapshot,
+        fields picks the rows of the list (0 to 3 for bid prices, bid volumes, ask prices and ask volumes)
+        """
+        if mode == 'view':
+            return self.book[:, :levels]
+        levels = min(levels, self.depth)
+        if fields is not None:
+            return self.book[fields, :levels].ravel().tolist()
+        if mode == 'dict':
+            snapshot = {}
+            snapshot['bid_prices'] = self.book[0, :levels]
+            snapshot['bid_volumes'] = self.book[1, :levels]
+            snapshot['ask_price'] = self.book[2, :levels]
+            snapshot['ask_volumes'] = self.book[3, :levels]
+        else:
+            snapshot = self.book[:, :levels].ravel().tolist()
+        return snapshot
+
+    def top(self):
+        # slots past the visible depth are nan, so is the best level of an empty book
+        return tuple(self.book[:, 0].tolist())
+
+    def __repr__(self) -> str:
+        return f"Instrument Code: {self.code}" +\
+               f"\nbid prices: {self.bid_prices.tolist()}" +\
+               f"\nbid volumes: {self.bid_volumes.tolist()}" +\
+               f"\nask prices: {self.ask_prices.tolist()}" +\
+               f"\nask volumes: {self.ask_volumes.tolist()}"
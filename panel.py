@@ -0,0 +1,103 @@
+"""
+cross instrument panels: the instruments of a group replayed together on their shared time grid, tick by tick,
+so that the panel features (feature_func.panel_feature) see the rows and the live books of every member at once
+every tick writes one wide row to the group's sink: the row of each member with its columns prefixed by its code,
+then the panel features, instead of one output per instrument to be joined afterwards
+"""
+import polars as pl
+
+from columns import ColumnSpec, column_spec
+from handlers import replay_bucket, tick_row
+from check_ob import BookValidator, save_validation
+from feature_func import panel_features, panel_feature_funcs
+from profiling import StageClock, bucket_messages, save_replay_profile
+
+
+def panel_columns(members: list, columns: list) -> list:
+    """
+    columns of a panel row, columns being those of the row of one instrument
+    """
+    return [f"{code}_{col}" for code in members for col in columns] + panel_features
+
+
+def stack_members(frames: dict, members: list) -> pl.DataFrame:
+    # the equally long frames of the members one after the other, a group's day is handed to its worker as one frame
+    return pl.concat([frames[code] for code in members])
+
+
+def split_members(frame: pl.DataFrame, members: list) -> dict:
+    height = frame.height // len(members)
+    return {code: frame.slice(i * height, height) for i, code in enumerate(members)}
+
+
+def compute_panel(
+        l2: pl.DataFrame,
+        l1: pl.DataFrame,
+        l2_col_mapping: dict,
+        l1_col_mapping: dict,
+        ob_handler: dict,
+        trade_handler: dict,
+        dest,
+        last: dict = None,
+        warmup: bool = False,
+        validation: dict = None,
+        profile: str = None,
+        columns: ColumnSpec = None,
+    ) -> tuple:
+    """
+    handlers.compute_day for the members of a panel group at once (same contract, including warmup and windows)
+    ob_handler, trade_handler and last are {code: ...} of the members in group order, l2 and l1 their frames
+    stacked in that order (see stack_members) and dest the sink of the panel
+    the books of every member are checked by their own validator, reported in {code}.{date}.validation.json
+    with the reports of the panel (see sinks.report_path)
+
+    returns ({code: last row}, {code: accuracy})
+    """
+    members = list(ob_handler)
+    chunks = [(l2, l1)] if l1 is not None else l2
+    columns = column_spec(columns)
+    snapshot = columns.snapshot
+    dest.open()
+    prev_rows = last if last is not None else {} # the last row of every member, none before its first
+    validators = {code: BookValidator(**(validation or {})) for code in members}
+    synced = {code: set() if warmup else None for code in members}
+    clock = StageClock() if profile is not None else None
+    rows, messages = 0, 0
+    for l2, l1 in chunks:
+        l2, l1 = split_members(l2, members), split_members(l1, members)
+        if clock is not None:
+            rows += l2[members[0]].height
+            messages += sum(bucket_messages(l2[code], l1[code]) for code in members)
+        buckets = zip(*(zip(l2[code].iter_rows(named = True), l1[code].iter_rows(named = True)) for code in members))
+        for tick in buckets:
+            timestamp = tick[0][0]['Timestamp']
+            for code, (l2_updates, trades) in zip(members, tick):
+                # assure time is uniform, across the members as well
+                assert timestamp == l2_updates.pop('Timestamp') == trades.pop('Timestamp')
+                replay_bucket(l2_updates, trades, l2_col_mapping, ob_handler[code], trade_handler[code], timestamp,
+                              validators[code], synced[code])
+            if clock is not None:
+                clock.lap('replay')
+
+            # record the features of every member, then those of the panel
+            member_rows = {
+                code: tick_row(snapshot, ob_handler[code], trade_handler[code], timestamp, prev_rows.get(code))
+                for code in members
+            }
+            prev_data = prev_rows if all(prev_rows.get(code) is not None for code in members) else None
+            data = [value for code in members for value in member_rows[code]]
+            data += [f(data=member_rows, prev_data=prev_data, books=ob_handler) for f in panel_feature_funcs]
+            if clock is not None:
+                clock.lap('features')
+            dest.write(data, timestamp)
+            prev_rows = member_rows
+            if clock is not None:
+                clock.lap('write')
+
+    dest.close()
+    for code, validator in validators.items():
+        save_validation(validator, dest, code)
+    if clock is not None:
+        clock.lap('write')
+        save_replay_profile(profile, dest, clock, rows, messages)
+    return prev_rows, {code: validator.accuracy(columns.layers[0]) for code, validator in validators.items()}
@@ -0,0 +1,61 @@
+from concurrent.futures import ThreadPoolExecutor
+
+
+def _frames_bytes(day) -> int:
+    # estimated in memory size of a loaded day: ({code: l2 frame}, {code: l1 frame}, anything else)
+    return sum(frame.estimated_size() for frames in day[:2] for frame in frames.values())
+
+
+class DayPrefetcher:
+
+    """
+    loads the upcoming dates in background threads while the current one is replayed
+    at most depth dates are loaded ahead, fewer once that many days the size of the last one would exceed max_bytes
+    load(date) must only read the replayer's state, polars and zlib release the gil so the loading overlaps with the replay
+    """
+
+    def __init__(self, load, depth: int = 1, max_bytes: int = 8 * 2**30) -> None:
+        self.load = load
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.pending = {} # {date: future}, in date order
+        self.day_bytes = 0 # size of the last loaded day
+        self._executor = None
+
+    def get(self, date: str):
+        """
+        returns load(date), from the background if it was prefetched
+        """
+        future = self.pending.pop(date, None)
+        day = future.result() if future is not None else self.load(date)
+        self.loaded(day)
+        return day
+
+    def loaded(self, day) -> None:
+        # the prefetch budget goes by the size of the last day, wherever it was loaded
+        self.day_bytes = _frames_bytes(day)
+
+    def schedule(self, dates: list) -> None:
+        """
+        starts loading the first of the upcoming dates, as far as depth and max_bytes allow
+        """
+        for date in list(self.pending):
+            if date not in dates[:self.depth]: # skipped, e.g. by a date parallel replay
+                self.pending.pop(date).cancel()
+        for date in dates[:self.depth]:
+            if date in self.pending:
+                continue
+            if (len(self.pending) + 1) * self.day_bytes > self.max_bytes:
+                print(f"not prefetching {date}, it would exceed the prefetch budget of {self.max_bytes} bytes")
+                break
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.depth, thread_name_prefix="prefetch")
+            self.pending[date] = self._executor.submit(self.load, date)
+
+    def close(self) -> None:
+        for future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
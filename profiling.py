@@ -0,0 +1,194 @@
+"""
+timings of the replay pipeline: wall and cpu seconds, rows, messages and peak rss per stage,
+written as a json and csv report per day (loading) and per instrument and day (replay), see write_day_report
+"""
+import os
+import sys
+import csv
+import json
+import time
+import resource
+import threading
+import collections
+from contextlib import contextmanager
+
+REPORT_COLUMNS = ['date', 'code', 'stage', 'wall_s', 'cpu_s', 'rows', 'messages', 'rows_per_s', 'messages_per_s',
+                  'peak_rss_mb']
+
+
+def peak_rss_mb() -> float:
+    # linux reports kilobytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class _Counts:
+
+    __slots__ = ('rows', 'messages')
+
+    def __init__(self) -> None:
+        self.rows = 0
+        self.messages = 0
+
+
+class StageProfile:
+
+    """
+    stages of one day (code None, the loading) or of one instrument's day (the replay), in the order first seen
+    cpu is the clock of the cpu seconds, process_time by default, which includes the threads of polars
+    """
+
+    def __init__(self, date: str, code: str = None, cpu=time.process_time) -> None:
+        self.date = date
+        self.code = code
+        self.cpu = cpu
+        self.stages = {} # {stage: [wall, cpu, rows, messages, peak rss]}
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        times the block, rows and messages can be set on the yielded counts
+        """
+        counts = _Counts()
+        wall, cpu = time.perf_counter(), self.cpu()
+        try:
+            yield counts
+        finally:
+            self.add(name, time.perf_counter() - wall, self.cpu() - cpu, counts.rows, counts.messages)
+
+    def add(self, name: str, wall: float, cpu: float, rows: int = 0, messages: int = 0) -> None:
+        stage = self.stages.setdefault(name, [0.0, 0.0, 0, 0, 0.0])
+        stage[0] += wall
+        stage[1] += cpu
+        stage[2] += rows
+        stage[3] += messages
+        stage[4] = peak_rss_mb()
+
+    def rows(self) -> list:
+        return [
+            {
+                'date': self.date,
+                'code': self.code,
+                'stage': name,
+                'wall_s': wall,
+                'cpu_s': cpu,
+                'rows': rows,
+                'messages': messages,
+                'rows_per_s': rows / wall if wall > 0 else None,
+                'messages_per_s': messages / wall if wall > 0 else None,
+                'peak_rss_mb': rss,
+            }
+            for name, (wall, cpu, rows, messages, rss) in self.stages.items()
+        ]
+
+    def save(self, directory: str) -> None:
+        name = f"{self.date}.json" if self.code is None else f"{self.code}.{self.date}.json"
+        _dump(os.path.join(directory, name), self.rows())
+
+
+class StageClock:
+
+    """
+    splits the time of a loop between stages, lap(stage) charges the wall and thread cpu time since the last lap
+    """
+
+    __slots__ = ('wall', 'cpu', 'last_wall', 'last_cpu')
+
+    def __init__(self) -> None:
+        self.wall = collections.defaultdict(float)
+        self.cpu = collections.defaultdict(float)
+        self.last_wall = time.perf_counter()
+        self.last_cpu = time.thread_time()
+
+    def lap(self, stage: str) -> None:
+        wall, cpu = time.perf_counter(), time.thread_time()
+        self.wall[stage] += wall - self.last_wall
+        self.cpu[stage] += cpu - self.last_cpu
+        self.last_wall, self.last_cpu = wall, cpu
+
+    def add_to(self, profile: StageProfile, rows: dict = {}, messages: dict = {}) -> None:
+        for stage in self.wall:
+            profile.add(stage, self.wall[stage], self.cpu[stage], rows.get(stage, 0), messages.get(stage, 0))
+
+
+def bucket_messages(l2, l1) -> int:
+    # l2 and l1 messages of a pair of bucketed frames, without the blank ones keeping the day uniform
+    return l2['LayerId'].explode().drop_nulls().len() + l1['TradeEvent_LastPrice'].explode().drop_nulls().len()
+
+
+def save_replay_profile(directory: str, sink, clock: StageClock, rows: int, messages: int) -> None:
+    """
+    writes the stages of an engine's day to {directory}/{code}.{date}.json, rows are the replayed intervals
+    """
+    profile = StageProfile(sink.date, sink.code)
+    clock.add_to(profile, {'replay': rows, 'features': rows, 'write': rows}, {'replay': messages})
+    profile.save(directory)
+
+
+def _dump(path: str, rows: list) -> None:
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(rows, f)
+    os.replace(tmp, path)
+
+
+def write_day_report(directory: str, date: str, profile: StageProfile, codes: list) -> None:
+    """
+    {date}.json with the loading stages and {date}.csv with those and the stages of every instrument,
+    from the {code}.{date}.json the engines left in directory
+    """
+    profile.save(directory)
+    rows = profile.rows()
+    for code in codes:
+        path = os.path.join(directory, f"{code}.{date}.json")
+        if os.path.exists(path):
+            with open(path) as f:
+                rows += json.load(f)
+    with open(os.path.join(directory, f"{date}.csv"), 'w', newline='') as f:
+        writer = csv.DictWriter(f, REPORT_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+class SamplingProfiler:
+
+    """
+    samples the python stacks of every other thread of the process every interval seconds from a daemon thread,
+    save writes the counts as collapsed stacks ("thread;outer;...;inner count" lines, for flamegraph.pl or speedscope)
+    """
+
+    def __init__(self, interval: float = 0.01) -> None:
+        self.interval = interval
+        self.counts = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        own = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                if ident not in names:
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.counts[';'.join(reversed(stack))] += 1
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def save(self, path: str) -> None:
+        with open(path, 'w') as f:
+            for stack, count in self.counts.most_common():
+                f.write(f"{stack} {count}\n")
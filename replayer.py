@@ -1,14 +1,52 @@
 import os
+import time
 import datetime
 import copy
+import functools
+import traceback
+import pgzip
 import polars as pl
-from concurrent.futures import ProcessPoolExecutor, as_completed
-from data_schema import L2_SCHEMA, L1_SCHEMA
-from orderbook import LocalOrderBook
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from data_schema import L2_SCHEMA, L1_SCHEMA, L2_MESSAGE_SCHEMA, L1_MESSAGE_SCHEMA, L2_SOURCE_COLUMNS, L1_SOURCE_COLUMNS
+from orderbook import LocalOrderBook, ArrayOrderBook
 from trades import TradesHandler
-from feature_func import all_features
-from handlers import compute_day
+from feature_func import all_features, vector_features, snapshot_columns
+from columns import ColumnSpec, column_spec
+from handlers import compute_day, iter_day_events
+from panel import compute_panel, panel_columns, stack_members
+from check_ob import VALIDATION_MODES
+from batch import compute_day_batch
+from sinks import make_sink, ResampleSink, frequency_label
+from cache import DayCache
+from workers import InstrumentWorkerPool
+from checkpoint import save_checkpoint, load_checkpoint, checkpoint_path
+from manifest import RunManifest
+from coordinator import Coordinator
+from stream import DayStream, encode_l2, encode_l1
+from prefetch import DayPrefetcher
+from profiling import StageProfile, write_day_report
 
+# columns aggregated per replay interval, in the order compute_day sees them
+L2_REPLAY_COLUMNS = [
+    'LayerId',
+    'Code',
+    'OverlapRefresh_BidChangeIndicator',
+    'OverlapRefresh_AskChangeIndicator',
+    'OverlapRefresh_BidLimits',
+    'OverlapRefresh_AskLimits',
+    'MaxVisibleDepth_MaxVisibleDepth',
+    'DeltaRefresh_DeltaAction',
+    'DeltaRefresh_CumulatedUnits',
+    'DeltaRefresh_Level',
+    'DeltaRefresh_Price',
+]
+L1_REPLAY_COLUMNS = [
+    'TradeEvent_LastPrice',
+    'TradeEvent_LastTradeQuantity',
+    'Code',
+    'TradeEvent_Context_AggressorSide',
+    'ServerTimestamp',
+]
 
 class Replayer:
 
@@ -18,10 +56,34 @@ class Replayer:
             eid: str,
             dest: str,
             start: str = None,
-            frequency: datetime.timedelta = datetime.timedelta(milliseconds=100),
+            frequency: datetime.timedelta | list = datetime.timedelta(milliseconds=100),
             universe: list = [],
             buffer_size: int = 2**20,
             max_workers: int = 2,
+            orderbook: type = None,
+            engine: str = 'rows',
+            output: str = 'csv',
+            batch_rows: int = 2**16,
+            cache: str = None,
+            cache_size: int = 100 * 2**30,
+            spool_dir: str = None,
+            checkpoint_dir: str = None,
+            streaming: bool = False,
+            chunk_bytes: int = 2**26,
+            window_buckets: int = 2**14,
+            prefetch: int = 0,
+            prefetch_bytes: int = 8 * 2**30,
+            decompress_threads: int = None,
+            trade_stats: bool = False,
+            sparse_levels: int = None,
+            heartbeat: datetime.timedelta = None,
+            validation: str = 'all',
+            validation_every: int = 100,
+            profile: bool = False,
+            profile_sampling: float = None,
+            resume: bool = False,
+            columns: ColumnSpec | dict = None,
+            panels: dict = None,
         ) -> None:
         """
         main thread of the feature generation process
@@ -32,10 +94,58 @@ class Replayer:
         eid:            str, exchange id
         dest:           str, absolute path to the directory to store the output
         start:          str, start date of the data to be replayed, format: YYYY-MM-DD
-        frequency:      timedelta, frequency of data replay
+        frequency:      timedelta, frequency of data replay, or a list of them: the data is replayed once
+                        at the finest one, every other must be a multiple of it, and each frequency is written
+                        with its own ohlcva windows to {dest}/{label}/, e.g. {dest}/1s/ and {dest}/1min/
         universe:       list, string codes of all instruments, if None, will be inferred from data
         buffer_size:    int, buffer size of the output file streams
-        max_workers:    int, number of processes to use for parallel processing
+        max_workers:    int, number of long lived worker processes, instruments are pinned to them
+        orderbook:      type, order book implementation, LocalOrderBook or the numpy backed ArrayOrderBook,
+                        if None, picked from the engine
+        engine:         str, 'rows' dispatches every message in python, 'batch' applies DeltaRefresh messages
+                        with the compiled kernel of batch.py (needs ArrayOrderBook)
+        output:         str, 'csv' appends to {dest}/{code}.csv, 'parquet' and 'ipc' write float32 columns
+                        partitioned as {dest}/code={code}/date={date}/
+        batch_rows:     int, rows buffered per record batch by the parquet and ipc outputs
+        cache:          str, directory of the preprocessed day cache, if None, every day is parsed from the csv.gz files
+        cache_size:     int, bytes the day cache may use before least recently used days are evicted
+        spool_dir:      str, where each day is published as arrow ipc files for the workers to memory map,
+                        if None, /dev/shm when available
+        checkpoint_dir: str, where the end of day book/trade state of every instrument is saved,
+                        if None, {dest}/_checkpoints (_ prefixed to stay out of the columnar outputs)
+        streaming:      bool, read each day chunk by chunk and replay it window by window (see stream.DayStream)
+                        instead of collecting it at once, needs an explicit universe and bypasses the day cache
+        chunk_bytes:    int, uncompressed csv bytes parsed at a time when streaming
+        window_buckets: int, replay intervals handed to the workers at a time when streaming
+        prefetch:       int, dates loaded in the background while the current one is replayed, 0 (default) disables
+                        prefetching, only dates still to be replayed are prefetched, so the date after the last replayed
+                        one may be loaded for nothing
+        prefetch_bytes: int, memory budget of the prefetched dates, fewer dates are loaded ahead past it
+        decompress_threads: int, threads decompressing each csv.gz file, if None, one per cpu
+        trade_stats:    bool, add trade_count, signed_volume and last_trade_age (seconds) after the ohlcva columns
+        sparse_levels:  int, if set, only write the intervals in which the first sparse_levels levels of a book
+                        or the trades changed, with a _reports/{code}.{date}.index.json (see sinks.densify)
+        heartbeat:      timedelta, with sparse_levels, write a row at least this often
+        validation:     str, which full OverlapRefresh snapshots the books are checked against: 'off', 'sampled' or 'all',
+                        the counters and a sample of the mismatches go to _reports/{code}.{date}.validation.json
+        validation_every: int, with validation='sampled', check every validation_every-th full snapshot
+        profile:        bool, time every stage of the pipeline, from the csv scan to the output write, and write
+                        {dest}/_profile/{date}.json and {date}.csv (all stages) and {code}.{date}.json (replay stages)
+        profile_sampling: float, if set, sample the python stacks of the worker processes every profile_sampling
+                        seconds into {dest}/_profile/worker-{pid}.folded (collapsed stacks, for flame graphs)
+        resume:         bool, continue the run recorded in {dest}/_manifest.json (see manifest.py): every instrument
+                        starts after the last of its finished units that are still fresh, from that unit's checkpoint
+                        and with its output rolled back to where that unit ended, dates finished for every instrument
+                        are skipped without being loaded; needs an explicit universe
+        columns:        ColumnSpec or a dict of its params (see columns.py), the layers, depth, fields and derived values
+                        (mid, spread, microprice) of the book columns, only the books of those layers are kept and
+                        messages of other layers are dropped when a day is loaded, if None, every field of 10 levels
+                        of the 6 layers
+        panels:         dict, {group: [codes]} of instruments replayed together on their shared time grid (see panel.py),
+                        every tick the panel features see the rows and books of all members of a group, and each group
+                        is written as one wide panel {dest}/panels/code={group}/date={date}/ (parquet, or ipc with
+                        output='ipc') of its members' columns prefixed by their codes, instead of per instrument outputs;
+                        needs an explicit universe, a single frequency and the compute_day replay without resume
         features:       list, feature classes to be computed along with snapshots and ohlcva
         """
         self.start = start
@@ -44,54 +154,428 @@ class Replayer:
         self.dir = src
         self.dates = self.list_dates(self.dir)
         self.eid = eid
-        self.freq = frequency
+        frequencies = sorted(frequency) if isinstance(frequency, (list, tuple)) else [frequency]
+        self.freq = frequencies[0]
+        for freq in frequencies[1:]:
+            assert freq % self.freq == datetime.timedelta(0), f"{freq} is not a multiple of the replay frequency {self.freq}"
+        self.frequencies = frequencies
         self.l2_col_mapping = None
         self.universe = universe
         self.ob_container = dict() # {instrument: {layerID: LocalOrderBook}}
         self.dest = dest
         self.buffer_size = buffer_size
+        self.output = output
+        self.batch_rows = batch_rows
         os.makedirs(self.dest, exist_ok=True)
-        self.blank_update_template = {k:[] for k in L2_SCHEMA.keys()}
-        self.blank_trade_template = {k:[] for k in L1_SCHEMA.keys()}
+        self.blank_update_template = {k:[] for k in ['Code', *L2_MESSAGE_SCHEMA.keys()]}
+        self.blank_trade_template = {k:[] for k in ['Code', *L1_MESSAGE_SCHEMA.keys()]}
         self.max_workers = max_workers
-        self.carry_over = []
+        assert engine in ('rows', 'batch'), f"unknown replay engine {engine}"
+        if orderbook is None:
+            orderbook = ArrayOrderBook if engine == 'batch' else LocalOrderBook
+        self.orderbook = orderbook
+        assert validation in VALIDATION_MODES, f"unknown validation mode {validation}"
+        self.profile_dir = None
+        if profile or profile_sampling is not None:
+            self.profile_dir = os.path.join(dest, "_profile")
+            os.makedirs(self.profile_dir, exist_ok=True)
+        self.profile = profile
+        self.profile_sampling = profile_sampling
+        self.load_profiles = {} # {date: StageProfile of its loading}, until the date's report is written
+        engine = compute_day_batch if engine == 'batch' else compute_day
+        self.columns = column_spec(columns)
+        self.engine = functools.partial(engine, validation=dict(mode=validation, every=validation_every),
+                                        profile=self.profile_dir if profile else None, columns=self.columns)
+        self.pool = None
+        self.spool_dir = spool_dir
+        self.checkpoint_dir = checkpoint_dir if checkpoint_dir is not None else os.path.join(dest, "_checkpoints")
+        self.sinks = None
+        self.headers_written = False
+        self.streaming = streaming
+        self.chunk_bytes = chunk_bytes
+        self.window_buckets = window_buckets
+        assert not streaming or universe != [], "streaming replay needs an explicit universe"
+        self.cache = None
+        if cache is not None:
+            key_parts = (L2_REPLAY_COLUMNS, L1_REPLAY_COLUMNS)
+            if self.columns.filters():
+                key_parts += (self.columns.layers,) # the cached days only hold the messages of these layers
+            self.cache = DayCache(cache, cache_size, key_parts=key_parts)
+        self.decompress_threads = decompress_threads
+        self.trade_stats = trade_stats
+        self.sparse_levels = sparse_levels
+        self.heartbeat = heartbeat
+        self.prefetcher = None
+        if prefetch > 0 and not streaming:
+            self.prefetcher = DayPrefetcher(self._prefetch_date, prefetch, prefetch_bytes)
+        # the finished units of every run are recorded, a resumed run starts after them
+        assert not resume or universe != [], "resuming a run needs an explicit universe"
+        self.panels = dict(panels) if panels is not None else {}
+        if self.panels:
+            grouped = [code for members in self.panels.values() for code in members]
+            assert universe != [], "panels need an explicit universe"
+            assert all(code in universe for code in grouped), f"panel members {grouped} are not all in the universe"
+            assert len(grouped) == len(set(grouped)), "an instrument is a member of several panels"
+            assert all(group not in universe for group in self.panels), "panels are named like instruments"
+            assert len(frequencies) == 1, "panels are replayed at a single frequency"
+            assert not resume, "panel replays do not resume"
+        self.panel_engine = functools.partial(compute_panel, validation=dict(mode=validation, every=validation_every),
+                                              profile=self.profile_dir if profile else None, columns=self.columns)
+        features = {
+            'columns': self._features() + [f.name for f in vector_features],
+            'frequencies': [str(freq) for freq in frequencies],
+            'output': output,
+            'sparse_levels': sparse_levels,
+            'heartbeat': None if heartbeat is None else str(heartbeat),
+        }
+        if self.panels:
+            features['panels'] = self.panels
+        self.manifest = RunManifest(dest, features)
+        self.resume = resume
+        self.resumed = None # {code: last finished date or None} once resumed
 
     def compute_day(self):
         """
         computes one day worth of features and write to destination
         """
-        self._read_next_date()
-        all_carry_over = []
+        if self.resume and self.resumed is None:
+            self._resume()
+        if self.resumed is not None and len(self.dates) > 0 and len(self._pending(self.dates[0])) == 0:
+            self.date = self.dates.pop(0)
+            print(f"skipping {self.date}, finished in {self.manifest.path}")
+            return
+        if self.streaming:
+            self._stream_next_date()
+        else:
+            self._read_next_date()
+        self._write_headers()
+        if self.pool is None:
+            # workers own the book state from here on, self.ob_container only holds the initial state
+            # unless the previous date left a checkpoint
+            sampling = None
+            if self.profile_sampling is not None:
+                sampling = (self.profile_sampling, self.profile_dir)
+            self.pool = InstrumentWorkerPool(self.engine, self.max_workers, self.spool_dir, sampling=sampling)
+            for unit in self._units(self.universe):
+                if unit in self.panels:
+                    # a panel is pinned to one worker as a whole, with the state of every member
+                    members = self.panels[unit]
+                    states = [self._initial_state(code) for code in members]
+                    ob_handler = {code: state[0] for code, state in zip(members, states)}
+                    trade_handler = {code: state[1] for code, state in zip(members, states)}
+                    last = {code: state[2] for code, state in zip(members, states)}
+                    self.pool.add(unit, ob_handler, trade_handler, self.sinks[unit], last, self.panel_engine)
+                else:
+                    ob_handler, trade_handler, last = self._initial_state(unit)
+                    self.pool.add(unit, ob_handler, trade_handler, self.sinks[unit], last)
 
-        with ProcessPoolExecutor(max_workers=self.max_workers) as pool:
-            rs = []
-            for carry_over, code in zip(self.carry_over, self.universe):
-                rs += [pool.submit(
-                    compute_day,
-                    self.curr_data['l2'][code],
-                    self.curr_data['trades'][code],
-                    self.l2_col_mapping,
-                    self.l1_col_mapping,
-                    self.ob_container[code],
-                    self.trade_handler_container[code],
-                    self.dest_file_streams[code],
-                    self.buffer_size,
-                    carry_over
-                )]
+        profile = self._load_profile(self.date)
+        units = self._units(self._pending(self.date))
+        if self.streaming:
+            # the day is read as it is published, so the stream stage holds the loading as well
+            with profile.stage('stream') as counts:
+                for unit in units:
+                    self.pool.start_stream(unit, self.l2_col_mapping, self.l1_col_mapping, self.date)
+                for i, window in enumerate(self.curr_data['stream']):
+                    l2 = {code: frames[0] for code, frames in window.items()}
+                    trades = {code: frames[1] for code, frames in window.items()}
+                    for unit in units:
+                        self.pool.submit_window(unit, *self._unit_frames(unit, l2, trades), self.date, i)
+                        counts.rows += sum(l2[code].height for code in self._members(unit))
+                for unit in units:
+                    self.pool.end_stream(unit)
+        else:
+            with profile.stage('publish') as counts:
+                for unit in units:
+                    self.pool.submit(
+                        unit,
+                        *self._unit_frames(unit, self.curr_data['l2'], self.curr_data['trades']),
+                        self.l2_col_mapping,
+                        self.l1_col_mapping,
+                        self.date,
+                    )
+                    counts.rows += sum(self.curr_data['l2'][code].height for code in self._members(unit))
 
         # catch exceptions & print progress
-        for i, future in enumerate(as_completed(rs)):
-            try:
-                carry_over, accuracy = future.result()
-                print(f"finished {self.universe[i] + ' ' + self.date} with accuracy {accuracy}")
-                all_carry_over += [carry_over]
-                print(f"finished {self.universe[i] + ' ' + self.date}")
-            except Exception as exc:
-                print(f"failed {self.universe[i] + ' ' + self.date}")
-                print(exc)
+        finished = {}
+        with profile.stage('workers'):
+            for unit, date, accuracy, error in self.pool.wait(len(units)):
+                if error is None:
+                    print(f"finished {unit + ' ' + date} with accuracy {accuracy}")
+                    finished[unit] = accuracy
+                else:
+                    print(f"failed {unit + ' ' + date}, warming up again on the next date")
+                    print(error)
+                    self._resync(unit)
+
+        for unit, accuracy in finished.items():
+            ob_handler, trade_handler, last = self.pool.fetch_state(unit)
+            if unit not in self.panels:
+                # laid out like the state of a panel, per member
+                ob_handler, trade_handler = {unit: ob_handler}, {unit: trade_handler}
+                last, accuracy = {unit: last}, {unit: accuracy}
+            for code in self._members(unit):
+                save_checkpoint(self.checkpoint_dir, code, self.date, ob_handler[code], trade_handler[code], last[code])
+                # the unit is finished once its state is saved, the workers closed its output
+                self.manifest.record(code, self.date, self._source_files(self.date), accuracy[code],
+                                     self.sinks[unit].offsets())
+        self.manifest.save()
+        self._write_profile(self.date)
+
+    def compute_days_parallel(self, days: int) -> None:
+        """
+        replays the next days dates at once, one process per date (at most max_workers at a time)
+        a date starts from the checkpoint saved at the end of the previous date if that date is not part of this batch,
+        otherwise from empty books, picking every layer up at its first full OverlapRefresh (warmup)
+        outputs are stitched per instrument in date order
+        """
+        assert self.universe != [], "date parallel replay needs an explicit universe"
+        assert not self.panels, "panels are replayed by compute_day"
+        dates, self.dates = self.dates[:days], self.dates[days:]
+        if len(dates) == 0:
+            raise ValueError("No more data to be replayed")
+        self.close() # state held by the workers is in the checkpoints
+        if self.sinks is None:
+            self._init_sinks()
+        self._write_headers()
+
+        with ProcessPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = {}
+            for date in dates:
+                prev_date = self.prev_dates.get(date)
+                if prev_date in dates:
+                    prev_date = None # keep the output independent of scheduling
+                futures[pool.submit(_replay_date, self._task_copy(), date, prev_date)] = date
+
+            finished = {} # {(code, date): accuracy}
+            for future in as_completed(futures):
+                date = futures[future]
+                try:
+                    results = future.result()
+                except Exception:
+                    print(f"failed {date}")
+                    print(traceback.format_exc())
+                    continue
+                for code, accuracy, warmup, error in results:
+                    start = "warmup" if warmup else "checkpoint"
+                    if error is None:
+                        print(f"finished {code + ' ' + date} from {start} with accuracy {accuracy}")
+                        finished[(code, date)] = accuracy
+                    else:
+                        print(f"failed {code + ' ' + date}")
+                        print(error)
+
+        # date by date, so every finished unit is recorded with the offsets it ends at
+        for date in dates:
+            for code, sink in self.sinks.items():
+                sink.stitch([date])
+                if (code, date) in finished:
+                    self.manifest.record(code, date, self._source_files(date), finished[(code, date)], sink.offsets())
+        self.manifest.save()
+        self.date = dates[-1]
+
+    def run_node(self, coordinator: Coordinator, days: int, units: int = None, poll: float = 1.0) -> None:
+        """
+        replays (date, instrument) units of the next days dates as one of the nodes sharing coordinator's directory,
+        until every unit is done or out of attempts, see coordinator.py
+        like compute_days_parallel, a unit starts from the checkpoint of the previous date if that date is not planned,
+        otherwise it warms up, so any node may take any unit; checkpoint_dir and dest must be shared by the nodes
+        units are claimed up to units (by default max_workers) instruments of one date at a time, which is loaded once
+        every attempt of a unit is written to its own part (see sinks), which is promoted to the part of the unit
+        only if the node still holds the lease of the attempt when it completes, merge_units stitches the parts
+        """
+        assert self.universe != [], "distributed replay needs an explicit universe"
+        assert not self.panels, "panels are replayed by compute_day"
+        dates = self.dates[:days]
+        if len(dates) == 0:
+            raise ValueError("No more data to be replayed")
+        coordinator.plan(dates, self.universe)
+        self.close() # the state of every unit is in the checkpoints
+        units = units if units is not None else self.max_workers
+        while True:
+            claimed = coordinator.claim(units)
+            if len(claimed) == 0:
+                if coordinator.finished():
+                    break
+                time.sleep(poll) # the rest is leased by other nodes, whose leases may still expire
+                continue
+            date = claimed[0][0]
+            prev_date = self.prev_dates.get(date)
+            if prev_date in dates:
+                prev_date = None # keep the output independent of scheduling
+            task = self._task_copy()
+            task.universe = [code for _, code in claimed]
+            attempts = {code: coordinator.attempt(date, code) for _, code in claimed}
+            with coordinator.hold(claimed):
+                try:
+                    results = _replay_date(task, date, prev_date, attempts)
+                except Exception:
+                    results = [(code, None, None, traceback.format_exc()) for code in task.universe]
+            if self.sinks is None:
+                self._init_sinks()
+            for code, accuracy, warmup, error in results:
+                if error is None:
+                    promote = functools.partial(self.sinks[code].promote, date, attempts[code])
+                    if coordinator.complete(date, code, {'accuracy': accuracy, 'warmup': warmup}, promote):
+                        print(f"finished {code + ' ' + date} on {coordinator.node} with accuracy {accuracy}")
+                    else:
+                        print(f"dropped {code + ' ' + date} on {coordinator.node}, its lease was taken over")
+                else:
+                    coordinator.fail(date, code, error)
+                    print(f"failed {code + ' ' + date} on {coordinator.node}, attempt {coordinator.attempts(date, code)}")
+                    print(error)
+
+    def merge_units(self, coordinator: Coordinator) -> list:
+        """
+        stitches the parts of the done units of coordinator's plan into the output of every instrument, in date order:
+        the run of done dates that follows the last date merged before (see Coordinator.merged), so merges can be
+        repeated while the nodes are still running, the output of earlier merges is kept
+        returns the units that are not merged yet (not done, or after one that is not)
+        """
+        assert not self.panels, "panels are replayed by compute_day"
+        done = coordinator.done()
+        merged = coordinator.merged()
+        if self.sinks is None:
+            self._init_sinks()
+        left = []
+        for code, sink in self.sinks.items():
+            dates = [date for date, unit_code in coordinator.units() if unit_code == code]
+            dates = dates[dates.index(merged[code]) + 1:] if code in merged else dates
+            run = []
+            for date in dates:
+                if (date, code) not in done:
+                    break
+                run.append(date)
+            if run:
+                sink.stitch(run)
+                coordinator.record_merged(code, run[-1])
+            left += [(date, code) for date in dates[len(run):]]
+        return sorted(left)
+
+    def iter_events(self, code: str, dates: list = None, changes_only: bool = False, levels: int = 10):
+        """
+        event time replay of one instrument, for consumers of every book state such as backtesters
+        yields (timestamp, books, trade) after every message of the dates (by default the remaining ones,
+        which are not consumed), see handlers.iter_day_events, the books carry over from one date to the next
+        timestamp is in microseconds since epoch, books is the live {layer: book}, the same object at every step,
+        trade is (price, qty, aggressor side) or None, with changes_only l2 messages that left the first
+        levels of their book unchanged are skipped
+        """
+        books = self.columns.books(code, self.orderbook)
+        for date in (self.dates if dates is None else dates):
+            if len(self.ob_container) == 0:
+                self.date = date # the first load initialises the replayer with the date
+            l2, trades = self._load_messages(date)
+            assert code in l2, f"{code} is not in the universe"
+            yield from iter_day_events(l2[code], trades[code], L2_REPLAY_COLUMNS, books, changes_only, levels)
+
+    def _task_copy(self):
+        # what a date parallel task needs, without any of the state of this process
+        task = copy.copy(self)
+        task.pool = None
+        task.prefetcher = None
+        task.curr_data = {}
+        task.load_profiles = {}
+        task.ob_container = {}
+        task.sinks = None
+        return task
+
+    def _write_headers(self) -> None:
+        if not self.headers_written:
+            for code, sink in self.sinks.items():
+                date = self._resumed_date(code)
+                if date is None:
+                    sink.write_header()
+                    self.manifest.units.pop(code, None) # the output starts over
+                else:
+                    # whatever a crashed run wrote after the unit is dropped
+                    sink.rollback(self.manifest.offsets(code, date))
+            self.headers_written = True
+
+    def _resume(self) -> None:
+        # the last finished unit every instrument resumes after, the manifest forgets the units to be redone
+        def resumable(code):
+            return lambda date: os.path.exists(checkpoint_path(self.checkpoint_dir, code, date))
+        self.resumed = {
+            code: self.manifest.resume(code, self.dates, self._source_files, resumable(code))
+            for code in self.universe
+        }
+        self.manifest.save()
+        for code, date in self.resumed.items():
+            if date is not None:
+                print(f"resuming {code} after {date}")
+
+    def _resumed_date(self, code):
+        return None if self.resumed is None else self.resumed[code]
 
-        self.carry_over = all_carry_over
+    def _pending(self, date) -> list:
+        # instruments of the universe with date still to be replayed
+        return [code for code in self.universe if self._resumed_date(code) is None or date > self.resumed[code]]
 
+    def _units(self, codes) -> list:
+        # what the workers replay for codes: the panels with a member among them and every instrument of no panel
+        grouped = {code for members in self.panels.values() for code in members}
+        panels = [group for group, members in self.panels.items() if any(code in codes for code in members)]
+        return panels + [code for code in codes if code not in grouped]
+
+    def _members(self, unit) -> list:
+        return self.panels.get(unit, [unit])
+
+    def _unit_frames(self, unit, l2: dict, trades: dict) -> tuple:
+        # the frames of a unit, those of a panel's members stacked (see panel.stack_members)
+        if unit in self.panels:
+            return stack_members(l2, self.panels[unit]), stack_members(trades, self.panels[unit])
+        return l2[unit], trades[unit]
+
+    def _resync(self, unit) -> None:
+        # the books of a failed day are half applied, the unit starts over from empty books and warms up,
+        # its failed date has neither checkpoint nor manifest record
+        features = self._features()
+        ob_handler = {code: self.columns.books(code, self.orderbook) for code in self._members(unit)}
+        trade_handler = {code: TradesHandler(code, self.freq, self.trade_stats, features) for code in self._members(unit)}
+        if unit not in self.panels:
+            ob_handler, trade_handler = ob_handler[unit], trade_handler[unit]
+        self.pool.resync(unit, ob_handler, trade_handler)
+
+    def _initial_state(self, code) -> tuple:
+        # (ob_handler, trade_handler, last) code starts the pool with, from the checkpoint of the date before if any
+        prev_date = self._resumed_date(code) or self.prev_dates.get(self.date)
+        state = load_checkpoint(self.checkpoint_dir, code, prev_date, self.columns.layers)
+        if state is None:
+            state = (self.ob_container[code], self.trade_handler_container[code], None)
+        return state
+
+    def _load_profile(self, date) -> StageProfile:
+        # stages of the loading of a date, only kept when profiling
+        profile = self.load_profiles.get(date)
+        if profile is None:
+            profile = StageProfile(date)
+            if self.profile:
+                self.load_profiles[date] = profile
+        return profile
+
+    def _write_profile(self, date) -> None:
+        if self.profile:
+            write_day_report(self.profile_dir, date, self._load_profile(date), self._units(self.universe))
+            self.load_profiles.pop(date)
+
+    def close(self) -> None:
+        """
+        shuts down the worker processes and drops the prefetched dates
+        """
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+    def cache_day(self) -> None:
+        """
+        preprocesses the next date into the day cache without replaying it
+        """
+        assert self.cache is not None, "no cache directory configured"
+        self._read_next_date()
+        self._write_profile(self.date)
 
     def _read_next_date(self) -> None:
         # read next date's data
@@ -99,232 +583,297 @@ class Replayer:
             self.date = self.dates.pop(0)
         except:
             raise ValueError("No more data to be replayed")
-        date, directory, eid = self.date, self.dir, self.eid
 
-        # load l2 data
         self.curr_data.clear()
-        self.curr_data['date'] = date
-        self.curr_data['l2'] = (
-            pl.scan_csv(
-                os.path.join(directory, "l2_data", f"{date}_{eid}_L2.csv.gz"),
-                schema=L2_SCHEMA,
-                low_memory=True,
-            )
-            .filter(pl.col("Code").is_in(self.universe))
-            .collect()
-        )
+        self.curr_data['date'] = self.date
+        if self.prefetcher is not None and len(self.ob_container) > 0:
+            self.curr_data['l2'], self.curr_data['trades'], profile = self.prefetcher.get(self.date)
+            if self.profile:
+                self.load_profiles[self.date] = profile
+        else:
+            # the first date sets the universe and the handlers up, always on this thread
+            self.curr_data['l2'], self.curr_data['trades'] = self._fetch_date(self.date)
+            if self.prefetcher is not None:
+                self.prefetcher.loaded((self.curr_data['l2'], self.curr_data['trades']))
+        if self.prefetcher is not None:
+            # the next dates load in the background while this one is replayed
+            self.prefetcher.schedule(self.dates)
+        self.time = datetime.datetime.strptime(self.date, "%Y-%m-%d") - datetime.timedelta(hours=2)
 
-        # load l1 data
-        self.curr_data['trades'] = (
-            pl.scan_csv(
-                os.path.join(directory, "l1_data", f"{date}_{eid}_L1-Trades.csv.gz"),
-                schema=L1_SCHEMA,
-                low_memory=True,
-            )
-            .filter(pl.col("Code").is_in(self.universe))
-            .collect()
-        )
+        if self.l2_col_mapping is None:
+            self.l2_col_mapping = {col: i for i, col in enumerate(self.curr_data['l2'][self.universe[0]].columns[1:])}
+            self.l1_col_mapping = {col: i for i, col in enumerate(self.curr_data['trades'][self.universe[0]].columns[1:])}
+            # the first column is the timestamp, which is not in the schema
 
-        # filter out instruments not in the universe
-        if self.universe != []:
-            self.curr_data['l2'] = self.curr_data['l2'].filter(
-                pl.col('Code').is_in(self.universe) | pl.col('Code').eq('blank')
-            )
-            self.curr_data['trades'] = self.curr_data['trades'].filter(
-                pl.col('Code').is_in(self.universe) | pl.col('Code').eq('blank')
-            )
+        shapes = [self.curr_data['l2'][code].shape[0] for code in self.universe]
+        assert len(set(shapes)) == 1, f"l2 dataframes have different shapes: {shapes}"
+        shapes = [self.curr_data['trades'][code].shape[0] for code in self.universe]
+        assert len(set(shapes)) == 1, f"l1 dataframes have different shapes: {shapes}"
 
-        # cast the string timestamps to datetime objects
-        self.curr_data['l2'] = self.curr_data['l2'].with_columns(
-            Timestamp = pl.coalesce(
-            ['DeltaRefresh_ServerTimestamp',
-             'OverlapRefresh_ServerTimestamp'])
-            .str.split(".")
-            .list
-            .first()
-            .cast(pl.Int64)
-            .cast(pl.Datetime)
-            .dt.with_time_unit("us")
-            .backward_fill() # backward fill to fill the None values in timestamps
-            # Note: we can do it because only max_visible_depth messages have None timestamps
-            # and they do not affect the order book
-        )
-        self.curr_data['trades'] = self.curr_data['trades'].with_columns(
-            pl.col('ServerTimestamp').cast(pl.Int64)
-            .cast(pl.Datetime)
-            .dt.with_time_unit("us")
-            .alias("Timestamp")
+        print(f"finished preprocessing for date {self.date}")
+
+    def _stream_next_date(self) -> None:
+        # like _read_next_date, but only sets up the stream of the date, which is read as the workers consume it
+        try:
+            self.date = self.dates.pop(0)
+        except:
+            raise ValueError("No more data to be replayed")
+
+        self.curr_data.clear()
+        self.curr_data['date'] = self.date
+        if len(self.ob_container) == 0:
+            self.init_params()
+        self.time = datetime.datetime.strptime(self.date, "%Y-%m-%d") - datetime.timedelta(hours=2)
+        self.curr_data['stream'] = DayStream(
+            *self._source_files(self.date),
+            self.universe,
+            self.time,
+            self.freq,
+            L2_REPLAY_COLUMNS,
+            L1_REPLAY_COLUMNS,
+            self.window_buckets,
+            self.chunk_bytes,
+            layers=self.columns.layers if self.columns.filters() else None,
         )
+        # the windows are laid out like the collected frames
+        self.l2_col_mapping = {col: i for i, col in enumerate(L2_REPLAY_COLUMNS)}
+        self.l1_col_mapping = {col: i for i, col in enumerate(L1_REPLAY_COLUMNS)}
+
+    def _source_files(self, date) -> list:
+        return [
+            os.path.join(self.dir, "l2_data", f"{date}_{self.eid}_L2.csv.gz"),
+            os.path.join(self.dir, "l1_data", f"{date}_{self.eid}_L1-Trades.csv.gz"),
+        ]
 
-        print(f"finished loading data for {self.date}")
+    def _fetch_date(self, date, profile: StageProfile = None) -> tuple:
+        # ({code: l2 frame}, {code: l1 frame}) of a date, from the cache or parsed from the csv.gz files
+        # only reads the state of the replayer once the universe is known, so it can run in the prefetcher
+        if profile is None:
+            profile = self._load_profile(date)
+        if self.cache is not None:
+            with profile.stage('cache_load'):
+                hit = self._load_cached_date(date)
+            if hit is not None:
+                return hit
+        full_universe = self.universe == [] # inferred from this date, which then is loaded whole
+        l2, trades = self._load_date(date, profile)
+        if self.cache is not None:
+            with profile.stage('cache_store'):
+                self.cache.store(self.eid, date, self.freq, l2, trades, self._source_files(date), full_universe)
+        return l2, trades
 
+    def _prefetch_date(self, date) -> tuple:
+        # _fetch_date on a prefetch thread: the universe and the handlers are set up by then, and the stages are
+        # timed into a profile of their own, which _read_next_date keeps on the main thread
+        assert len(self.ob_container) > 0, "only dates after the first one are prefetched"
+        profile = StageProfile(date)
+        return *self._fetch_date(date, profile), profile
+
+    def _load_cached_date(self, date):
+        hit = self.cache.load(self.eid, date, self.freq, self.universe, self._source_files(date))
+        if hit is None:
+            return None
+        codes, l2, trades = hit
         if len(self.ob_container) == 0:
+            self.universe = codes
             self.init_params()
-        l2_schema = copy.deepcopy(L2_SCHEMA)
-        l2_schema['Timestamp'] = pl.Datetime
-        l1_schema = copy.deepcopy(L1_SCHEMA)
-        l1_schema['Timestamp'] = pl.Datetime
-        self.time = datetime.datetime.strptime(date, "%Y-%m-%d") - datetime.timedelta(hours=2)
+        print(f"loaded {date} from cache")
+        return l2, trades
+
+    def _read_csv(self, path, schema, columns) -> pl.DataFrame:
+        # pgzip decompresses files written by pgzip in parallel blocks, plain gzip in one thread
+        with pgzip.open(path, 'rb', thread=self.decompress_threads) as f:
+            data = pl.read_csv(f.read(), schema=schema, columns=columns)
+        if self.universe == []:
+            return data # the universe is inferred from the whole first date
+        return data.filter(pl.col("Code").is_in(self.universe))
+
+    def _load_messages(self, date, profile: StageProfile = None) -> tuple:
+        # ({code: l2 messages}, {code: l1 messages}) of a date in the message format of data_schema, not bucketed
+        # the time of every step goes to profile
+        if profile is None:
+            profile = StageProfile(date)
+        l2_path, l1_path = self._source_files(date)
+
+        # load l2 and l1 data, both files are decompressed at the same time
+        with profile.stage('csv_scan') as counts:
+            with ThreadPoolExecutor(max_workers=2) as readers:
+                l2 = readers.submit(self._read_csv, l2_path, L2_SCHEMA, L2_SOURCE_COLUMNS)
+                trades = readers.submit(self._read_csv, l1_path, L1_SCHEMA, L1_SOURCE_COLUMNS)
+                l2, trades = l2.result(), trades.result()
+
+            # filter out instruments not in the universe
+            if self.universe != []:
+                l2 = l2.filter(
+                    pl.col('Code').is_in(self.universe) | pl.col('Code').eq('blank')
+                )
+                trades = trades.filter(
+                    pl.col('Code').is_in(self.universe) | pl.col('Code').eq('blank')
+                )
+            counts.rows = counts.messages = l2.height + trades.height
+
+        print(f"finished loading data for {date}")
+
+        if len(self.ob_container) == 0:
+            self.curr_data['l2'] = l2
+            self.init_params()
+
+        # encode the messages once for the whole day: integer codes, timestamps in microseconds since epoch
+        # and parsed OverlapRefresh limits instead of the strings the handlers would decode message by message
+        with profile.stage('encode') as counts:
+            l2 = encode_l2(l2, self.universe).with_columns(
+                pl.col('Timestamp')
+                .backward_fill() # backward fill to fill the None values in timestamps
+                # Note: we can do it because only max_visible_depth messages have None timestamps
+                # and they do not affect the order book
+            )
+            trades = encode_l1(trades, self.universe)
+            if self.columns.filters():
+                # the books of the other layers are never kept, their messages are dropped before bucketing,
+                # after the backward fill since a MaxVisibleDepth message takes the time of the next message of any layer
+                l2 = l2.filter(pl.col('LayerId').is_in(self.columns.layers) | pl.col('LayerId').is_null())
+            counts.rows = counts.messages = l2.height + trades.height
+        time = datetime.datetime.strptime(date, "%Y-%m-%d") - datetime.timedelta(hours=2)
         blank_update = copy.deepcopy(self.blank_update_template)
         blank_trade = copy.deepcopy(self.blank_trade_template)
-        self._insert_to_end(blank_update, blank_trade, l2_schema, l1_schema, date)
-        self._insert_to_start(blank_update, blank_trade, l2_schema, l1_schema)
+        with profile.stage('blank_insertion') as counts:
+            l2, trades = self._insert_to_end(l2, trades, blank_update, blank_trade, l2.schema, trades.schema, time)
+            l2, trades = self._insert_to_start(l2, trades, blank_update, blank_trade, l2.schema, trades.schema, time)
+            counts.rows = counts.messages = l2.height + trades.height
 
-        print(f"finished blank l1/l2 message insertion for {self.date}")
+        print(f"finished blank l1/l2 message insertion for {date}")
 
         # sanity check
-        msg = f"l2 and l1 dataframes have different min timestamps: {self.curr_data['l2']['Timestamp'].min()},\
-                {self.curr_data['trades']['Timestamp'].min()}"
-        assert self.curr_data['l2']['Timestamp'].min() == self.curr_data['trades']['Timestamp'].min() == self.time, msg
-        msg = f"l2 and l1 dataframes have different max timestamps: {self.curr_data['l2']['Timestamp'].max()},\
-                {self.curr_data['trades']['Timestamp'].max()}"
-        assert self.curr_data['l2']['Timestamp'].max() == self.curr_data['trades']['Timestamp'].max()\
-                == self.time + datetime.timedelta(hours=24) - self.freq / 100, msg
+        msg = f"l2 and l1 dataframes have different min timestamps: {l2['Timestamp'].min()},\
+                {trades['Timestamp'].min()}"
+        assert l2['Timestamp'].min() == trades['Timestamp'].min() == time, msg
+        msg = f"l2 and l1 dataframes have different max timestamps: {l2['Timestamp'].max()},\
+                {trades['Timestamp'].max()}"
+        assert l2['Timestamp'].max() == trades['Timestamp'].max()\
+                == time + datetime.timedelta(hours=24) - self.freq / 100, msg
 
 
         # partition all data by instrument for parallel processing
-        self.curr_data['l2'] = self.curr_data['l2'].partition_by(
-            by='Code',
-            maintain_order=True,
-            include_key=True,
-            as_dict=True
-        )
-        self.curr_data['l2'] = {
-            code[0]: data
-            for code, data in self.curr_data["l2"].items()
-        }
-        self.curr_data['trades'] = self.curr_data['trades'].partition_by(
-            by='Code',
-            maintain_order=True,
-            include_key=True,
-            as_dict=True
-        )
-        self.curr_data["trades"] = {
-            code[0]: data
-            for code, data in self.curr_data["trades"].items()
-        }
+        with profile.stage('partition') as counts:
+            counts.rows = counts.messages = l2.height + trades.height
+            l2 = l2.partition_by(
+                by='Code',
+                maintain_order=True,
+                include_key=True,
+                as_dict=True
+            )
+            l2 = {
+                code[0]: data
+                for code, data in l2.items()
+            }
+            trades = trades.partition_by(
+                by='Code',
+                maintain_order=True,
+                include_key=True,
+                as_dict=True
+            )
+            trades = {
+                code[0]: data
+                for code, data in trades.items()
+            }
+
+        print(f"finished partitioning by instrument code for {date}")
+        return l2, trades
 
-        print(f"finished partitioning by instrument code for {self.date}")
+    def _load_date(self, date, profile: StageProfile = None) -> tuple:
+        if profile is None:
+            profile = StageProfile(date)
+        l2, trades = self._load_messages(date, profile)
 
         # aggregating and upsampling to make the data time uniform
         # each row in the dataframe is a collection of messages that happened in this interval
-        for code in self.universe:
-            self.curr_data['l2'][code] = self.curr_data['l2'][code].group_by_dynamic(
-                    index_column="Timestamp",
-                    every=self.freq,
-                    include_boundaries=True,
-                    closed='left',
-                ).agg(
-                    pl.col("LayerId"),
-                    pl.col('Code'),
-                    pl.col('OverlapRefresh_BidChangeIndicator'),
-                    pl.col('OverlapRefresh_AskChangeIndicator'),
-                    pl.col('OverlapRefresh_BidLimits'),
-                    pl.col('OverlapRefresh_AskLimits'),
-                    pl.col('MaxVisibleDepth_MaxVisibleDepth'),
-                    pl.col('DeltaRefresh_DeltaAction'),
-                    pl.col('DeltaRefresh_CumulatedUnits'),
-                    pl.col('DeltaRefresh_Level'),
-                    pl.col('DeltaRefresh_Price'),
-                ).select(
-                    pl.col("LayerId"),
-                    pl.col('Code'),
-                    pl.col('OverlapRefresh_BidChangeIndicator'),
-                    pl.col('OverlapRefresh_AskChangeIndicator'),
-                    pl.col('OverlapRefresh_BidLimits'),
-                    pl.col('OverlapRefresh_AskLimits'),
-                    pl.col('MaxVisibleDepth_MaxVisibleDepth'),
-                    pl.col('DeltaRefresh_DeltaAction'),
-                    pl.col('DeltaRefresh_CumulatedUnits'),
-                    pl.col('DeltaRefresh_Level'),
-                    pl.col('DeltaRefresh_Price'),
-                    pl.col('_upper_boundary').alias('Timestamp'),
-                ).upsample(
-                    time_column="Timestamp",
-                    every=self.freq
-                )
-            self.curr_data['trades'][code] = self.curr_data['trades'][code].group_by_dynamic(
-                    index_column="Timestamp",
-                    every=self.freq,
-                    include_boundaries=True,
-                    closed='left',
-                ).agg(
-                    pl.col("TradeEvent_LastPrice"),
-                    pl.col("TradeEvent_LastTradeQuantity"),
-                    pl.col("Code"),
-                ).select(
-                    pl.col("_upper_boundary").alias("Timestamp"),
-                    pl.col("TradeEvent_LastPrice"),
-                    pl.col("TradeEvent_LastTradeQuantity"),
-                    pl.col("Code")
-                ).upsample(
-                    time_column="Timestamp",
-                    every=self.freq
-                )
-
-        if self.l2_col_mapping is None:
-            self.l2_col_mapping = {col: i for i, col in enumerate(self.curr_data['l2'][self.universe[0]].columns[1:])}
-            self.l1_col_mapping = {col: i for i, col in enumerate(self.curr_data['trades'][self.universe[0]].columns[1:])}
-            # the first column is the timestamp, which is not in the schema
-
-        shapes = [self.curr_data['l2'][code].shape[0] for code in self.universe]
-        assert len(set(shapes)) == 1, f"l2 dataframes have different shapes: {shapes}"
-        shapes = [self.curr_data['trades'][code].shape[0] for code in self.universe]
-        assert len(set(shapes)) == 1, f"l1 dataframes have different shapes: {shapes}"
-
-        print(f"finished preprocessing for date {self.date}")
+        with profile.stage('group_by_dynamic') as counts:
+            for code in self.universe:
+                counts.messages += l2[code].height + trades[code].height
+                l2[code] = l2[code].group_by_dynamic(
+                        index_column="Timestamp",
+                        every=self.freq,
+                        include_boundaries=True,
+                        closed='left',
+                    ).agg(
+                        L2_REPLAY_COLUMNS
+                    ).select(
+                        *L2_REPLAY_COLUMNS,
+                        pl.col('_upper_boundary').alias('Timestamp'),
+                    ).upsample(
+                        time_column="Timestamp",
+                        every=self.freq
+                    )
+                trades[code] = trades[code].group_by_dynamic(
+                        index_column="Timestamp",
+                        every=self.freq,
+                        include_boundaries=True,
+                        closed='left',
+                    ).agg(
+                        L1_REPLAY_COLUMNS
+                    ).select(
+                        pl.col("_upper_boundary").alias("Timestamp"),
+                        *L1_REPLAY_COLUMNS,
+                    ).upsample(
+                        time_column="Timestamp",
+                        every=self.freq
+                    )
+                counts.rows += l2[code].height
+        return l2, trades
 
-    def _insert_to_end(self, blank_update, blank_trade, l2_schema, l1_schema, date):
+    def _insert_to_end(self, l2, trades, blank_update, blank_trade, l2_schema, l1_schema, time):
         # insert a blank message to end of trades/l2 data
         # to ensure uniform sampling
-        self.curr_data['l2'] = self.curr_data['l2'].set_sorted(
+        l2 = l2.set_sorted(
             'Timestamp',
             descending=False
         ).filter(
-            pl.col('Timestamp') < self.time + datetime.timedelta(days=1)
+            pl.col('Timestamp') < time + datetime.timedelta(days=1)
         )
-        eod_time = [self.time + datetime.timedelta(days=1) - self.freq/100]
+        eod_time = [time + datetime.timedelta(days=1) - self.freq/100]
         blank_trade['Timestamp'] = eod_time * len(self.universe)
         blank_update['Timestamp'] = eod_time * len(self.universe)
-        self.curr_data['trades'] = pl.concat([
-                self.curr_data['trades'],
-                pl.DataFrame(blank_trade, schema_overrides=l1_schema),
+        trades = pl.concat([
+                trades,
+                pl.DataFrame(blank_trade, schema=l1_schema),
             ]).set_sorted(
                 column='Timestamp',
                 descending=False
             )
-        self.curr_data['l2'] = pl.concat([
-                self.curr_data['l2'],
-                pl.DataFrame(blank_update, schema_overrides=l2_schema),
+        l2 = pl.concat([
+                l2,
+                pl.DataFrame(blank_update, schema=l2_schema),
             ]).set_sorted(
                 column='Timestamp',
                 descending=False
             )
+        return l2, trades
 
-    def _insert_to_start(self, blank_update, blank_trade, l2_schema, l1_schema):
+    def _insert_to_start(self, l2, trades, blank_update, blank_trade, l2_schema, l1_schema, time):
         # insert a blank message to start of trades/l2 data
-        self.curr_data['l2'] = self.curr_data['l2'].set_sorted(
+        l2 = l2.set_sorted(
             column='Timestamp',
             descending=False
         ).filter(
-            pl.col('Timestamp') >= self.time
+            pl.col('Timestamp') >= time
         )
-        blank_update['Timestamp'] = [self.time] * len(self.universe)
-        blank_trade['Timestamp'] = [self.time] * len(self.universe)
-        self.curr_data['l2'] = pl.concat([
-            pl.DataFrame(blank_update, schema_overrides=l2_schema),
-            self.curr_data['l2'],
+        blank_update['Timestamp'] = [time] * len(self.universe)
+        blank_trade['Timestamp'] = [time] * len(self.universe)
+        l2 = pl.concat([
+            pl.DataFrame(blank_update, schema=l2_schema),
+            l2,
         ]).set_sorted(
             column='Timestamp',
             descending=False
         )
-        self.curr_data['trades'] = pl.concat([
-            pl.DataFrame(blank_trade, schema_overrides=l1_schema),
-            self.curr_data['trades'],
+        trades = pl.concat([
+            pl.DataFrame(blank_trade, schema=l1_schema),
+            trades,
         ]).set_sorted(
             column='Timestamp',
             descending=False
         )
+        return l2, trades
 
     def __repr__(self) -> str:
         return f"Replayer({self.dir}, {self.eid}, {self.freq})"
@@ -333,7 +882,6 @@ class Replayer:
         if self.universe == []:
             self.universe = self.curr_data['l2']['Code'].unique().to_list()
             self.universe = [code for code in self.universe if code != 'blank']
-        self.carry_over = [None] * len(self.universe)
         self.blank_update_template['Code'] = copy.deepcopy(self.universe)
         self.blank_trade_template['Code'] = copy.deepcopy(self.universe)
         for key in self.blank_trade_template.keys():
@@ -342,29 +890,41 @@ class Replayer:
         for key in self.blank_update_template.keys():
             if key != 'Code':
                 self.blank_update_template[key] = [None] * len(self.universe)
-        self.ob_container = {
-            code: {
-                str(layer): LocalOrderBook(code) 
-                for layer in range(6)
-            } 
-            for code in self.universe
+        self.ob_container = {code: self.columns.books(code, self.orderbook) for code in self.universe}
+        features = self._features()
+        self.trade_handler_container = {
+            code: TradesHandler(code, self.freq, self.trade_stats, features) for code in self.universe
         }
-        self.trade_handler_container = {code: TradesHandler(code, self.freq) for code in self.universe}
         self.time = datetime.datetime.strptime(self.date, "%Y-%m-%d") - datetime.timedelta(hours=2)
-        self.dest_file_streams = {
-            code: os.path.join(self.dest, f"{code}.csv")
-            for code in self.universe
-        }
-        print(f"universe: {list(self.dest_file_streams.keys())}")
-        orderbook_cols = [f'bid_price_{i}' for i in range(10)] + [f'bid_qty_{i}' for i in range(10)] +\
-                     [f'ask_price_{i}' for i in range(10)] + [f'ask_qty_{i}' for i in range(10)]
-        orderbooks = [f"layer_{layer}_{col}" for col in orderbook_cols for layer in range(6)]
-        features = orderbooks + ['open', 'high', 'low', 'close', 'volume', 'amount'] +\
-                   all_features + ['timestamp']
-        features = ','.join(features)
-        for dest in self.dest_file_streams.values():
-            with open(dest, 'w+') as dest:
-                dest.write(f"{features}\n")
+        self._init_sinks()
+
+    def _features(self) -> list:
+        # same order as the snapshots are laid out by compute_day: layer by layer
+        return snapshot_columns(trade_stats=self.trade_stats, spec=self.columns) + all_features
+
+    def _init_sinks(self):
+        # {unit: sink}, the members of a panel are only written to the panel's sink
+        features = self._features()
+        self.sinks = {code: self._make_sinks(code, features) for code in self._units(self.universe)
+                      if code not in self.panels}
+        for group, members in self.panels.items():
+            self.sinks[group] = make_sink('ipc' if self.output == 'ipc' else 'parquet', os.path.join(self.dest, "panels"),
+                                          group, panel_columns(members, features), self.buffer_size, self.batch_rows)
+        print(f"universe: {self.universe}, panels: {self.panels}" if self.panels else f"universe: {list(self.sinks.keys())}")
+
+    def _make_sinks(self, code, features):
+        if len(self.frequencies) == 1:
+            return make_sink(self.output, self.dest, code, features, self.buffer_size, self.batch_rows, vector_features,
+                             self.sparse_levels, self.freq, self.heartbeat)
+        sinks = {}
+        for freq in self.frequencies:
+            dest = os.path.join(self.dest, frequency_label(freq))
+            os.makedirs(dest, exist_ok=True)
+            sinks[freq] = make_sink(self.output, dest, code, features, self.buffer_size, self.batch_rows, vector_features,
+                                    self.sparse_levels, freq, self.heartbeat)
+        # the replayed rows go to the finest frequency's sink, the coarser ones are taken off them
+        sink = sinks.pop(self.freq)
+        return ResampleSink(sink, features, sinks, self.trade_stats)
 
     def list_dates(self, data_dir) -> list:
         assert os.path.isdir(data_dir), f"{data_dir} is not a directory"
@@ -374,5 +934,42 @@ class Replayer:
                 dates.add(file.split('_')[0])
         self.time = datetime.datetime.strptime(min(dates), "%Y-%m-%d")
         dates = sorted(list(dates))
+        self.prev_dates = dict(zip(dates[1:], dates[:-1]))
         dates = [d for d in dates if d >= self.start]
         return dates
+
+
+def _replay_date(replayer: Replayer, date: str, prev_date: str, attempts: dict = None) -> list:
+    # one date of Replayer.compute_days_parallel, runs in a child process on its own copy of the replayer
+    # attempts are {code: attempt name} of the units of Replayer.run_node, each written apart until promoted
+    replayer.dates = [date]
+    replayer._read_next_date()
+    results = []
+    for code in replayer.universe:
+        state = load_checkpoint(replayer.checkpoint_dir, code, prev_date, replayer.columns.layers)
+        warmup = state is None
+        if warmup:
+            state = (replayer.ob_container[code], replayer.trade_handler_container[code], None)
+        ob_handler, trade_handler, last = state
+        sink = replayer.sinks[code]
+        sink.date = date
+        sink.parts = True
+        sink.attempt = attempts[code] if attempts is not None else None
+        try:
+            last, accuracy = replayer.engine(
+                replayer.curr_data['l2'][code],
+                replayer.curr_data['trades'][code],
+                replayer.l2_col_mapping,
+                replayer.l1_col_mapping,
+                ob_handler,
+                trade_handler,
+                sink,
+                last,
+                warmup,
+            )
+            save_checkpoint(replayer.checkpoint_dir, code, date, ob_handler, trade_handler, last)
+            results.append((code, accuracy, warmup, None))
+        except Exception:
+            results.append((code, None, warmup, traceback.format_exc()))
+    replayer._write_profile(date)
+    return results
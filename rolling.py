@@ -0,0 +1,227 @@
+"""
+online operators for per tick features, every update is O(1) whatever the window
+update(x) feeds the value of the current tick and returns the operator's value after it,
+missing values (None or nan) are skipped by every operator but still move the window
+"""
+import math
+from collections import deque
+
+
+def _missing(x) -> bool:
+    return x is None or x != x
+
+
+def _neumaier(total: float, comp: float, x: float) -> tuple:
+    # compensated (Neumaier) summation: the rounding error of every addition is carried in comp,
+    # so total + comp stays accurate however many values went in and out of a window
+    t = total + x
+    if abs(total) >= abs(x):
+        comp += (total - t) + x
+    else:
+        comp += (x - t) + total
+    return t, comp
+
+
+class RollingSum:
+
+    __slots__ = ('window', 'values', 'sum', 'comp', 'count')
+
+    def __init__(self, window: int) -> None:
+        assert window > 0, "window must be positive"
+        self.window = window
+        self.values = deque(maxlen=window) # nan for missing values
+        self.sum = 0.0
+        self.comp = 0.0 # rounding error of sum, see _neumaier
+        self.count = 0 # valid values in the window
+
+    def update(self, x) -> float:
+        x = math.nan if _missing(x) else float(x)
+        if len(self.values) == self.window:
+            old = self.values[0]
+            if old == old:
+                self._remove(old)
+        self.values.append(x)
+        if x == x:
+            self._add(x)
+        return self.value
+
+    def _add(self, x: float) -> None:
+        self.sum, self.comp = _neumaier(self.sum, self.comp, x)
+        self.count += 1
+
+    def _remove(self, x: float) -> None:
+        self.count -= 1
+        if self.count == 0:
+            # an empty window sums to zero exactly
+            self.sum = self.comp = 0.0
+        else:
+            self.sum, self.comp = _neumaier(self.sum, self.comp, -x)
+
+    @property
+    def value(self) -> float:
+        return self.sum + self.comp if self.count > 0 else math.nan
+
+
+class RollingMean(RollingSum):
+
+    __slots__ = ()
+
+    @property
+    def value(self) -> float:
+        return (self.sum + self.comp) / self.count if self.count > 0 else math.nan
+
+
+class RollingVar(RollingSum):
+
+    """
+    sample variance (ddof 1) over the window
+    from compensated sums of the deviations from a shift (the first value of the window when it was last empty),
+    so the sum of squares does not cancel out for values far from zero, such as prices
+    """
+
+    __slots__ = ('shift', 'dev', 'dev_comp', 'sq', 'sq_comp')
+
+    def __init__(self, window: int) -> None:
+        super().__init__(window)
+        self.shift = None
+        self.dev = self.dev_comp = 0.0
+        self.sq = self.sq_comp = 0.0
+
+    def _add(self, x: float) -> None:
+        super()._add(x)
+        if self.shift is None:
+            self.shift = x
+        d = x - self.shift
+        self.dev, self.dev_comp = _neumaier(self.dev, self.dev_comp, d)
+        self.sq, self.sq_comp = _neumaier(self.sq, self.sq_comp, d * d)
+
+    def _remove(self, x: float) -> None:
+        super()._remove(x)
+        if self.count == 0:
+            self.shift = None
+            self.dev = self.dev_comp = 0.0
+            self.sq = self.sq_comp = 0.0
+            return
+        d = x - self.shift
+        self.dev, self.dev_comp = _neumaier(self.dev, self.dev_comp, -d)
+        self.sq, self.sq_comp = _neumaier(self.sq, self.sq_comp, -d * d)
+
+    @property
+    def value(self) -> float:
+        if self.count < 2:
+            return math.nan
+        dev = self.dev + self.dev_comp
+        return max(self.sq + self.sq_comp - dev * dev / self.count, 0.0) / (self.count - 1)
+
+
+class EWMA:
+
+    """
+    exponentially weighted moving average, by alpha or by halflife in ticks
+    """
+
+    __slots__ = ('alpha', 'value')
+
+    def __init__(self, alpha: float = None, halflife: float = None) -> None:
+        assert (alpha is None) != (halflife is None), "give either alpha or halflife"
+        self.alpha = alpha if alpha is not None else 1 - 0.5 ** (1 / halflife)
+        self.value = math.nan
+
+    def update(self, x) -> float:
+        if not _missing(x):
+            self.value = float(x) if self.value != self.value else self.value + self.alpha * (float(x) - self.value)
+        return self.value
+
+
+class RollingMin:
+
+    """
+    minimum over the window, from a monotonic deque of (tick, value)
+    """
+
+    __slots__ = ('window', 'tick', 'candidates')
+
+    sign = 1.0
+
+    def __init__(self, window: int) -> None:
+        assert window > 0, "window must be positive"
+        self.window = window
+        self.tick = 0
+        self.candidates = deque() # increasing values (decreasing for RollingMax), oldest first
+
+    def update(self, x) -> float:
+        if not _missing(x):
+            x = self.sign * float(x)
+            while self.candidates and self.candidates[-1][1] >= x:
+                self.candidates.pop()
+            self.candidates.append((self.tick, x))
+        while self.candidates and self.candidates[0][0] <= self.tick - self.window:
+            self.candidates.popleft()
+        self.tick += 1
+        return self.value
+
+    @property
+    def value(self) -> float:
+        return self.sign * self.candidates[0][1] if self.candidates else math.nan
+
+
+class RollingMax(RollingMin):
+
+    __slots__ = ()
+
+    sign = -1.0
+
+
+class OrderFlowImbalance:
+
+    """
+    order flow imbalance of the best level (Cont, Kukanov and Stoikov), summed over the window
+    update(bid_price, bid_qty, ask_price, ask_qty) with the top of the book of the tick
+    """
+
+    __slots__ = ('prev', 'flow')
+
+    def __init__(self, window: int = 1) -> None:
+        self.prev = None
+        self.flow = RollingSum(window)
+
+    def update(self, bid_price, bid_qty, ask_price, ask_qty) -> float:
+        top = (bid_price, bid_qty, ask_price, ask_qty)
+        if any(_missing(x) for x in top):
+            return self.flow.update(None)
+        e = None
+        if self.prev is not None:
+            prev_bid_price, prev_bid_qty, prev_ask_price, prev_ask_qty = self.prev
+            e = (bid_qty if bid_price >= prev_bid_price else 0.0) - (prev_bid_qty if bid_price <= prev_bid_price else 0.0)\
+              - (ask_qty if ask_price <= prev_ask_price else 0.0) + (prev_ask_qty if ask_price >= prev_ask_price else 0.0)
+        self.prev = top
+        return self.flow.update(e)
+
+
+class DecayedCount:
+
+    """
+    exponentially decayed count (or sum) of events, halflife in ticks, ticks being evenly spaced in time
+    """
+
+    __slots__ = ('decay', 'value')
+
+    def __init__(self, halflife: float) -> None:
+        self.decay = 0.5 ** (1 / halflife)
+        self.value = 0.0
+
+    def update(self, n) -> float:
+        self.value = self.value * self.decay + (0.0 if _missing(n) else float(n))
+        return self.value
+
+
+OPERATORS = {
+    'sum': RollingSum,
+    'mean': RollingMean,
+    'var': RollingVar,
+    'ewma': EWMA,
+    'min': RollingMin,
+    'max': RollingMax,
+    'ofi': OrderFlowImbalance,
+    'decayed_count': DecayedCount,
+}
@@ -0,0 +1,632 @@
+import os
+import re
+import glob
+import json
+import shutil
+import datetime
+import numpy as np
+import polars as pl
+import pyarrow as pa
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
+from trades import TradesHandler, EPOCH
+
+
+def report_path(sink, kind: str, code: str = None) -> str:
+    """
+    the {kind} report (validation, index) of the day of sink, of code if given instead of the sink's:
+    {dest}/_reports/{code}.{date}.{kind}.json, dataset readers (pyarrow, hive scans) skip the _ prefixed directory
+    so the reports stay out of the columnar outputs
+    """
+    return os.path.join(sink.dest, "_reports", f"{code or sink.code}.{sink.date}.{kind}.json")
+
+
+class CsvSink:
+
+    """
+    appends one line per tick to {dest}/{code}.csv, the original output format
+    should be used as the destination of handlers.compute_day for a single instrument
+    with parts set, every date goes to its own {dest}/{code}.{date}.csv.part until stitch appends them in order,
+    with an attempt set as well to {dest}/{code}.{date}.{attempt}.csv.part until promote moves it into place
+    """
+
+    def __init__(self, dest: str, code: str, columns: list, buffer_size: int = 2**20) -> None:
+        self.dest = dest
+        self.code = code
+        self.columns = columns
+        self.buffer_size = buffer_size
+        self.date = None
+        self.parts = False
+        self.attempt = None # name of the attempt writing the part, see coordinator.Coordinator.attempt
+        self._file = None
+
+    @property
+    def path(self):
+        if self.parts:
+            return self._part_path(self.date, self.attempt)
+        return self._csv_path()
+
+    def _csv_path(self):
+        return os.path.join(self.dest, f"{self.code}.csv")
+
+    def _part_path(self, date, attempt=None):
+        if attempt is not None:
+            return os.path.join(self.dest, f"{self.code}.{date}.{attempt}.csv.part")
+        return os.path.join(self.dest, f"{self.code}.{date}.csv.part")
+
+    def promote(self, date, attempt):
+        # the part of a completed attempt becomes the part of its date
+        os.replace(self._part_path(date, attempt), self._part_path(date))
+
+    def stitch(self, dates: list):
+        # appends to the output of earlier stitches, which only starts over if it does not exist yet
+        if not os.path.exists(self._csv_path()):
+            self.write_header()
+        with open(self._csv_path(), 'ab') as dest:
+            for date in dates:
+                # parts of attempts that lost their unit to another node
+                prefix = os.path.join(self.dest, f"{self.code}.{date}.")
+                for stale in glob.glob(glob.escape(prefix) + "*.csv.part"):
+                    os.remove(stale)
+                part = self._part_path(date)
+                if not os.path.exists(part):
+                    continue
+                with open(part, 'rb') as src:
+                    shutil.copyfileobj(src, dest, self.buffer_size)
+                os.remove(part)
+
+    def write_header(self):
+        with open(self._csv_path(), 'w+') as dest:
+            dest.write(f"{','.join(self.columns + ['timestamp'])}\n")
+
+    def offsets(self) -> dict:
+        # {path: size} of the output written so far, parts are only ever stitched whole
+        path = self._csv_path()
+        if self.parts or not os.path.exists(path):
+            return {}
+        return {path: os.path.getsize(path)}
+
+    def rollback(self, offsets: dict) -> None:
+        """
+        drops whatever was appended after offsets (see offsets) were taken, starts over without them
+        """
+        path = self._csv_path()
+        if path in offsets and os.path.exists(path):
+            os.truncate(path, offsets[path])
+        else:
+            self.write_header()
+
+    def open(self):
+        # a part holds one run of its date, a retried date starts it over
+        self._file = open(self.path, 'w' if self.parts else 'a', buffering=self.buffer_size)
+        return self
+
+    def write(self, data, timestamp):
+        self._file.write(f"{str(data)[1:-1]}, {timestamp}\n")
+
+    def close(self):
+        self._file.close()
+        self._file = None
+
+    def __getstate__(self):
+        # sinks are shipped to the workers unopened
+        state = self.__dict__.copy()
+        state['_file'] = None
+        return state
+
+
+class ColumnarSink:
+
+    """
+    accumulates ticks into preallocated float32 column buffers and flushes them as arrow record batches,
+    one file per instrument and date under {dest}/code={code}/date={date}/ (hive partitioning)
+    subclasses only decide the file format
+    """
+
+    extension = None
+
+    def __init__(self, dest: str, code: str, columns: list, batch_rows: int = 2**16) -> None:
+        self.dest = dest
+        self.code = code
+        self.columns = columns
+        self.batch_rows = batch_rows
+        self.date = None
+        self.parts = False # always one partition per date
+        self.attempt = None # with parts, the attempt writes a hidden file of its own until promote
+        self.schema = pa.schema(
+            [(col, pa.float32()) for col in columns] + [('timestamp', pa.timestamp('us'))]
+        )
+        self._buffer = None
+        self._timestamps = None
+        self._rows = 0
+        self._writer = None
+
+    @property
+    def path(self):
+        return self._partition_path(self.date)
+
+    def _partition_path(self, date):
+        return os.path.join(self.dest, f"code={self.code}", f"date={date}", f"part-0.{self.extension}")
+
+    def write_header(self):
+        # the schema is stored in every file
+        pass
+
+    def _attempt_path(self, date, attempt):
+        path = self._partition_path(date)
+        return os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.{attempt}")
+
+    def promote(self, date, attempt):
+        os.replace(self._attempt_path(date, attempt), self._partition_path(date))
+
+    def stitch(self, dates: list):
+        # every date already is its own partition, only the files of attempts that lost their unit are left over
+        for date in dates:
+            for stale in glob.glob(glob.escape(self._attempt_path(date, "")) + "*"):
+                os.remove(stale)
+
+    def offsets(self) -> dict:
+        # partitions are replaced whole
+        return {}
+
+    def rollback(self, offsets: dict) -> None:
+        pass
+
+    @property
+    def _tmp_path(self):
+        # hidden from dataset readers until the partition is complete
+        if self.parts and self.attempt is not None:
+            return f"{self._attempt_path(self.date, self.attempt)}.tmp"
+        return os.path.join(os.path.dirname(self.path), f".{os.path.basename(self.path)}.tmp")
+
+    def open(self):
+        assert self.date is not None, "set the date of the partition before opening the sink"
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # column major so every column can be handed to arrow without a copy
+        self._buffer = np.empty((len(self.columns), self.batch_rows), dtype=np.float32)
+        self._timestamps = np.empty(self.batch_rows, dtype='datetime64[us]')
+        self._rows = 0
+        self._writer = self._open_writer(self._tmp_path)
+        return self
+
+    def write(self, data, timestamp):
+        self._buffer[:, self._rows] = data
+        self._timestamps[self._rows] = timestamp
+        self._rows += 1
+        if self._rows == self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        if self._rows == 0:
+            return
+        n = self._rows
+        batch = pa.RecordBatch.from_arrays(
+            [pa.array(col[:n]) for col in self._buffer] + [pa.array(self._timestamps[:n])],
+            schema=self.schema,
+        )
+        self._writer.write_batch(batch)
+        self._rows = 0
+
+    def close(self):
+        self.flush()
+        self._writer.close()
+        if self.parts and self.attempt is not None:
+            os.replace(self._tmp_path, self._attempt_path(self.date, self.attempt))
+        else:
+            os.replace(self._tmp_path, self.path)
+        self._writer = None
+        self._buffer = None
+        self._timestamps = None
+
+    def _open_writer(self, path):
+        raise NotImplementedError
+
+    def __getstate__(self):
+        # sinks are shipped to the workers unopened
+        state = self.__dict__.copy()
+        state['_writer'] = None
+        state['_buffer'] = None
+        state['_timestamps'] = None
+        return state
+
+
+class ParquetSink(ColumnarSink):
+
+    extension = 'parquet'
+
+    def _open_writer(self, path):
+        # every flushed batch becomes a row group
+        return pq.ParquetWriter(path, self.schema, compression='zstd')
+
+
+class IpcSink(ColumnarSink):
+
+    extension = 'arrow'
+
+    def _open_writer(self, path):
+        return ipc.new_file(path, self.schema)
+
+
+class WrapperSink:
+
+    """
+    base of the sinks that transform rows on their way to another sink,
+    everything but writing is forwarded to the wrapped sink
+    """
+
+    def __init__(self, sink) -> None:
+        self.sink = sink
+
+    @property
+    def code(self):
+        return self.sink.code
+
+    @property
+    def date(self):
+        return self.sink.date
+
+    @date.setter
+    def date(self, date):
+        self.sink.date = date
+
+    @property
+    def parts(self):
+        return self.sink.parts
+
+    @parts.setter
+    def parts(self, parts):
+        self.sink.parts = parts
+
+    @property
+    def attempt(self):
+        return self.sink.attempt
+
+    @attempt.setter
+    def attempt(self, attempt):
+        self.sink.attempt = attempt
+
+    @property
+    def path(self):
+        return self.sink.path
+
+    @property
+    def dest(self):
+        return self.sink.dest
+
+    def write_header(self):
+        self.sink.write_header()
+
+    def stitch(self, dates: list):
+        self.sink.stitch(dates)
+
+    def promote(self, date, attempt):
+        self.sink.promote(date, attempt)
+
+    def offsets(self) -> dict:
+        return self.sink.offsets()
+
+    def rollback(self, offsets: dict) -> None:
+        self.sink.rollback(offsets)
+
+    def open(self):
+        self.sink.open()
+        return self
+
+    def close(self):
+        self.sink.close()
+
+
+class FeatureSink(WrapperSink):
+
+    """
+    wraps another sink and appends the vectorized features of feature_func to every row written to it
+    rows are held back until block_rows of them can be computed at once, the features only see their deps,
+    the last max(lookback) ticks of a block are kept in front of the next one
+    columns are the ones of the rows written to this sink, the wrapped sink's columns end with the feature names
+    """
+
+    def __init__(self, sink, columns: list, features: list, block_rows: int = 2**16) -> None:
+        super().__init__(sink)
+        missing = sorted({col for f in features for col in f.deps} - set(columns))
+        assert missing == [], f"vector features depend on unknown columns {missing}"
+        self.features = features
+        self.block_rows = block_rows
+        self.lookback = max(f.lookback for f in features)
+        self.deps = [col for col in columns if any(col in f.deps for f in features)]
+        self._index = [columns.index(col) for col in self.deps]
+        self._rows = []
+        self._timestamps = []
+        self._history = None # deps of the last lookback ticks
+
+    def write(self, data, timestamp):
+        self._rows.append(data)
+        self._timestamps.append(timestamp)
+        if len(self._rows) == self.block_rows:
+            self.flush()
+
+    def flush(self):
+        if len(self._rows) == 0:
+            return
+        # None (no close price yet) becomes nan
+        values = np.array([[row[i] for i in self._index] for row in self._rows], dtype=np.float64)
+        frame = pl.DataFrame(values, schema=self.deps, orient='row')
+        if self._history is not None:
+            frame = pl.concat([self._history, frame])
+        offset = frame.height - len(self._rows)
+        outputs = [f.compute(frame)[offset:].tolist() for f in self.features]
+        for i, (row, timestamp) in enumerate(zip(self._rows, self._timestamps)):
+            self.sink.write(row + [out[i] for out in outputs], timestamp)
+        if self.lookback > 0:
+            self._history = frame.tail(self.lookback)
+        self._rows = []
+        self._timestamps = []
+
+    def close(self):
+        self.flush()
+        self.sink.close()
+
+
+class _Grid:
+
+    __slots__ = ('frequency', 'sink', 'trade_handler', 'prev_data')
+
+    def __init__(self, frequency, sink, trade_handler) -> None:
+        self.frequency = frequency
+        self.sink = sink
+        self.trade_handler = trade_handler
+        self.prev_data = None
+
+
+class ResampleSink(WrapperSink):
+
+    """
+    writes the rows of the replay frequency to the wrapped sink and the rows of coarser grids to their own sinks,
+    so that one replay serves every frequency, grids: {frequency: sink}, each frequency a multiple of the replay one
+    a coarser row is written when a replayed interval closes on its boundary: the books are the replayed ones,
+    the ohlcva (and trade stats) are folded interval by interval into the grid's own TradesHandler
+    and the per tick features are computed again with the grid's own state (see TradesHandler.feature_funcs)
+    """
+
+    def __init__(self, sink, columns: list, grids: dict, trade_stats: bool = False) -> None:
+        super().__init__(sink)
+        self._trades = columns.index('open') # the books come before the trades
+        self.trade_stats = trade_stats
+        self.grids = [_Grid(frequency, grid, TradesHandler(sink.code, frequency, trade_stats, columns))
+                      for frequency, grid in grids.items()]
+
+    @WrapperSink.date.setter
+    def date(self, date):
+        self.sink.date = date
+        for grid in self.grids:
+            grid.sink.date = date
+
+    @WrapperSink.parts.setter
+    def parts(self, parts):
+        self.sink.parts = parts
+        for grid in self.grids:
+            grid.sink.parts = parts
+
+    @WrapperSink.attempt.setter
+    def attempt(self, attempt):
+        self.sink.attempt = attempt
+        for grid in self.grids:
+            grid.sink.attempt = attempt
+
+    def write_header(self):
+        self.sink.write_header()
+        for grid in self.grids:
+            grid.sink.write_header()
+
+    def stitch(self, dates: list):
+        self.sink.stitch(dates)
+        for grid in self.grids:
+            grid.sink.stitch(dates)
+
+    def promote(self, date, attempt):
+        self.sink.promote(date, attempt)
+        for grid in self.grids:
+            grid.sink.promote(date, attempt)
+
+    def offsets(self) -> dict:
+        offsets = self.sink.offsets()
+        for grid in self.grids:
+            offsets.update(grid.sink.offsets())
+        return offsets
+
+    def rollback(self, offsets: dict) -> None:
+        self.sink.rollback(offsets)
+        for grid in self.grids:
+            grid.sink.rollback(offsets)
+
+    def open(self):
+        self.sink.open()
+        for grid in self.grids:
+            grid.sink.open()
+        return self
+
+    def write(self, data, timestamp):
+        self.sink.write(data, timestamp)
+        i = self._trades
+        open, high, low, close, volume, amount = data[i:i + 6]
+        if self.trade_stats:
+            count, signed_volume, age = data[i + 6:i + 9]
+        else:
+            count, signed_volume = int(volume != 0), 0
+        since_epoch = timestamp - EPOCH
+        for grid in self.grids:
+            trade_handler = grid.trade_handler
+            trade_handler.handle_bar(open, high, low, close, volume, amount, count, signed_volume)
+            if since_epoch % grid.frequency:
+                continue
+            row = data[:i]
+            row += trade_handler.get_ohlcva()
+            if self.trade_stats:
+                # the last trade is the same for every grid
+                row += trade_handler.get_stats(timestamp)[:2] + [age]
+            row += [f(
+                        data=row,
+                        prev_data=grid.prev_data,
+                        vwap=trade_handler.vwap
+                    ) for f in trade_handler.feature_funcs]
+            grid.sink.write(row, timestamp)
+            grid.prev_data = row
+
+    def close(self):
+        self.sink.close()
+        for grid in self.grids:
+            grid.sink.close()
+
+
+def frequency_label(frequency: datetime.timedelta) -> str:
+    """
+    e.g. 100ms, 1s, 5min, the directory of a frequency's output when replaying several
+    """
+    us = frequency // datetime.timedelta(microseconds=1)
+    for unit, size in (('h', 3600 * 10**6), ('min', 60 * 10**6), ('s', 10**6), ('ms', 10**3)):
+        if us % size == 0:
+            return f"{us // size}{unit}"
+    return f"{us}us"
+
+
+def _same(a, b) -> bool:
+    # nan equal to nan
+    return a == b or (a != a and b != b)
+
+
+class SparseSink(WrapperSink):
+
+    """
+    only passes on the rows in which one of the watched columns changed, plus one every heartbeat if given,
+    the first row of every date is always written
+    a skipped row equals the last written one in every watched column, so forward filling the written rows
+    onto the uniform grid described by the companion index (see densify) restores the watched columns exactly
+    and the others as of the last written row
+
+    the index is a json file with the reports of the sink: {dest}/_reports/{code}.{date}.index.json (see load_index)
+    """
+
+    def __init__(self, sink, columns: list, watch: list, frequency: datetime.timedelta,
+                 heartbeat: datetime.timedelta = None) -> None:
+        super().__init__(sink)
+        self._watch = [columns.index(col) for col in watch]
+        self.frequency = frequency
+        self.heartbeat = heartbeat
+        self._last = None
+        self._last_time = None
+        self._first_time = None
+        self._intervals = 0
+        self._rows = 0
+
+    @property
+    def index_path(self):
+        return report_path(self.sink, 'index')
+
+    def open(self):
+        self._last = None
+        self._last_time = None
+        self._first_time = None
+        self._intervals = 0
+        self._rows = 0
+        return super().open()
+
+    def write(self, data, timestamp):
+        if self._first_time is None:
+            self._first_time = timestamp
+        self._intervals += 1
+        watched = [data[i] for i in self._watch]
+        last = self._last
+        if last is not None and (watched == last or all(map(_same, watched, last))):
+            if self.heartbeat is None or timestamp - self._last_time < self.heartbeat:
+                return
+        self._last = watched
+        self._last_time = timestamp
+        self._rows += 1
+        self.sink.write(data, timestamp)
+
+    def close(self):
+        self.sink.close()
+        index = {
+            'code': self.sink.code,
+            'date': self.sink.date,
+            'start': str(self._first_time),
+            'frequency_us': self.frequency // datetime.timedelta(microseconds=1),
+            'intervals': self._intervals,
+            'rows': self._rows,
+            'heartbeat_us': None if self.heartbeat is None else self.heartbeat // datetime.timedelta(microseconds=1),
+        }
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        tmp = f"{self.index_path}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp, self.index_path)
+
+
+def sparse_watch(columns: list, levels: int = 10) -> list:
+    """
+    columns a SparseSink watches: the first levels levels of every book side, the values derived from the top
+    of the books (see columns.py) and the trade columns
+    """
+    book = re.compile(r"layer_\d+_(bid|ask)_(price|qty)_(\d+)$")
+    derived = re.compile(r"layer_\d+_(mid|spread|microprice)$")
+    trades = {'open', 'high', 'low', 'close', 'volume', 'amount', 'trade_count', 'signed_volume'}
+    watch = []
+    for col in columns:
+        m = book.match(col)
+        if (m is not None and int(m.group(3)) < levels) or derived.match(col) or col in trades:
+            watch.append(col)
+    return watch
+
+
+def load_index(dest: str, code: str, date: str) -> dict:
+    """
+    the index SparseSink wrote for the date of code, dest being the destination the sink was made with
+    """
+    with open(os.path.join(dest, "_reports", f"{code}.{date}.index.json")) as f:
+        return json.load(f)
+
+
+def densify(data: pl.DataFrame, index: dict, timestamp: str = 'timestamp') -> pl.DataFrame:
+    """
+    the uniform grid of a date of sparse output, given its rows and its index (see load_index)
+    """
+    start = datetime.datetime.fromisoformat(index['start'])
+    frequency = datetime.timedelta(microseconds=index['frequency_us'])
+    grid = pl.DataFrame({
+        timestamp: pl.datetime_range(
+            start, start + (index['intervals'] - 1) * frequency, frequency, time_unit='us', eager=True
+        )
+    })
+    if data[timestamp].dtype == pl.String: # csv output
+        data = data.with_columns(pl.col(timestamp).str.strip_chars().str.to_datetime(time_unit='us'))
+    data = data.with_columns(pl.col(timestamp).cast(pl.Datetime('us')))
+    return grid.join(data, on=timestamp, how='left').select(data.columns).fill_null(strategy='forward')
+
+
+SINKS = {
+    'csv': CsvSink,
+    'parquet': ParquetSink,
+    'ipc': IpcSink,
+}
+
+
+def make_sink(output: str, dest: str, code: str, columns: list, buffer_size: int = 2**20, batch_rows: int = 2**16,
+              vector_features: list = (), sparse_levels: int = None, frequency: datetime.timedelta = None,
+              heartbeat: datetime.timedelta = None):
+    """
+    the sink of one instrument, with vector_features the vectorized features are appended to the rows
+    and with sparse_levels only the rows that changed within that many levels (or the trades) are written
+    """
+    assert output in SINKS, f"unknown output format {output}, expected one of {list(SINKS)}"
+    if len(vector_features) > 0:
+        # the engines write columns, the vectorized features are appended on the way to the file
+        columns = columns + [f.name for f in vector_features]
+        sink = make_sink(output, dest, code, columns, buffer_size, batch_rows,
+                         sparse_levels=sparse_levels, frequency=frequency, heartbeat=heartbeat)
+        return FeatureSink(sink, columns[:-len(vector_features)], vector_features, batch_rows)
+    if sparse_levels is not None:
+        # features are computed on every tick before the unchanged ones are dropped
+        sink = make_sink(output, dest, code, columns, buffer_size, batch_rows)
+        return SparseSink(sink, columns, sparse_watch(columns, sparse_levels), frequency, heartbeat)
+    if output == 'csv':
+        return CsvSink(dest, code, columns, buffer_size)
+    return SINKS[output](dest, code, columns, batch_rows)
@@ -0,0 +1,242 @@
+import io
+import datetime
+import pgzip
+import polars as pl
+from data_schema import L2_SCHEMA, L1_SCHEMA, L2_MESSAGE_SCHEMA, L1_MESSAGE_SCHEMA, L2_SOURCE_COLUMNS, L1_SOURCE_COLUMNS
+
+
+def l2_timestamp() -> pl.Expr:
+    # DeltaRefresh/OverlapRefresh server timestamps in microseconds since epoch,
+    # MaxVisibleDepth messages have none
+    return (
+        pl.coalesce(['DeltaRefresh_ServerTimestamp', 'OverlapRefresh_ServerTimestamp'])
+        .str.split(".")
+        .list
+        .first()
+        .cast(pl.Int64)
+        .cast(pl.Datetime("us"))
+    )
+
+
+def l1_timestamp() -> pl.Expr:
+    return (
+        pl.col('ServerTimestamp').cast(pl.Int64)
+        .cast(pl.Datetime("us"))
+    )
+
+
+def parse_limits(col: str) -> pl.Expr:
+    # OverlapRefresh limits "[price,qty][price,qty]..." as a flat [price, qty, price, qty, ...] float list
+    return (
+        pl.col(col)
+        .str.extract_all(r"[^\[\],]+")
+        .list.eval(pl.element().str.strip_chars().cast(pl.Float64))
+    )
+
+
+def _integer(col: str, dtype) -> pl.Expr:
+    # integer codes read as strings or floats, e.g. the DeltaAction "3.0"
+    return pl.col(col).cast(pl.Float32).cast(dtype)
+
+
+def message_schema(schema: dict, codes: list) -> dict:
+    """
+    L2_MESSAGE_SCHEMA or L1_MESSAGE_SCHEMA with the Code column of the universe codes,
+    in the column order of the encoded frames
+    """
+    columns = {col: dtype for col, dtype in schema.items() if col != 'Timestamp'}
+    return {'Timestamp': schema['Timestamp'], 'Code': pl.Enum(codes), **columns}
+
+
+def encode_l2(data: pl.DataFrame, codes: list) -> pl.DataFrame:
+    """
+    raw l2 messages of the universe codes in the message format of data_schema.L2_MESSAGE_SCHEMA,
+    everything the handlers would otherwise decode message by message, MaxVisibleDepth messages keep a null timestamp
+    """
+    return data.select(
+        Timestamp=l2_timestamp(),
+        Code=pl.col('Code').cast(pl.Enum(codes)),
+        LayerId=_integer('LayerId', pl.Int8),
+        DeltaRefresh_DeltaAction=_integer('DeltaRefresh_DeltaAction', pl.UInt8),
+        DeltaRefresh_Level=_integer('DeltaRefresh_Level', pl.Int16),
+        DeltaRefresh_Price=pl.col('DeltaRefresh_Price').cast(pl.Float32),
+        DeltaRefresh_CumulatedUnits=pl.col('DeltaRefresh_CumulatedUnits').cast(pl.Float32),
+        OverlapRefresh_BidChangeIndicator=_integer('OverlapRefresh_BidChangeIndicator', pl.Int8),
+        OverlapRefresh_AskChangeIndicator=_integer('OverlapRefresh_AskChangeIndicator', pl.Int8),
+        OverlapRefresh_BidLimits=parse_limits('OverlapRefresh_BidLimits'),
+        OverlapRefresh_AskLimits=parse_limits('OverlapRefresh_AskLimits'),
+        MaxVisibleDepth_MaxVisibleDepth=_integer('MaxVisibleDepth_MaxVisibleDepth', pl.Int16),
+    )
+
+
+def encode_l1(data: pl.DataFrame, codes: list) -> pl.DataFrame:
+    """
+    raw l1 messages of the universe codes in the message format of data_schema.L1_MESSAGE_SCHEMA
+    """
+    return data.select(
+        Timestamp=l1_timestamp(),
+        Code=pl.col('Code').cast(pl.Enum(codes)),
+        ServerTimestamp=pl.col('ServerTimestamp').cast(pl.Int64),
+        TradeEvent_LastPrice=pl.col('TradeEvent_LastPrice').cast(pl.Float32),
+        TradeEvent_LastTradeQuantity=pl.col('TradeEvent_LastTradeQuantity').cast(pl.Float32),
+        TradeEvent_Context_AggressorSide=_integer('TradeEvent_Context_AggressorSide', pl.UInt8),
+    )
+
+
+def read_csv_chunks(path: str, schema: dict, chunk_bytes: int = 2**26, threads: int = None, columns: list = None):
+    """
+    yields the rows of a csv.gz file as DataFrames of roughly chunk_bytes of uncompressed csv each,
+    only columns if set
+    blocks written by pgzip are decompressed in parallel by threads threads, plain gzip falls back to one
+    """
+    with pgzip.open(path, 'rb', thread=threads) as f:
+        header = f.readline()
+        rest = b''
+        while True:
+            block = f.read(chunk_bytes)
+            if not block:
+                break
+            block = rest + block
+            cut = block.rfind(b'\n') + 1
+            rest = block[cut:] # a line split over two reads goes with the next chunk
+            if cut > 0:
+                yield pl.read_csv(io.BytesIO(header + block[:cut]), schema=schema, columns=columns)
+        if rest.strip():
+            yield pl.read_csv(io.BytesIO(header + rest), schema=schema, columns=columns)
+
+
+class DayStream:
+
+    """
+    replays one date of l2 and l1 messages from the csv.gz files without ever collecting the whole day
+    the files are read chunk by chunk and bucketed into the replay frequency window_buckets buckets at a time,
+    each iteration yields {code: (l2, l1)} with frames shaped like the ones of Replayer._read_next_date,
+    the windows of one instrument fed in order to compute_day replay the same day as the full frames
+    memory is bounded by chunk_bytes and window_buckets instead of the size of the day
+    with layers, only the l2 messages of those layers are kept
+
+    assumes both files are sorted by time, like the full loader does
+    """
+
+    def __init__(
+            self,
+            l2_path: str,
+            l1_path: str,
+            universe: list,
+            start: datetime.datetime,
+            frequency: datetime.timedelta,
+            l2_columns: list,
+            l1_columns: list,
+            window_buckets: int = 2**14,
+            chunk_bytes: int = 2**26,
+            threads: int = None,
+            layers: list = None,
+        ) -> None:
+        self.l2_path = l2_path
+        self.l1_path = l1_path
+        self.universe = universe
+        self.start = start
+        self.end = start + datetime.timedelta(days=1)
+        self.freq = frequency
+        self.l2_columns = l2_columns
+        self.l1_columns = l1_columns
+        self.window_buckets = window_buckets
+        self.chunk_bytes = chunk_bytes
+        self.threads = threads
+        self.layers = layers
+        # same grid as group_by_dynamic + upsample over [start, end), labelled by the upper boundaries
+        epoch = datetime.datetime(1970, 1, 1)
+        self.first = start - (start - epoch) % frequency
+        last = self.end - frequency / 100
+        self.n_buckets = (last - self.first) // frequency + 1
+
+    def __iter__(self):
+        l2 = _Buffer(self._messages(self.l2_path, l2=True))
+        l1 = _Buffer(self._messages(self.l1_path))
+        for k0 in range(0, self.n_buckets, self.window_buckets):
+            k1 = min(k0 + self.window_buckets, self.n_buckets)
+            until = self.first + k1 * self.freq
+            l2_window = l2.take_until(until)
+            l1_window = l1.take_until(until)
+            l2_frames = self._partition(l2_window)
+            l1_frames = self._partition(l1_window)
+            yield {
+                code: (
+                    self._bucket(l2_frames.get(code), L2_MESSAGE_SCHEMA, self.l2_columns, k0, k1),
+                    self._bucket(l1_frames.get(code), L1_MESSAGE_SCHEMA, self.l1_columns, k0, k1),
+                )
+                for code in self.universe
+            }
+
+    def _messages(self, path, l2=False):
+        # time stamped messages of the universe within the day in the message format, one chunk at a time
+        pending = None
+        if l2:
+            schema, columns, encode = L2_SCHEMA, L2_SOURCE_COLUMNS, encode_l2
+        else:
+            schema, columns, encode = L1_SCHEMA, L1_SOURCE_COLUMNS, encode_l1
+        for chunk in read_csv_chunks(path, schema, self.chunk_bytes, self.threads, columns):
+            chunk = encode(chunk.filter(pl.col('Code').is_in(self.universe)), self.universe)
+            if l2:
+                # MaxVisibleDepth messages take the timestamp of the next message, which may be in the next chunk
+                if pending is not None:
+                    chunk = pl.concat([pending, chunk])
+                stamped = chunk['Timestamp'].is_not_null().arg_true()
+                cut = stamped[-1] + 1 if len(stamped) > 0 else 0
+                pending = chunk.slice(cut)
+                chunk = chunk.slice(0, cut).with_columns(pl.col('Timestamp').backward_fill())
+                if self.layers is not None:
+                    chunk = chunk.filter(pl.col('LayerId').is_in(self.layers) | pl.col('LayerId').is_null())
+            yield chunk.filter((pl.col('Timestamp') >= self.start) & (pl.col('Timestamp') < self.end))
+
+    def _partition(self, data: pl.DataFrame) -> dict:
+        if data is None:
+            return {}
+        return {code[0]: frame for code, frame in data.partition_by('Code', maintain_order=True, as_dict=True).items()}
+
+    def _bucket(self, data, schema, columns, k0, k1) -> pl.DataFrame:
+        # buckets [k0, k1) of the grid, a row of lists of the messages of each bucket, null where there were none
+        grid = pl.DataFrame({
+            'Timestamp': pl.datetime_range(
+                self.first + (k0 + 1) * self.freq,
+                self.first + k1 * self.freq,
+                self.freq,
+                time_unit='us',
+                eager=True,
+            )
+        })
+        if data is None:
+            data = pl.DataFrame(schema=message_schema(schema, self.universe))
+        aggregated = data.group_by(
+            pl.col('Timestamp').dt.truncate(self.freq) + self.freq,
+            maintain_order=True,
+        ).agg(columns)
+        return grid.join(aggregated, on='Timestamp', how='left').select('Timestamp', *columns)
+
+
+class _Buffer:
+
+    """
+    messages read ahead of the current window
+    """
+
+    def __init__(self, chunks) -> None:
+        self.chunks = chunks
+        self.data = None
+        self.exhausted = False
+
+    def take_until(self, until: datetime.datetime):
+        # all messages before until, reading chunks until one reaches past it
+        frames = [] if self.data is None else [self.data]
+        while not self.exhausted and (len(frames) == 0 or frames[-1].height == 0 or frames[-1]['Timestamp'][-1] < until):
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                self.exhausted = True
+                break
+            frames.append(chunk)
+        if len(frames) == 0:
+            return None
+        data = pl.concat(frames) if len(frames) > 1 else frames[0]
+        n = data['Timestamp'].search_sorted(until, side='left')
+        self.data = data.slice(n)
+        return data.slice(0, n)
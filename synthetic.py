@@ -0,0 +1,213 @@
+"""
+synthetic IRESS days for benchmarks, written like the real files:
+{root}/l2_data/{date}_{eid}_L2.csv.gz and {root}/l1_data/{date}_{eid}_L1-Trades.csv.gz with the columns of data_schema
+
+every layer of every instrument starts with a MaxVisibleDepth and a full OverlapRefresh, then draws DeltaRefresh
+messages from action_mix and full OverlapRefresh snapshots of the generator's own book, so replays of the days
+are consistent (validation accuracy 1) and the same seed always writes the same files
+"""
+import os
+import gzip
+import datetime
+import numpy as np
+import polars as pl
+from data_schema import L2_SCHEMA, L1_SCHEMA
+
+# DeltaRefresh actions drawn for the bid side, the ask side is the next action, see handlers.handle_DeltaRefresh
+ACTIONS = {
+    'change_qty': 7,
+    'insert': 3,
+    'remove': 5,
+    'remove_append': 9,
+    'clear': 1,
+}
+ACTION_MIX = {'change_qty': 0.5, 'insert': 0.2, 'remove': 0.2, 'remove_append': 0.1}
+TICK = 0.25 # exact in float32, so snapshots compare equal to the replayed books
+
+
+def _limits(prices: list, qtys: list) -> str:
+    # "[price,qty][price,qty]..." of the non empty levels
+    return ''.join(f"[{p},{q}]" for p, q in zip(prices, qtys) if p == p)
+
+
+class _Book:
+
+    """
+    the levels of one layer as the replay's LocalOrderBook will see them, with depth levels per side
+    """
+
+    def __init__(self, rng, depth: int) -> None:
+        self.sides = []
+        for sign in (-1, 1):
+            prices = [100.0 + sign * (0.5 + i) * TICK * 2 for i in range(depth)]
+            qtys = [float(q) for q in rng.integers(1, 50, depth)]
+            self.sides.append((prices, qtys))
+
+    def apply(self, action: str, side: int, level: int, qty: float) -> tuple:
+        """
+        applies action to the book, returns the (price, qty) of the message, None where the message has none
+        """
+        prices, qtys = self.sides[side]
+        sign = -1 if side == 0 else 1
+        if action == 'change_qty':
+            qtys[level] = qty
+            return None, qty
+        if action == 'insert':
+            # between the level and the one above it, or a new best level
+            price = prices[level] if prices[level] == prices[level] else 100.0
+            price -= sign * TICK
+            prices.insert(level, price)
+            qtys.insert(level, qty)
+            prices.pop()
+            qtys.pop()
+            return price, qty
+        if action == 'remove':
+            prices.pop(level)
+            qtys.pop(level)
+            prices.append(np.nan)
+            qtys.append(np.nan)
+            return None, None
+        if action == 'remove_append':
+            last = prices[-1] if prices[-1] == prices[-1] else 100.0
+            price = last + sign * TICK
+            prices.pop(level)
+            qtys.pop(level)
+            prices.append(price)
+            qtys.append(qty)
+            return price, qty
+        if action == 'clear':
+            prices[level:] = [np.nan] * (len(prices) - level)
+            qtys[level:] = [np.nan] * (len(qtys) - level)
+            return None, None
+        raise ValueError(f"unknown action {action}, expected one of {list(ACTIONS)}")
+
+    def limits(self) -> tuple:
+        return tuple(_limits(*side) for side in self.sides)
+
+
+def generate_day(
+        root: str,
+        date: str,
+        codes: list,
+        eid: str = "1027",
+        rate: float = 1.0,
+        trade_rate: float = 0.25,
+        layers: int = 2,
+        depth: int = 10,
+        action_mix: dict = ACTION_MIX,
+        overlap_fraction: float = 0.005,
+        max_level: int = 5,
+        hours: float = 24.0,
+        seed: int = 0,
+        compresslevel: int = 6,
+    ) -> tuple:
+    """
+    writes one synthetic day and returns the paths of its (l2, l1) files
+
+    Params:
+    -------
+    root:               str, directory of the l2_data and l1_data directories
+    date:               str, date of the files, messages start 2 hours before it like the replay day
+    codes:              list, instrument codes
+    eid:                str, exchange id of the file names
+    rate:               float, l2 messages per second and instrument
+    trade_rate:         float, trades per second and instrument
+    layers:             int, layers per instrument, layer ids 0 to layers - 1
+    depth:              int, visible depth of every layer
+    action_mix:         dict, {action: weight} of the DeltaRefresh messages, actions are the keys of ACTIONS
+    overlap_fraction:   float, share of the l2 messages that are full OverlapRefresh snapshots
+    max_level:          int, DeltaRefresh messages hit levels 0 to max_level - 1
+    hours:              float, hours of the replay day that have messages
+    seed:               int, seed of the random draws
+    compresslevel:      int, gzip compression level
+    """
+    assert 0 < layers <= 6, "IRESS has at most 6 layers"
+    assert 0 < max_level <= depth, "max_level must be within the depth"
+    assert 0 <= overlap_fraction <= 1, "overlap_fraction is a share of the l2 messages"
+    rng = np.random.default_rng(seed)
+    start = datetime.datetime.strptime(date, "%Y-%m-%d") - datetime.timedelta(hours=2)
+    start = int((start - datetime.datetime(1970, 1, 1)).total_seconds() * 1e6)
+    span = int(hours * 3600e6)
+    names = list(action_mix)
+    weights = np.array([action_mix[name] for name in names], dtype=np.float64)
+    weights /= weights.sum()
+
+    l2 = {col: [] for col in ('Code', 'LayerId', 'DeltaRefresh_ServerTimestamp', 'DeltaRefresh_DeltaAction',
+                              'DeltaRefresh_Level', 'DeltaRefresh_Price', 'DeltaRefresh_CumulatedUnits',
+                              'OverlapRefresh_ServerTimestamp', 'OverlapRefresh_BidChangeIndicator',
+                              'OverlapRefresh_AskChangeIndicator', 'OverlapRefresh_BidLimits',
+                              'OverlapRefresh_AskLimits', 'MaxVisibleDepth_MaxVisibleDepth', '_time')}
+
+    def append(**row):
+        for col, values in l2.items():
+            values.append(row.get(col))
+
+    for code in codes:
+        books = [_Book(rng, depth) for _ in range(layers)]
+        for layer, book in enumerate(books):
+            # MaxVisibleDepth messages have no timestamp, they sort right before the first snapshot
+            append(Code=code, LayerId=str(layer), MaxVisibleDepth_MaxVisibleDepth=float(depth), _time=start)
+            bid, ask = book.limits()
+            append(Code=code, LayerId=str(layer), OverlapRefresh_ServerTimestamp=str(start + 1), _time=start + 1,
+                   OverlapRefresh_BidChangeIndicator=-1.0, OverlapRefresh_AskChangeIndicator=-1.0,
+                   OverlapRefresh_BidLimits=bid, OverlapRefresh_AskLimits=ask)
+        n = int(rate * hours * 3600)
+        times = np.sort(rng.integers(2, span, n)) + start
+        message_layers = rng.integers(0, layers, n)
+        snapshots = rng.random(n) < overlap_fraction
+        actions = rng.choice(len(names), n, p=weights)
+        sides = rng.integers(0, 2, n)
+        levels = rng.integers(0, max_level, n)
+        qtys = rng.integers(1, 50, n).astype(np.float64)
+        for i in range(n):
+            time = int(times[i])
+            layer = int(message_layers[i])
+            book = books[layer]
+            if snapshots[i]:
+                bid, ask = book.limits()
+                append(Code=code, LayerId=str(layer), OverlapRefresh_ServerTimestamp=str(time), _time=time,
+                       OverlapRefresh_BidChangeIndicator=-1.0, OverlapRefresh_AskChangeIndicator=-1.0,
+                       OverlapRefresh_BidLimits=bid, OverlapRefresh_AskLimits=ask)
+                continue
+            action, side, level = names[actions[i]], int(sides[i]), int(levels[i])
+            price, qty = book.apply(action, side, level, float(qtys[i]))
+            append(Code=code, LayerId=str(layer), DeltaRefresh_ServerTimestamp=str(time), _time=time,
+                   DeltaRefresh_DeltaAction=f"{float(ACTIONS[action] + side)}", DeltaRefresh_Level=float(level),
+                   DeltaRefresh_Price=price, DeltaRefresh_CumulatedUnits=qty)
+
+    n = int(trade_rate * hours * 3600)
+    l1 = {
+        'Code': np.repeat(codes, n),
+        '_time': np.concatenate([np.sort(rng.integers(2, span, n)) + start for _ in codes]),
+        'TradeEvent_LastPrice': 100.0 + rng.integers(-8, 9, n * len(codes)) * TICK,
+        'TradeEvent_LastTradeQuantity': rng.integers(1, 20, n * len(codes)).astype(np.float64),
+        'TradeEvent_Context_AggressorSide': rng.choice(['1', '2'], n * len(codes)),
+    }
+
+    paths = (
+        os.path.join(root, "l2_data", f"{date}_{eid}_L2.csv.gz"),
+        os.path.join(root, "l1_data", f"{date}_{eid}_L1-Trades.csv.gz"),
+    )
+    for path in paths:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    # the messages of all instruments interleave in time, like in the real files
+    l2 = pl.DataFrame(l2).sort('_time', maintain_order=True)
+    l1 = pl.DataFrame(l1).sort('_time', maintain_order=True).with_columns(
+        ServerTimestamp=pl.col('_time').cast(pl.Utf8),
+    )
+    for frame, schema, path in ((l2, L2_SCHEMA, paths[0]), (l1, L1_SCHEMA, paths[1])):
+        frame = frame.select(
+            pl.col(col).cast(dtype) if col in frame.columns else pl.lit(None, dtype).alias(col)
+            for col, dtype in schema.items()
+        )
+        with gzip.open(path, 'wb', compresslevel=compresslevel) as f:
+            frame.write_csv(f)
+    return paths
+
+
+def generate_days(root: str, dates: list, codes: list, seed: int = 0, **params) -> None:
+    """
+    writes generate_day for every date, each with its own seed
+    """
+    for i, date in enumerate(dates):
+        generate_day(root, date, codes, seed=seed + i, **params)
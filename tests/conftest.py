@@ -0,0 +1,79 @@
+"""
+shared fixtures: two synthetic days (see synthetic.generate_day) and replayers over them
+"""
+import os
+import sys
+import datetime
+import multiprocessing as mp
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic import generate_days
+from replayer import Replayer
+
+DATES = ['2020-12-01', '2020-12-02']
+CODES = ['111', '222']
+FREQUENCY = datetime.timedelta(seconds=10)
+
+
+def pytest_configure(config):
+    # the workers are not fork safe once polars started its threads, like in main.py
+    mp.set_start_method("forkserver", force=True)
+
+
+@pytest.fixture(scope="session")
+def data(tmp_path_factory) -> str:
+    root = str(tmp_path_factory.mktemp("data"))
+    generate_days(root, DATES, CODES, rate=0.2, trade_rate=0.05, compresslevel=1)
+    return root
+
+
+@pytest.fixture
+def make_replayer(data, tmp_path):
+    """
+    make_replayer(dest name, **params) with the synthetic days as source unless src is given, closed after the test
+    """
+    replayers = []
+
+    def make(name: str, **params) -> Replayer:
+        params = {'src': data, 'frequency': FREQUENCY, 'universe': list(CODES)} | params
+        replayer = Replayer(eid="1027", dest=str(tmp_path / name), start=DATES[0], **params)
+        replayers.append(replayer)
+        return replayer
+
+    yield make
+    for replayer in replayers:
+        replayer.close()
+
+
+def replay(replayer: Replayer, days: int = len(DATES)) -> str:
+    # every date one after the other, returns the destination
+    for _ in range(days):
+        replayer.compute_day()
+    return replayer.dest
+
+
+class ListSink:
+
+    """
+    sink keeping the rows written to it in memory, in (row, timestamp) pairs
+    """
+
+    def __init__(self, code: str = CODES[0], date: str = DATES[0]) -> None:
+        self.code = code
+        self.date = date
+        self.parts = False
+        self.rows = []
+
+    def open(self):
+        return self
+
+    def write(self, data, timestamp):
+        self.rows.append((list(data), timestamp))
+
+    def write_header(self):
+        pass
+
+    def close(self):
+        pass
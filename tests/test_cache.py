@@ -0,0 +1,34 @@
+import os
+import datetime
+import polars as pl
+from conftest import CODES, DATES
+from cache import DayCache
+
+FREQUENCY = datetime.timedelta(seconds=1)
+
+
+def _frames(codes: list) -> dict:
+    return {code: pl.DataFrame({'Code': [code]}) for code in codes}
+
+
+def test_subset_entry_does_not_serve_the_full_universe(tmp_path):
+    source = tmp_path / "source.csv.gz"
+    source.write_bytes(b"day")
+    cache = DayCache(str(tmp_path / "cache"))
+    cache.store("1027", DATES[0], FREQUENCY, _frames(['111']), _frames(['111']), [str(source)])
+    assert cache.load("1027", DATES[0], FREQUENCY, ['111'], [str(source)])[0] == ['111']
+    assert cache.load("1027", DATES[0], FREQUENCY, [], [str(source)]) is None
+    cache.store("1027", DATES[0], FREQUENCY, _frames(CODES), _frames(CODES), [str(source)], full_universe=True)
+    assert cache.load("1027", DATES[0], FREQUENCY, [], [str(source)])[0] == sorted(CODES)
+
+
+def test_inferred_universe_after_a_subset_run(make_replayer, tmp_path):
+    cache = str(tmp_path / "cache")
+    subset = make_replayer("subset", universe=CODES[:1], cache=cache)
+    subset.compute_day()
+    full = make_replayer("full", universe=[], cache=cache)
+    full.compute_day()
+    assert sorted(full.universe) == sorted(CODES)
+    assert all(os.path.exists(os.path.join(full.dest, f"{code}.csv")) for code in CODES)
+    # the entry now holds the whole day, the next inferred universe is a hit
+    assert full.cache.load("1027", DATES[0], full.freq, [], full._source_files(DATES[0]))[0] == sorted(CODES)
@@ -0,0 +1,52 @@
+import json
+import numpy as np
+import pytest
+from check_ob import check_ob, BookValidator, save_validation
+from orderbook import LocalOrderBook, ArrayOrderBook
+from sinks import CsvSink
+
+BID = [100.0, 5.0, 99.75, 3.0]
+ASK = [100.25, 4.0, 100.5, 2.0]
+
+
+def _book(orderbook, depth: int = 10):
+    ob = orderbook("111")
+    ob.MaxVisibleDepth(depth)
+    ob.BidOverwriteLevels(BID[::2], BID[1::2], 0)
+    ob.AskOverwriteLevels(ASK[::2], ASK[1::2], 0)
+    return ob
+
+
+@pytest.mark.parametrize("orderbook", [LocalOrderBook, ArrayOrderBook])
+def test_nan_levels_mismatch(orderbook):
+    ob = _book(orderbook)
+    assert check_ob(ob, BID, ASK, 0)
+    # the snapshot has a level the book left empty, the original check counted it as consistent
+    assert not check_ob(ob, BID + [99.5, 1.0], ASK, 0)
+    # or a level past the depth of the book
+    assert not check_ob(_book(orderbook, depth=2), BID + [99.5, 1.0], ASK + [100.75, 1.0], 0)
+    # levels past the shorter side of the snapshot are not compared
+    assert check_ob(ob, BID[:2], ASK, 0)
+
+
+def test_validator_counts_and_report(tmp_path):
+    validator = BookValidator('sampled', every=2, levels=3)
+    ob = _book(ArrayOrderBook)
+    wrong = [100.0, 5.0, 99.75, 7.0]
+    for bid in (BID, wrong, BID, wrong, BID, BID):
+        validator.check(ob, bid, ASK, 1606780800000000, layer=1)
+    # the 2nd, 4th and 6th snapshots are checked
+    assert validator.accuracy(1) == pytest.approx(1 / 3)
+    assert np.isnan(validator.accuracy(0))
+    report = validator.report()
+    assert (report['full_snapshots'], report['checked'], report['consistent']) == (6, 3, 1)
+    assert report['layers'][1]['bid']['mismatches'] == [0, 2, 0]
+    assert report['layers'][1]['bid']['qty_drift'] == [None, 4.0, None]
+    assert report['layers'][1]['ask']['mismatches'] == [0, 0, 0]
+    assert [(m['side'], m['level'], m['qty'], m['reference_qty']) for m in report['mismatches']] == \
+        [('bid', 1, 3.0, 7.0)] * 2
+    sink = CsvSink(str(tmp_path), "111", [])
+    sink.date = "2020-12-01"
+    save_validation(validator, sink)
+    with open(tmp_path / "_reports" / "111.2020-12-01.validation.json") as f:
+        assert json.load(f)['checked'] == 3
@@ -0,0 +1,25 @@
+from conftest import CODES, DATES
+from checkpoint import save_checkpoint, load_checkpoint
+from orderbook import LocalOrderBook
+
+
+def test_books_are_keyed_by_integer_layers(tmp_path):
+    books = {0: LocalOrderBook("111"), 1: LocalOrderBook("111")}
+    save_checkpoint(str(tmp_path), "111", DATES[0], books, None, [1.0])
+    ob_handler, _, last = load_checkpoint(str(tmp_path), "111", DATES[0], [0, 1])
+    assert sorted(ob_handler) == [0, 1] and last == [1.0]
+    # written by a replay of other layers
+    assert load_checkpoint(str(tmp_path), "111", DATES[0], [0]) is None
+    assert load_checkpoint(str(tmp_path), "111", DATES[1]) is None
+
+
+def test_next_date_starts_from_the_checkpoint(make_replayer):
+    sequential = make_replayer("sequential")
+    for _ in DATES:
+        sequential.compute_day()
+    parallel = make_replayer("parallel")
+    parallel.compute_days_parallel(1)
+    parallel.compute_days_parallel(1) # the second date is not in the batch of the first, it starts from its checkpoint
+    for code in CODES:
+        with open(f"{sequential.dest}/{code}.csv", 'rb') as a, open(f"{parallel.dest}/{code}.csv", 'rb') as b:
+            assert a.read() == b.read()
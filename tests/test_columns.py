@@ -0,0 +1,68 @@
+import os
+import numpy as np
+import polars as pl
+import pytest
+from conftest import CODES, replay
+from columns import ColumnSpec, column_spec
+from orderbook import LocalOrderBook, ArrayOrderBook
+
+SPEC = {'layers': [1], 'depth': 3, 'fields': ['bid_price', 'ask_qty'], 'derived': ['mid', 'spread', 'microprice']}
+
+
+def _csv(dest: str, code: str) -> pl.DataFrame:
+    frame = pl.read_csv(os.path.join(dest, f"{code}.csv"), infer_schema=False)
+    return frame.select(
+        pl.col(col).str.strip_chars().cast(pl.Float64, strict=False).alias(col.strip()) for col in frame.columns[:-1]
+    )
+
+
+def test_column_names():
+    spec = column_spec(SPEC)
+    assert spec.columns() == ['layer_1_bid_price_0', 'layer_1_bid_price_1', 'layer_1_bid_price_2',
+                              'layer_1_ask_qty_0', 'layer_1_ask_qty_1', 'layer_1_ask_qty_2',
+                              'layer_1_mid', 'layer_1_spread', 'layer_1_microprice']
+    assert column_spec(None).columns() == ColumnSpec().columns() and len(ColumnSpec().columns()) == 6 * 4 * 10
+    assert column_spec(spec) is spec
+    with pytest.raises(AssertionError):
+        ColumnSpec(fields=['bid_volume'])
+    with pytest.raises(AssertionError):
+        ColumnSpec(depth=0)
+
+
+@pytest.mark.parametrize("orderbook", [LocalOrderBook, ArrayOrderBook])
+def test_rows_and_blocks_select_the_same_values(orderbook):
+    spec = column_spec(SPEC)
+    full = ColumnSpec(layers=[1], depth=10)
+    books = full.books("111", orderbook)
+    ob = books[1]
+    ob.MaxVisibleDepth(10)
+    ob.BidOverwriteLevels([100.0, 99.75], [5.0, 1.0], 0)
+    ob.AskOverwriteLevels([100.5, 100.75], [3.0, 2.0], 0)
+    row = spec.snapshot(books)
+    block = np.array([full.snapshot(books)], dtype=np.float64)
+    assert np.array_equal(np.array([row]), spec.select(block, 10), equal_nan=True)
+    assert np.array_equal(row[:6], [100.0, 99.75, np.nan, 3.0, 2.0, np.nan], equal_nan=True)
+    assert row[6:] == [100.25, 0.5, (100.0 * 3.0 + 100.5 * 5.0) / 8.0]
+
+
+def test_selected_columns_are_those_of_the_full_replay(make_replayer):
+    full = replay(make_replayer("full"))
+    rows = replay(make_replayer("rows", columns=SPEC))
+    assert _outputs_equal(rows, replay(make_replayer("batch", columns=SPEC, engine='batch')))
+    for code in CODES:
+        expected, selected = _csv(full, code), _csv(rows, code)
+        books = column_spec(SPEC).columns()[:6] # those of the full replay too
+        trades = ['open', 'high', 'low', 'close', 'volume', 'amount']
+        assert selected.columns == column_spec(SPEC).columns() + trades
+        assert selected.select(books + trades).equals(expected.select(books + trades))
+        bid, ask = expected['layer_1_bid_price_0'], expected['layer_1_ask_price_0']
+        assert np.allclose(selected['layer_1_mid'], (bid + ask) / 2, equal_nan=True)
+        assert np.allclose(selected['layer_1_spread'], ask - bid, equal_nan=True)
+
+
+def _outputs_equal(a: str, b: str) -> bool:
+    for code in CODES:
+        with open(os.path.join(a, f"{code}.csv"), 'rb') as x, open(os.path.join(b, f"{code}.csv"), 'rb') as y:
+            if x.read() != y.read():
+                return False
+    return True
@@ -0,0 +1,74 @@
+import os
+import time
+from conftest import CODES, DATES
+from coordinator import Coordinator
+
+
+def test_expired_lease_is_taken_over(tmp_path):
+    a = Coordinator(str(tmp_path), "a", lease=0.5)
+    b = Coordinator(str(tmp_path), "b", lease=0.5)
+    a.plan(['d1'], ['x'])
+    assert a.claim() == [('d1', 'x')]
+    assert b.claim() == []
+    a.renew([('d1', 'x')])
+    assert a.owns('d1', 'x')
+    time.sleep(1.0)
+    assert b.claim() == [('d1', 'x')]
+    assert a.attempt('d1', 'x') != b.attempt('d1', 'x')
+    # the first node lost its lease: it neither renews, completes nor releases the unit
+    promoted = []
+    a.renew([('d1', 'x')])
+    assert not a.complete('d1', 'x', {}, promote=lambda: promoted.append('a'))
+    assert b.owns('d1', 'x')
+    assert b.complete('d1', 'x', {}, promote=lambda: promoted.append('b'))
+    assert promoted == ['b']
+    assert b.done()[('d1', 'x')]['node'] == "b"
+    assert a.status() == {('d1', 'x'): 'done'}
+    assert a.claim() == []
+
+
+def test_failed_unit_is_retried_until_out_of_attempts(tmp_path):
+    coordinator = Coordinator(str(tmp_path), "a", max_attempts=2)
+    coordinator.plan(['d1'], ['x'])
+    for _ in range(2):
+        assert coordinator.claim() == [('d1', 'x')]
+        coordinator.fail('d1', 'x', "error\n")
+    assert coordinator.claim() == []
+    assert coordinator.status() == {('d1', 'x'): 'failed'}
+    assert coordinator.finished()
+
+
+def _outputs(dest: str) -> dict:
+    outputs = {}
+    for code in CODES:
+        path = os.path.join(dest, f"{code}.csv")
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                outputs[code] = f.read()
+    return outputs
+
+
+def test_merge_only_appends_the_dates_after_the_last_merge(make_replayer, tmp_path):
+    expected = make_replayer("parallel")
+    expected.compute_days_parallel(len(DATES))
+    expected = _outputs(expected.dest)
+
+    node = make_replayer("node")
+    coordinator = Coordinator(str(tmp_path / "coordinator"), "node")
+    node.run_node(coordinator, len(DATES), units=1, poll=0.1)
+    assert coordinator.finished()
+    # the first date of an instrument not done yet holds back its later dates
+    code = CODES[0]
+    done = os.path.join(coordinator.root, "done", f"{DATES[0]}_{code}.json")
+    os.rename(done, f"{done}.held")
+    merge = make_replayer("node")
+    assert merge.merge_units(coordinator) == [(date, code) for date in DATES]
+    assert code not in _outputs(merge.dest)
+    assert coordinator.merged() == {other: DATES[-1] for other in CODES[1:]}
+
+    os.rename(f"{done}.held", done)
+    assert merge.merge_units(coordinator) == []
+    assert _outputs(merge.dest) == expected
+    # merging again changes nothing
+    assert merge.merge_units(coordinator) == []
+    assert _outputs(merge.dest) == expected
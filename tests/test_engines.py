@@ -0,0 +1,53 @@
+import os
+import datetime
+import pytest
+from conftest import CODES, DATES, FREQUENCY, replay
+from synthetic import generate_days
+from orderbook import ArrayOrderBook
+
+
+def _outputs(dest: str) -> dict:
+    outputs = {}
+    for code in CODES:
+        with open(os.path.join(dest, f"{code}.csv"), 'rb') as f:
+            outputs[code] = f.read()
+    return outputs
+
+
+def test_engines_write_the_same_rows(make_replayer, tmp_path):
+    rows = _outputs(replay(make_replayer("rows")))
+    assert all(len(output.splitlines()) > 1 for output in rows.values())
+    assert _outputs(replay(make_replayer("batch", engine='batch'))) == rows
+    assert _outputs(replay(make_replayer("streaming", streaming=True, chunk_bytes=2**16))) == rows
+    cache = str(tmp_path / "cache")
+    assert _outputs(replay(make_replayer("cold", cache=cache))) == rows
+    assert _outputs(replay(make_replayer("warm", cache=cache))) == rows
+
+
+def test_parallel_dates_match_sequential(make_replayer):
+    rows = _outputs(replay(make_replayer("rows")))
+    replayer = make_replayer("parallel")
+    replayer.compute_days_parallel(2)
+    parallel = _outputs(replayer.dest)
+    # the second date starts from a warmup instead of the books and trades of the first one
+    day = 1 + int(datetime.timedelta(days=1) / FREQUENCY)
+    for code in CODES:
+        assert parallel[code].splitlines()[:day] == rows[code].splitlines()[:day]
+        assert len(parallel[code].splitlines()) == len(rows[code].splitlines())
+
+
+@pytest.fixture(scope="module")
+def shallow(tmp_path_factory) -> str:
+    # books of 3 visible levels, fewer than the 10 levels of the columns
+    root = str(tmp_path_factory.mktemp("shallow"))
+    generate_days(root, DATES, CODES, rate=0.2, trade_rate=0.05, depth=3, max_level=3, compresslevel=1)
+    return root
+
+
+def test_engines_pad_shallow_books(make_replayer, shallow):
+    rows = _outputs(replay(make_replayer("rows", src=shallow)))
+    header = rows[CODES[0]].splitlines()[0].count(b",")
+    assert all(line.count(b",") == header for output in rows.values() for line in output.splitlines())
+    assert b"nan" in rows[CODES[0]].splitlines()[1]
+    assert _outputs(replay(make_replayer("array", src=shallow, orderbook=ArrayOrderBook))) == rows
+    assert _outputs(replay(make_replayer("batch", src=shallow, engine='batch'))) == rows
@@ -0,0 +1,39 @@
+import os
+import numpy as np
+from conftest import CODES, DATES, replay
+
+
+def _state(replayer, books) -> bytes:
+    # the book columns of the live books, nan compares equal as bytes
+    return np.array(replayer.columns.snapshot(books), dtype=np.float64).tobytes()
+
+
+def _events(replayer, changes_only: bool = False) -> list:
+    return [(timestamp, _state(replayer, books), trade)
+            for timestamp, books, trade in replayer.iter_events(CODES[0], DATES[:1], changes_only)]
+
+
+def test_events_end_on_the_books_of_the_replay(make_replayer):
+    events = _events(make_replayer("events"))
+    timestamps = [timestamp for timestamp, _, _ in events]
+    assert timestamps == sorted(timestamps)
+    assert any(trade is not None for _, _, trade in events)
+    # the last row of the day is written after the last message of the day
+    dest = replay(make_replayer("rows"), days=1)
+    with open(os.path.join(dest, f"{CODES[0]}.csv")) as f:
+        last = f.read().splitlines()[-1].split(',')
+    book = np.frombuffer(events[-1][1])
+    assert np.array_equal(book, np.array(last[:len(book)], dtype=np.float64), equal_nan=True)
+
+
+def test_changes_only_skips_the_messages_that_left_the_books_unchanged(make_replayer):
+    replayer = make_replayer("events")
+    events = _events(replayer)
+    expected, state = [], _state(replayer, replayer.columns.books(CODES[0], replayer.orderbook))
+    for event in events:
+        if event[2] is not None or event[1] != state:
+            expected.append(event)
+        state = event[1]
+    changes = _events(make_replayer("changes"), changes_only=True)
+    assert len(changes) < len(events)
+    assert changes == expected
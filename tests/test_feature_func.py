@@ -0,0 +1,46 @@
+import datetime
+import numpy as np
+import polars as pl
+from conftest import ListSink
+from feature_func import VectorFeature
+from sinks import FeatureSink
+
+COLUMNS = ['close', 'volume']
+
+
+def _rows(n: int) -> list:
+    rng = np.random.default_rng(0)
+    return [[float(p), float(v)] for p, v in zip(100 + rng.integers(-5, 5, n) * 0.25, rng.integers(0, 9, n))]
+
+
+def test_features_do_not_depend_on_the_blocks():
+    features = [
+        VectorFeature('change', func=lambda close: np.diff(close, prepend=np.nan), deps=['close'], lookback=1),
+        VectorFeature('volume_3', expr=pl.col('volume').rolling_sum(3).alias('volume_3'), lookback=2),
+    ]
+    rows = _rows(50)
+    start = datetime.datetime(2020, 12, 1)
+    outputs = []
+    for block_rows in (4, 7, 50):
+        sink = ListSink()
+        feature_sink = FeatureSink(sink, COLUMNS, features, block_rows)
+        for i, row in enumerate(rows):
+            feature_sink.write(list(row), start + datetime.timedelta(seconds=i))
+        feature_sink.close()
+        assert [row[:2] for row, _ in sink.rows] == rows
+        outputs.append([row[2:] for row, _ in sink.rows])
+    close = np.array([row[0] for row in rows])
+    volume = np.array([row[1] for row in rows])
+    expected = np.column_stack([np.diff(close, prepend=np.nan),
+                                np.convolve(volume, np.ones(3))[:len(volume)]])
+    expected[:2, 1] = np.nan
+    for output in outputs:
+        # the first ticks of the day have no history, nan like the whole day at once
+        assert np.array_equal(np.array(output, dtype=np.float64), expected, equal_nan=True)
+
+
+def test_expression_deps_are_read_off_the_expression():
+    feature = VectorFeature('spread', expr=(pl.col('ask') - pl.col('bid')).alias('spread'))
+    assert feature.deps == ['ask', 'bid']
+    frame = pl.DataFrame({'ask': [2.0, 3.0], 'bid': [1.0, 1.5]})
+    assert feature.compute(frame).tolist() == [1.0, 1.5]
@@ -0,0 +1,81 @@
+import os
+import gzip
+import heapq
+import socket
+import asyncio
+import datetime
+import numpy as np
+from conftest import CODES, DATES, FREQUENCY, replay
+from live import LiveReplayer, FeedSimulator, simulate, parse_l2_line, parse_l1_line
+from trades import EPOCH
+
+
+def _lines(data: str, date: str) -> tuple:
+    paths = (os.path.join(data, "l2_data", f"{date}_1027_L2.csv.gz"),
+             os.path.join(data, "l1_data", f"{date}_1027_L1-Trades.csv.gz"))
+    lines = []
+    for path in paths:
+        with gzip.open(path, 'rt') as f:
+            lines.append(f.read().splitlines(keepends=True)[1:])
+    return (*paths, *lines)
+
+
+def _timed(lines: list, parse, kind: int):
+    # (timestamp, kind, i, line), messages without a server timestamp take the previous one
+    last = 0
+    for i, line in enumerate(lines):
+        timestamp = parse(line)[1]
+        last = timestamp if timestamp is not None else last
+        yield last, kind, i, line
+
+
+def test_live_rows_match_the_day_replay(make_replayer, data, tmp_path):
+    # the lines of both files in time order, snapshotting on the replay grid
+    _, _, l2, l1 = _lines(data, DATES[0])
+    live = LiveReplayer(str(tmp_path / "live"), CODES, FREQUENCY)
+    us = datetime.timedelta(microseconds=1)
+    step = FREQUENCY // us
+    # the replay day starts 2 hours before the date
+    start = (datetime.datetime.fromisoformat(DATES[0]) - datetime.timedelta(hours=2) - EPOCH) // us
+    boundary = start + step
+    for timestamp, kind, _, line in heapq.merge(_timed(l2, parse_l2_line, 0), _timed(l1, parse_l1_line, 1)):
+        while timestamp >= boundary:
+            live.snapshot(EPOCH + datetime.timedelta(microseconds=boundary))
+            boundary += step
+        (live.handle_l2 if kind == 0 else live.handle_l1)(line)
+    while boundary <= start + 24 * 3600 * 10**6:
+        live.snapshot(EPOCH + datetime.timedelta(microseconds=boundary))
+        boundary += step
+    live.close()
+    assert live.checks > 0 and live.consistent == live.checks
+    dest = replay(make_replayer("rows"), days=1)
+    for code in CODES:
+        with open(os.path.join(dest, f"{code}.csv"), 'rb') as a, open(tmp_path / "live" / f"{code}.csv", 'rb') as b:
+            assert a.read() == b.read()
+
+
+def _free_ports() -> list:
+    sockets = [socket.socket() for _ in range(2)]
+    for s in sockets:
+        s.bind(('127.0.0.1', 0))
+    ports = [s.getsockname()[1] for s in sockets]
+    for s in sockets:
+        s.close()
+    return ports
+
+
+def test_simulated_feeds_report_latency(data, tmp_path):
+    l2_path, l1_path, l2, l1 = _lines(data, DATES[0])
+    l2_port, l1_port = _free_ports()
+    # a whole day in about a second
+    live = asyncio.run(simulate(l2_path, l1_path, str(tmp_path / "live"), CODES, speed=1e5,
+                                l2_port=l2_port, l1_port=l1_port, frequency=datetime.timedelta(minutes=10)))
+    assert live.messages == len(l2) + len(l1)
+    assert live.consistent == live.checks > 0
+    percentiles = live.latency_percentiles((50, 99))
+    assert percentiles['messages'] == live.messages
+    assert 0 < percentiles['latency_us'][50] <= percentiles['latency_us'][99]
+    assert percentiles['lag_us'][50] <= percentiles['lag_us'][99]
+    with open(tmp_path / "live" / f"{CODES[0]}.csv") as f:
+        assert len(f.read().splitlines()) > 1
+    assert FeedSimulator(l2_path, l1_path).start == min(parse_l2_line(line)[1] or np.inf for line in l2)
@@ -0,0 +1,16 @@
+from main import parse_args
+
+
+def test_data_arguments():
+    args = parse_args(["src", "dst", "2", "--eid", "9", "--start", "2020-12-02", "--universe", "111", "222",
+                       "--frequency", "10"])
+    assert (args.command, args.eid, args.start, args.universe, args.frequency) == \
+        ("replay", "9", "2020-12-02", ["111", "222"], 10.0)
+    assert parse_args(["src", "dst", "2", "--universe"]).universe == [] # inferred from the first date
+    assert parse_args(["node", "src", "dst", "coordinator", "2"]).universe == ["648799570"]
+    assert parse_args(["simulate", "src", "2020-12-01", "--eid", "9"]).eid == "9"
+
+
+def test_live_universe():
+    assert parse_args(["live", "l2", "l1", "dst", "--universe", "111", "222"]).universe == ["111", "222"]
+    assert parse_args(["live", "l2", "l1", "dst"]).universe == ["648799570"]
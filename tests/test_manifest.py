@@ -0,0 +1,58 @@
+import os
+import shutil
+import pytest
+from conftest import CODES
+from synthetic import generate_day, generate_days
+
+DATES = ['2020-12-01', '2020-12-02', '2020-12-03']
+
+
+@pytest.fixture(scope="module")
+def days(tmp_path_factory) -> str:
+    root = str(tmp_path_factory.mktemp("days"))
+    generate_days(root, DATES, CODES, rate=0.1, trade_rate=0.05, compresslevel=1)
+    return root
+
+
+def _outputs(dest: str) -> dict:
+    outputs = {}
+    for code in CODES:
+        with open(os.path.join(dest, f"{code}.csv"), 'rb') as f:
+            outputs[code] = f.read()
+    return outputs
+
+
+def _run(make_replayer, name: str, src: str, days: int, **params) -> str:
+    replayer = make_replayer(name, src=src, **params)
+    for _ in range(days):
+        replayer.compute_day()
+    replayer.close()
+    return replayer.dest
+
+
+def test_resume_after_a_crash_matches_an_uninterrupted_run(make_replayer, days):
+    expected = _outputs(_run(make_replayer, "uninterrupted", days, 3))
+    dest = _run(make_replayer, "resumed", days, 2)
+    # a crash in the middle of the next date leaves a partial row behind
+    for code in CODES:
+        with open(os.path.join(dest, f"{code}.csv"), 'ab') as f:
+            f.write(b"99.0, 98.5, garb")
+    _run(make_replayer, "resumed", days, 3, resume=True)
+    assert _outputs(dest) == expected
+
+
+def test_changed_input_redoes_its_date_and_the_later_ones(make_replayer, days, tmp_path, capsys):
+    src = str(tmp_path / "src")
+    shutil.copytree(days, src)
+    dest = _run(make_replayer, "resumed", src, 3)
+    # the second date is replaced by another day
+    generate_day(src, DATES[1], CODES, rate=0.1, trade_rate=0.05, compresslevel=1, seed=7)
+    replayer = make_replayer("resumed", src=src, resume=True)
+    capsys.readouterr()
+    for date in DATES:
+        replayer.compute_day()
+        skipped = f"skipping {date}" in capsys.readouterr().out
+        assert skipped == (date == DATES[0])
+    replayer.close()
+    assert _outputs(dest) == _outputs(_run(make_replayer, "fresh", src, 3))
+    assert _outputs(dest) != _outputs(_run(make_replayer, "original", days, 3))
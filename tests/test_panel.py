@@ -0,0 +1,33 @@
+import os
+import numpy as np
+import polars as pl
+from conftest import CODES, DATES, replay
+from panel import panel_columns, split_members, stack_members
+
+
+def test_members_are_stacked_and_split_in_group_order():
+    frames = {code: pl.DataFrame({'x': [i, i + 1]}) for i, code in enumerate(CODES)}
+    stacked = stack_members(frames, CODES[::-1])
+    assert stacked['x'].to_list() == [1, 2, 0, 1]
+    assert {code: frame['x'].to_list() for code, frame in split_members(stacked, CODES[::-1]).items()} == \
+        {'222': [1, 2], '111': [0, 1]}
+    assert panel_columns(CODES, ['a', 'b']) == ['111_a', '111_b', '222_a', '222_b']
+
+
+def test_panel_holds_the_rows_of_its_members(make_replayer):
+    rows = replay(make_replayer("rows"))
+    panel = replay(make_replayer("panel", panels={'pair': list(CODES)}))
+    assert not any(os.path.exists(os.path.join(panel, f"{code}.csv")) for code in CODES)
+    for code in CODES:
+        expected = pl.read_csv(os.path.join(rows, f"{code}.csv"), infer_schema=False)
+        expected = expected.rename({col: col.strip() for col in expected.columns})
+        columns = [col for col in expected.columns if col != 'timestamp']
+        parts = [pl.read_parquet(os.path.join(panel, "panels", "code=pair", f"date={date}", "part-0.parquet"))
+                 for date in DATES]
+        wide = pl.concat(parts)
+        assert wide.height == expected.height
+        # the panel is float32, the rows float64 with None before the first trade
+        want = expected.select(pl.col(col).str.strip_chars().cast(pl.Float64, strict=False).fill_null(np.nan)
+                               for col in columns).to_numpy().astype(np.float32)
+        got = wide.select(f"{code}_{col}" for col in columns).to_numpy()
+        assert np.array_equal(want, got, equal_nan=True)
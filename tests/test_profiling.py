@@ -0,0 +1,55 @@
+import os
+import csv
+import itertools
+from conftest import CODES, DATES, replay
+from profiling import StageProfile, StageClock
+
+
+def test_stages_accumulate_in_order():
+    ticks = itertools.count()
+    profile = StageProfile(DATES[0], cpu=lambda: next(ticks)) # one cpu second per reading
+    for _ in range(2):
+        with profile.stage('csv_scan') as counts:
+            counts.rows, counts.messages = 10, 4
+    with profile.stage('encode'):
+        pass
+    rows = profile.rows()
+    assert [row['stage'] for row in rows] == ['csv_scan', 'encode']
+    scan = rows[0]
+    assert (scan['date'], scan['code'], scan['cpu_s'], scan['rows'], scan['messages']) == (DATES[0], None, 2, 20, 8)
+    assert scan['rows_per_s'] == scan['rows'] / scan['wall_s'] and scan['peak_rss_mb'] > 0
+
+
+def test_clock_laps_split_a_loop():
+    clock = StageClock()
+    for _ in range(3):
+        clock.lap('replay')
+        sum(range(10**4))
+        clock.lap('features')
+    profile = StageProfile(DATES[0], CODES[0])
+    clock.add_to(profile, {'replay': 3}, {'replay': 7})
+    rows = {row['stage']: row for row in profile.rows()}
+    assert rows['features']['wall_s'] > 0 and rows['replay']['rows'] == 3 and rows['replay']['messages'] == 7
+
+
+def _read(path: str) -> str:
+    with open(path) as f:
+        return f.read()
+
+
+def test_day_report_of_a_replay(make_replayer):
+    plain = replay(make_replayer("plain"), days=1)
+    profiled = make_replayer("profiled", profile=True)
+    replay(profiled, days=1)
+    with open(os.path.join(profiled.profile_dir, f"{DATES[0]}.csv")) as f:
+        rows = list(csv.DictReader(f))
+    loading = [row['stage'] for row in rows if row['code'] == '']
+    assert loading[0] == 'csv_scan' and 'group_by_dynamic' in loading
+    for code in CODES:
+        stages = {row['stage']: row for row in rows if row['code'] == code}
+        assert {'replay', 'features', 'write'} <= set(stages)
+        output = _read(os.path.join(plain, f"{code}.csv"))
+        assert int(stages['replay']['rows']) == len(output.splitlines()) - 1
+        assert int(stages['replay']['messages']) > 0
+        # profiling does not change the output
+        assert _read(os.path.join(profiled.dest, f"{code}.csv")) == output
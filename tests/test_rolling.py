@@ -0,0 +1,79 @@
+import math
+import numpy as np
+import pytest
+from rolling import RollingSum, RollingMean, RollingVar, RollingMin, RollingMax, EWMA, OrderFlowImbalance, DecayedCount
+from feature_func import OnlineFeature, online_feature, all_features
+
+
+def _values(n: int = 300) -> list:
+    rng = np.random.default_rng(0)
+    values = (1e6 + rng.normal(0, 1, n)).tolist() # far from zero, where naive sums of squares cancel out
+    for i in rng.integers(0, n, n // 10):
+        values[i] = None if i % 2 else math.nan
+    return values
+
+
+def _windows(values: list, window: int):
+    for i in range(len(values)):
+        yield np.array([np.nan if v is None else v for v in values[max(0, i - window + 1):i + 1]])
+
+
+@pytest.mark.parametrize("window", [1, 5, 64])
+def test_window_operators_match_numpy(window):
+    values = _values()
+    ops = {
+        RollingSum(window): lambda w: w.sum() if len(w) else np.nan,
+        RollingMean(window): lambda w: w.mean() if len(w) else np.nan,
+        RollingVar(window): lambda w: w.var(ddof=1) if len(w) > 1 else np.nan,
+        RollingMin(window): lambda w: w.min() if len(w) else np.nan,
+        RollingMax(window): lambda w: w.max() if len(w) else np.nan,
+    }
+    for op, reference in ops.items():
+        for x, w in zip(values, _windows(values, window)):
+            got, expected = op.update(x), reference(w[~np.isnan(w)])
+            if np.isnan(expected):
+                assert np.isnan(got)
+            else:
+                assert got == pytest.approx(expected, rel=1e-9, abs=1e-9)
+
+
+def test_empty_window_sums_to_nothing():
+    op = RollingSum(2)
+    assert [op.update(x) for x in (1e16, 1.0)] == [1e16, 1e16 + 1.0]
+    assert op.update(None) == 1.0 # compensated, 1e16 + 1.0 - 1e16 is exact
+    assert math.isnan(op.update(None))
+    assert (op.count, op.sum, op.comp) == (0, 0.0, 0.0)
+    assert op.update(3.0) == 3.0
+
+
+def test_ewma_and_decayed_count():
+    ewma = EWMA(alpha=0.5)
+    assert math.isnan(ewma.update(None))
+    assert [ewma.update(x) for x in (2.0, 4.0, math.nan)] == [2.0, 3.0, 3.0]
+    assert EWMA(halflife=1).alpha == pytest.approx(0.5)
+    count = DecayedCount(halflife=1)
+    assert [count.update(x) for x in (1, None, 2)] == [1.0, 0.5, 2.25]
+
+
+def test_order_flow_imbalance():
+    ofi = OrderFlowImbalance(window=2)
+    assert math.isnan(ofi.update(100.0, 5.0, 101.0, 5.0)) # no previous top
+    # bid queue grows by 2, ask queue shrinks by 1
+    assert ofi.update(100.0, 7.0, 101.0, 4.0) == 3.0
+    # bid price steps up: the whole new queue arrives
+    assert ofi.update(100.5, 1.0, 101.0, 4.0) == 4.0
+    assert ofi.update(None, 1.0, 101.0, 4.0) == 1.0 # missing, the window still moves
+
+
+def test_online_features_read_snapshot_columns():
+    feature = OnlineFeature(RollingSum(2), ['close'])
+    feature.bind(['open', 'close'])
+    assert [feature([0.0, x]) for x in (1.0, 2.0, 4.0)] == [1.0, 3.0, 6.0]
+    with pytest.raises(AssertionError):
+        OnlineFeature(RollingSum(2), ['missing']).bind(['open', 'close'])
+    all_features.append('per_tick')
+    try:
+        with pytest.raises(AssertionError, match="per tick features"):
+            online_feature('sum_of_feature', 'sum', 'per_tick', window=2)
+    finally:
+        all_features.remove('per_tick')
@@ -0,0 +1,66 @@
+import os
+import numpy as np
+import polars as pl
+import pytest
+from conftest import CODES, DATES, FREQUENCY, replay
+from sinks import densify, load_index, sparse_watch, frequency_label
+
+
+def _csv(dest: str, code: str) -> pl.DataFrame:
+    frame = pl.read_csv(os.path.join(dest, f"{code}.csv"), infer_schema=False)
+    frame = frame.rename({col: col.strip() for col in frame.columns})
+    return frame.with_columns(
+        pl.col(col).str.strip_chars().replace({'None': None, '': None}).cast(pl.Float32)
+        for col in frame.columns if col != 'timestamp'
+    ).with_columns(pl.col('timestamp').str.strip_chars().str.to_datetime(time_unit='us'))
+
+
+def _columnar(dest: str, code: str, output: str, date: str = None) -> pl.DataFrame:
+    read = pl.read_parquet if output == 'parquet' else pl.read_ipc
+    dates = DATES if date is None else [date]
+    ext = 'parquet' if output == 'parquet' else 'arrow'
+    return pl.concat([read(os.path.join(dest, f"code={code}", f"date={date}", f"part-0.{ext}")) for date in dates])
+
+
+def _equal(a: pl.DataFrame, b: pl.DataFrame, columns: list) -> bool:
+    assert a.height == b.height
+    x = a.select(columns).to_numpy().astype(np.float32)
+    y = b.select(columns).to_numpy().astype(np.float32)
+    return np.array_equal(x, y, equal_nan=True) and a['timestamp'].equals(b['timestamp'].cast(pl.Datetime('us')))
+
+
+@pytest.mark.parametrize("output", ['parquet', 'ipc'])
+def test_columnar_outputs_match_csv(make_replayer, output):
+    csv = replay(make_replayer("csv"))
+    columnar = replay(make_replayer(output, output=output))
+    for code in CODES:
+        expected = _csv(csv, code)
+        values = [col for col in expected.columns if col != 'timestamp']
+        assert _equal(_columnar(columnar, code, output), expected, values)
+
+
+def test_densify_restores_sparse_output(make_replayer):
+    dense = replay(make_replayer("dense", output='parquet'))
+    sparse = replay(make_replayer("sparse", output='parquet', sparse_levels=1))
+    for code in CODES:
+        for date in DATES:
+            full = _columnar(dense, code, 'parquet', date)
+            rows = _columnar(sparse, code, 'parquet', date)
+            assert rows.height < full.height
+            index = load_index(sparse, code, date)
+            assert index['rows'] == rows.height and index['intervals'] == full.height
+            watched = sparse_watch(full.columns, levels=1)
+            assert _equal(densify(rows, index), full, watched)
+
+
+@pytest.mark.parametrize("trade_stats", [False, True])
+def test_one_pass_serves_every_frequency(make_replayer, trade_stats):
+    frequencies = [FREQUENCY, 6 * FREQUENCY]
+    both = replay(make_replayer("both", frequency=frequencies, trade_stats=trade_stats))
+    for frequency in frequencies:
+        alone = replay(make_replayer(f"alone-{frequency_label(frequency)}", frequency=frequency,
+                                     trade_stats=trade_stats))
+        for code in CODES:
+            with open(os.path.join(both, frequency_label(frequency), f"{code}.csv"), 'rb') as a, \
+                    open(os.path.join(alone, f"{code}.csv"), 'rb') as b:
+                assert a.read() == b.read()
@@ -0,0 +1,51 @@
+import datetime
+import math
+from trades import TradesHandler, EPOCH
+
+FREQUENCY = datetime.timedelta(seconds=1)
+TRADES = [(100.0, 2.0, 1, 10), (None, 1.0, 1, 11), (101.0, 1.0, 2, 12), (99.5, 3.0, 1, 13), (100.5, 1.0, 2, 14)]
+
+
+def test_ohlcva_trade_by_trade():
+    handler = TradesHandler("111", FREQUENCY)
+    for price, qty, _, _ in TRADES:
+        handler.handle_trades(price, qty)
+    assert tuple(handler.get_ohlcva()) == (100.0, 101.0, 99.5, 100.5, 7.0, 200.0 + 101.0 + 298.5 + 100.5)
+    assert handler.vwap == (200.0 + 101.0 + 298.5 + 100.5) / 7.0
+    # an interval without trades repeats the last close with no volume
+    assert list(handler.get_ohlcva()) == [100.5] * 4 + [0, 0]
+    assert list(TradesHandler("111", FREQUENCY).get_ohlcva()) == [None] * 4 + [0, 0]
+
+
+def test_array_and_bars_match_trade_by_trade():
+    one = TradesHandler("111", FREQUENCY, stats=True)
+    for price, qty, side, time in TRADES:
+        one.handle_trades(price, qty, side, time)
+    array = TradesHandler("111", FREQUENCY, stats=True)
+    array.handle_trades_array(*zip(*TRADES))
+    bars = TradesHandler("111", FREQUENCY)
+    for trades in (TRADES[:2], TRADES[2:3], [], TRADES[3:]):
+        bar = TradesHandler("111", FREQUENCY, stats=True)
+        for trade in trades:
+            bar.handle_trades(*trade)
+        ohlcva = list(bar.get_ohlcva())
+        count, signed_volume, _ = bar.get_stats(EPOCH)
+        bars.handle_bar(*ohlcva, count, signed_volume)
+    assert bars.signed_volume == 3.0
+    expected = list(one.get_ohlcva())
+    assert list(array.get_ohlcva()) == expected
+    assert list(bars.get_ohlcva()) == expected
+    # 5 seconds after the last trade, at 14us
+    timestamp = EPOCH + datetime.timedelta(microseconds=14, seconds=5)
+    assert one.get_stats(timestamp) == array.get_stats(timestamp) == [4, 2.0 - 1.0 + 3.0 - 1.0, 5.0]
+
+
+def test_stats_reset_every_interval():
+    handler = TradesHandler("111", FREQUENCY, stats=True)
+    handler.handle_trades(100.0, 1.0, 1, 0)
+    handler.get_ohlcva()
+    assert handler.get_stats(EPOCH)[:2] == [1, 1.0]
+    handler.get_ohlcva()
+    count, signed_volume, age = handler.get_stats(EPOCH + FREQUENCY)
+    assert (count, signed_volume, age) == (0, 0, 1.0)
+    assert math.isnan(TradesHandler("111", FREQUENCY, stats=True).get_stats(EPOCH)[2])
@@ -1,40 +1,140 @@
-import numpy as np 
+import datetime
+import numpy as np
+from feature_func import bind_features
+
+EPOCH = datetime.datetime(1970, 1, 1)
+MICROSECOND = datetime.timedelta(microseconds=1)
+
 
 class TradesHandler:
-    
+
     """
     should be used to store trade data for a single instrument
     has handler functions for all types of trade updates
+    ohlcva of the current interval are accumulated trade by trade, nothing is allocated per interval
+
+    with stats, also keeps the trade count and signed volume (buyer initiated minus seller initiated)
+    of the interval and the time of the last trade, see get_stats
     """
-    
-    def __init__(self, code, freq):
+
+    __slots__ = (
+        'code', 'freq', 'stats', 'vwap', 'feature_funcs',
+        'open', 'high', 'low', 'close', 'volume', 'amount',
+        'count', 'signed_volume', 'last_trade_time',
+        'prev_open', 'prev_high', 'prev_low', 'prev_close',
+    )
+
+    def __init__(self, code, freq, stats: bool = False, columns: list = None):
         self.code = code
         self.freq = freq
-        self.recent_trade_prices = []
-        self.recent_trade_volumes = []
+        self.stats = stats
         self.prev_open = None
         self.prev_high = None
         self.prev_low = None
         self.prev_close = None
         self.vwap = np.nan
-        
-    def handle_trades(self, price, qty):
+        self.last_trade_time = None # microseconds since epoch
+        self.feature_funcs = bind_features(columns) # per tick features with this instrument's state
+        self._reset()
+
+    def _reset(self):
+        self.open = None
+        self.high = None
+        self.low = None
+        self.close = None
+        self.volume = 0
+        self.amount = 0
+        self.count = 0
+        self.signed_volume = 0
+
+    def handle_trades(self, price, qty, side=None, time=None):
         if price is None: return
-        self.recent_trade_prices.append(price)
-        self.recent_trade_volumes.append(qty)
-    
+        if self.open is None:
+            self.open = self.high = self.low = price
+        elif price > self.high:
+            self.high = price
+        elif price < self.low:
+            self.low = price
+        self.close = price
+        self.volume += qty
+        self.amount += price * qty
+        self.count += 1
+        if self.stats:
+            self._handle_stats(qty, side, time)
+
+    def handle_trades_array(self, prices, qtys, sides=None, times=None):
+        """
+        all trades of an interval at once, e.g. the list columns of a bucketed l1 row, None prices are skipped
+        """
+        first, high, low, last = self.open, self.high, self.low, self.close
+        volume, amount, count = self.volume, self.amount, self.count
+        for price, qty in zip(prices, qtys):
+            if price is None: continue
+            if first is None:
+                first = high = low = price
+            elif price > high:
+                high = price
+            elif price < low:
+                low = price
+            last = price
+            volume += qty
+            amount += price * qty
+            count += 1
+        self.open, self.high, self.low, self.close = first, high, low, last
+        self.volume, self.amount, self.count = volume, amount, count
+        if self.stats:
+            for price, qty, side, time in zip(prices, qtys, sides, times):
+                if price is not None:
+                    self._handle_stats(qty, side, time)
+
+    def handle_bar(self, open, high, low, close, volume, amount, count=1, signed_volume=0):
+        """
+        folds the ohlcva of a finer interval into the current one, intervals without trades (count 0) are skipped
+        """
+        if count == 0: return
+        if self.open is None:
+            self.open, self.high, self.low = open, high, low
+        else:
+            self.high = max(self.high, high)
+            self.low = min(self.low, low)
+        self.close = close
+        self.volume += volume
+        self.amount += amount
+        self.count += count
+        self.signed_volume += signed_volume
+
+    def _handle_stats(self, qty, side, time):
+        # TradeEvent_Context_AggressorSide: 1 buyer initiated, 2 seller initiated
+        if side == 1:
+            self.signed_volume += qty
+        elif side == 2:
+            self.signed_volume -= qty
+        if time is not None:
+            self.last_trade_time = time
+
     def get_ohlcva(self):
-        if len(self.recent_trade_prices) == 0:
+        if self.count == 0:
             # open, high, low, close, volume, amount
-            return [self.prev_close] * 4 + [0] * 2 
+            return [self.prev_close] * 4 + [0] * 2
         else:
-            self.prev_open = self.recent_trade_prices[0]
-            self.prev_high = max(self.recent_trade_prices)
-            self.prev_low = min(self.recent_trade_prices)
-            self.prev_close = self.recent_trade_prices[-1]
-            volume = sum(self.recent_trade_volumes)
-            amount = sum([p * v for p, v in zip(self.recent_trade_prices, self.recent_trade_volumes)])
+            self.prev_open = self.open
+            self.prev_high = self.high
+            self.prev_low = self.low
+            self.prev_close = self.close
+            volume, amount = self.volume, self.amount
             self.vwap = amount / volume
-            self.recent_trade_prices = []
-            self.recent_trade_volumes = []
+            if not self.stats:
+                self._reset()
             return self.prev_open, self.prev_high, self.prev_low, self.prev_close, volume, amount
+
+    def get_stats(self, timestamp):
+        """
+        trade count, signed volume and seconds since the last trade at timestamp, the end of the interval,
+        to be called after get_ohlcva
+        """
+        count, signed_volume = self.count, self.signed_volume
+        age = np.nan
+        if self.last_trade_time is not None:
+            age = ((timestamp - EPOCH) // MICROSECOND - self.last_trade_time) / 1e6
+        self._reset()
+        return [count, signed_volume, age]
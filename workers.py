@@ -0,0 +1,229 @@
+import os
+import queue
+import shutil
+import tempfile
+import traceback
+import threading
+import collections
+import multiprocessing as mp
+import polars as pl
+from profiling import SamplingProfiler
+
+
+def publish_day(spool: str, code: str, date: str, l2: pl.DataFrame, l1: pl.DataFrame) -> tuple:
+    """
+    writes the day's frames of one instrument as uncompressed arrow ipc files,
+    only the returned paths travel to the worker, which memory maps them instead of unpickling a copy
+    """
+    paths = (
+        os.path.join(spool, f"{code}_{date}_l2.arrow"),
+        os.path.join(spool, f"{code}_{date}_l1.arrow"),
+    )
+    l2.write_ipc(paths[0], compression='uncompressed')
+    l1.write_ipc(paths[1], compression='uncompressed')
+    return paths
+
+
+def attach_day(paths: tuple) -> tuple:
+    return tuple(pl.read_ipc(path, memory_map=True) for path in paths)
+
+
+def _run_day(engine, state, code, date, l2, l1, l2_col_mapping, l1_col_mapping, results) -> None:
+    ob_handler, trade_handler, sink, last, own_engine, resync = state
+    if own_engine is not None:
+        engine = own_engine
+    sink.date = date
+    try:
+        # a resynced instrument starts from empty books, picking every layer up at its first full OverlapRefresh
+        last, accuracy = engine(l2, l1, l2_col_mapping, l1_col_mapping, ob_handler, trade_handler, sink, last, resync)
+        state[3] = last
+        state[5] = False
+        results.put(('day', code, date, accuracy, None))
+    except Exception:
+        results.put(('day', code, date, None, traceback.format_exc()))
+
+
+def _stream_windows(code, windows, results):
+    # the windows of one instrument as they are published, acked once the engine asks for the next one
+    while True:
+        paths = windows.get()
+        if paths is None:
+            return
+        yield attach_day(paths)
+        results.put(('ack', code, None))
+
+
+def _worker_loop(engine, tasks, results, sampling=None) -> None:
+    # state of every instrument pinned to this worker:
+    # {code: [ob_handler, trade_handler, sink, last, engine or None, whether the next day warms up]}
+    state = {}
+    # sampling is (interval, directory) of the sampling profiler, saved when the worker shuts down
+    profiler = None
+    if sampling is not None:
+        profiler = SamplingProfiler(sampling[0])
+        profiler.start()
+    # streamed days run in one thread per instrument so the windows of all instruments can interleave
+    streams = {} # {code: (queue of window paths, thread)}
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        kind, code, payload = task
+        if kind == 'init':
+            state[code] = list(payload) + [False]
+        elif kind == 'resync':
+            state[code][0], state[code][1] = payload
+            state[code][3] = None
+            state[code][5] = True
+        elif kind == 'day':
+            paths, l2_col_mapping, l1_col_mapping, date = payload
+            _run_day(engine, state[code], code, date, *attach_day(paths), l2_col_mapping, l1_col_mapping, results)
+        elif kind == 'stream':
+            l2_col_mapping, l1_col_mapping, date = payload
+            windows = queue.Queue()
+            thread = threading.Thread(
+                target=_run_day,
+                args=(engine, state[code], code, date, _stream_windows(code, windows, results), None,
+                      l2_col_mapping, l1_col_mapping, results),
+                daemon=True,
+            )
+            thread.start()
+            streams[code] = (windows, thread)
+        elif kind == 'window':
+            streams[code][0].put(payload)
+        elif kind == 'end':
+            streams.pop(code)[0].put(None)
+        elif kind == 'state':
+            ob_handler, trade_handler, _, last, _, _ = state[code]
+            results.put(('state', code, (ob_handler, trade_handler, last)))
+    if profiler is not None:
+        profiler.stop()
+        profiler.save(os.path.join(sampling[1], f"worker-{os.getpid()}.folded"))
+
+
+class InstrumentWorkerPool:
+
+    """
+    long lived worker processes with instrument affinity
+    every instrument is pinned to one worker which owns its order books, trades handler, sink and
+    carry over across compute_day calls, so only the day's data is shipped to the workers
+    the day's data itself is handed over as memory mapped arrow ipc files in spool_dir,
+    which defaults to /dev/shm (shared memory) when available
+    a streamed day is handed over window by window instead, with at most max_pending windows per instrument
+    published ahead of its worker
+    a failed day leaves the state of its instrument half applied, resync replaces it with empty books
+    that warm up on the next day
+    an instrument added with its own engine is replayed by it instead, e.g. the group of a panel (see panel.py),
+    which is added and submitted under the name of the group
+    sampling is (interval, directory) to run a profiling.SamplingProfiler in every worker,
+    whose stacks are written to {directory}/worker-{pid}.folded on close
+    """
+
+    def __init__(self, engine, max_workers: int = 2, spool_dir: str = None, max_pending: int = 2,
+                 sampling: tuple = None) -> None:
+        if spool_dir is None:
+            spool_dir = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+        self.spool = tempfile.mkdtemp(prefix="replayer-", dir=spool_dir)
+        self.published = collections.defaultdict(collections.deque) # {code: paths not yet consumed, oldest first}
+        self.max_pending = max_pending # windows of a streamed day published ahead of its worker
+        self.finished = [] # (code, date, accuracy, error) not yet yielded by wait
+        self.states = {}
+        self.engine = engine
+        self.results = mp.Queue()
+        self.tasks = [mp.Queue() for _ in range(max_workers)]
+        self.processes = [
+            mp.Process(target=_worker_loop, args=(engine, tasks, self.results, sampling), daemon=True)
+            for tasks in self.tasks
+        ]
+        for p in self.processes:
+            p.start()
+        self.affinity = {} # {code: worker index}
+        self.streaming = set() # codes with a streamed day in progress
+
+    def add(self, code: str, ob_handler: dict, trade_handler, sink, last=None, engine=None) -> None:
+        # pin instruments round robin
+        worker = len(self.affinity) % len(self.tasks)
+        self.affinity[code] = worker
+        self.tasks[worker].put(('init', code, (ob_handler, trade_handler, sink, last, engine)))
+
+    def resync(self, code: str, ob_handler: dict, trade_handler) -> None:
+        # the next day of code starts from these (empty) handlers, without carry over, and warms up
+        self.tasks[self.affinity[code]].put(('resync', code, (ob_handler, trade_handler)))
+
+    def submit(self, code: str, l2, l1, l2_col_mapping: dict, l1_col_mapping: dict, date: str) -> None:
+        paths = publish_day(self.spool, code, date, l2, l1)
+        self.published[code].append(paths)
+        self.tasks[self.affinity[code]].put(('day', code, (paths, l2_col_mapping, l1_col_mapping, date)))
+
+    def start_stream(self, code: str, l2_col_mapping: dict, l1_col_mapping: dict, date: str) -> None:
+        """
+        starts a day of code whose data follows window by window through submit_window, until end_stream
+        """
+        self.streaming.add(code)
+        self.tasks[self.affinity[code]].put(('stream', code, (l2_col_mapping, l1_col_mapping, date)))
+
+    def submit_window(self, code: str, l2, l1, date: str, index: int) -> None:
+        # blocks while max_pending windows of code are waiting for its worker
+        while code in self.streaming and len(self.published[code]) >= self.max_pending:
+            self._handle(self._get())
+        if code not in self.streaming:
+            return # the day already failed
+        paths = publish_day(self.spool, code, f"{date}.{index}", l2, l1)
+        self.published[code].append(paths)
+        self.tasks[self.affinity[code]].put(('window', code, paths))
+
+    def end_stream(self, code: str) -> None:
+        self.tasks[self.affinity[code]].put(('end', code, None))
+
+    def wait(self, n: int):
+        """
+        yields (code, date, accuracy, error) for the next n finished days, error is a formatted traceback or None
+        """
+        for _ in range(n):
+            while len(self.finished) == 0:
+                self._handle(self._get())
+            yield self.finished.pop(0)
+
+    def fetch_state(self, code: str) -> tuple:
+        """
+        returns a copy of (ob_handler, trade_handler, last) as currently held by the worker of code
+        must not be called while days are pending
+        """
+        self.tasks[self.affinity[code]].put(('state', code, None))
+        while code not in self.states:
+            self._handle(self._get())
+        return self.states.pop(code)
+
+    def close(self) -> None:
+        for tasks in self.tasks:
+            tasks.put(None)
+        for p in self.processes:
+            p.join()
+        shutil.rmtree(self.spool, ignore_errors=True)
+
+    def _handle(self, message) -> None:
+        kind, code = message[:2]
+        if kind == 'ack':
+            self._remove(self.published[code].popleft())
+        elif kind == 'day':
+            # whatever is left was never read, the day is over either way
+            while self.published[code]:
+                self._remove(self.published[code].popleft())
+            self.streaming.discard(code)
+            self.finished.append(message[1:])
+        elif kind == 'state':
+            self.states[code] = message[2]
+
+    @staticmethod
+    def _remove(paths) -> None:
+        for path in paths:
+            os.remove(path)
+
+    def _get(self):
+        while True:
+            try:
+                return self.results.get(timeout=1)
+            except queue.Empty:
+                dead = [p.pid for p in self.processes if not p.is_alive()]
+                if dead:
+                    raise RuntimeError(f"worker processes {dead} died")